@@ -0,0 +1,307 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List, Tuple
+import numpy as np
+import rembg
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Models suited to stamp illustrations, with short aliases
+REMBG_MODELS = {
+    'u2net': 'u2net',
+    'u2netp': 'u2netp',
+    'isnet': 'isnet-general-use',
+    'isnet-general-use': 'isnet-general-use',
+    'isnet-anime': 'isnet-anime',
+    'silueta': 'silueta'
+}
+
+# Model input side and normalisation (mean, std), as used by the rembg sessions
+_U2NET_INPUT = (320, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+MODEL_INPUTS = {
+    'u2net': _U2NET_INPUT,
+    'u2netp': _U2NET_INPUT,
+    'silueta': _U2NET_INPUT,
+    'isnet-general-use': (1024, (0.5, 0.5, 0.5), (1.0, 1.0, 1.0)),
+    'isnet-anime': (1024, (0.485, 0.456, 0.406), (1.0, 1.0, 1.0))
+}
+
+# Calibrated batch size per model, shared by every remover in the process
+_calibrated_batch_sizes: Dict[str, int] = {}
+
+class BackgroundRemover:
+    """Pool of explicitly created, pre-warmed rembg sessions.
+    
+    rembg.remove() without a session builds a new ONNX Runtime session on
+    every call. Here sessions are created once per worker with tuned thread
+    counts, warmed with a dummy inference, and checked out per image. Load
+    time and per-image inference latency are recorded.
+    
+    predict_masks() runs several images through one ONNX Runtime call.
+    REMBG_BATCH_SIZE=auto picks the batch size from a short calibration
+    benchmark, run once per process and model by warm_up() and kept out of
+    the inference stats."""
+    
+    def __init__(self, model_name: Optional[str] = None, pool_size: Optional[int] = None):
+        model_name = (model_name or os.getenv('REMBG_MODEL', 'u2net')).lower()
+        if model_name not in REMBG_MODELS:
+            raise ValueError(f"Unsupported rembg model: {model_name} (choose from {', '.join(REMBG_MODELS)})")
+        self.model_name = REMBG_MODELS[model_name]
+        self.pool_size = max(1, pool_size or int(os.getenv('REMBG_SESSIONS', 1)))
+        self.intra_op_threads = int(os.getenv('REMBG_INTRA_OP_THREADS', 0))  # 0 = ONNX Runtime default
+        self.inter_op_threads = int(os.getenv('REMBG_INTER_OP_THREADS', 0))
+        batch_size = os.getenv('REMBG_BATCH_SIZE', 'auto').lower()
+        self.batch_size: Optional[int] = None if batch_size == 'auto' else max(1, int(batch_size))
+        self._batching_supported: Optional[bool] = None
+        self._calibrate_lock = threading.Lock()
+        self.calibration: Dict[int, float] = {}
+        
+        self._sessions: "queue.Queue" = queue.Queue()
+        self._created = 0
+        self._create_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'sessions': 0,
+            'load_seconds': [],
+            'images': 0,
+            'inference_seconds': 0.0,
+            'max_inference_seconds': 0.0,
+            'last_inference_seconds': None
+        }
+    
+    def _session_options(self):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        if self.intra_op_threads > 0:
+            options.intra_op_num_threads = self.intra_op_threads
+        if self.inter_op_threads > 0:
+            options.inter_op_num_threads = self.inter_op_threads
+        return options
+    
+    def _create_session(self):
+        """Load the ONNX model into a new session with our thread settings"""
+        start = time.perf_counter()
+        try:
+            from rembg.sessions import sessions_class
+            session_class = next(cls for cls in sessions_class if cls.name() == self.model_name)
+            session = session_class(self.model_name, self._session_options())
+        except Exception as e:
+            # Older/newer rembg layouts: let rembg build the session itself
+            print(f"Falling back to rembg.new_session for {self.model_name}: {e}")
+            session = rembg.new_session(self.model_name)
+        
+        # A first inference allocates ONNX Runtime buffers; pay for it now
+        rembg.remove(Image.new('RGB', (64, 64), (255, 255, 255)), session=session)
+        
+        elapsed = time.perf_counter() - start
+        with self._stats_lock:
+            self._stats['sessions'] += 1
+            self._stats['load_seconds'].append(elapsed)
+        print(f"rembg session ready ({self.model_name}, {elapsed:.2f}s)")
+        return session
+    
+    def warm_up(self, sessions: Optional[int] = None):
+        """Create and warm sessions, and calibrate the batch size, up front so the
+        first stamps do not pay for either"""
+        target = min(self.pool_size, sessions or self.pool_size)
+        while True:
+            with self._create_lock:
+                if self._created >= target:
+                    break
+                self._created += 1
+            try:
+                self._sessions.put(self._create_session())
+            except Exception:
+                with self._create_lock:
+                    self._created -= 1
+                raise
+        self.get_batch_size()
+    
+    def warm_up_in_background(self) -> threading.Thread:
+        """Warm the pool on a daemon thread; failures are only logged"""
+        def run():
+            try:
+                self.warm_up()
+            except Exception as e:
+                print(f"Error warming up rembg sessions: {e}")
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+    
+    @contextmanager
+    def session(self):
+        """Check out a session, creating one if the pool is not full yet"""
+        session = self._checkout()
+        try:
+            yield session
+        finally:
+            self._sessions.put(session)
+    
+    def _checkout(self):
+        while True:
+            try:
+                return self._sessions.get_nowait()
+            except queue.Empty:
+                pass
+            with self._create_lock:
+                create = self._created < self.pool_size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    return self._create_session()
+                except Exception:
+                    with self._create_lock:
+                        self._created -= 1
+                    raise
+            try:
+                return self._sessions.get(timeout=1.0)
+            except queue.Empty:
+                # Another thread's session load may have failed; check again
+                continue
+    
+    def _record_inference(self, elapsed: float, images: int = 1):
+        with self._stats_lock:
+            self._stats['images'] += images
+            self._stats['inference_seconds'] += elapsed
+            self._stats['max_inference_seconds'] = max(self._stats['max_inference_seconds'], elapsed / images)
+            self._stats['last_inference_seconds'] = elapsed / images
+    
+    def remove(self, image_data: bytes) -> bytes:
+        """Background-removed PNG bytes"""
+        with self.session() as session:
+            start = time.perf_counter()
+            output_data = rembg.remove(image_data, session=session)
+            self._record_inference(time.perf_counter() - start)
+        return output_data
+    
+    def remove_image(self, img: Image.Image) -> Image.Image:
+        """Background-removed RGBA image, without a PNG round-trip"""
+        with self.session() as session:
+            start = time.perf_counter()
+            output = rembg.remove(img, session=session)
+            self._record_inference(time.perf_counter() - start)
+        return output
+    
+    def _prepare(self, img: Image.Image, side: int, mean, std) -> Tuple[np.ndarray, Tuple[int, int]]:
+        """Resize to the model input and normalise (CHW), as rembg's sessions do.
+        
+        rembg stretches to the square input rather than padding; doing the same
+        keeps batched masks identical to the single-image path."""
+        resized = np.asarray(img.convert('RGB').resize((side, side), Image.Resampling.LANCZOS), dtype=np.float32)
+        resized /= max(float(resized.max()), 1e-6)
+        normalised = (resized - np.asarray(mean, dtype=np.float32)) / np.asarray(std, dtype=np.float32)
+        return normalised.transpose(2, 0, 1), img.size
+    
+    @staticmethod
+    def _to_mask(pred: np.ndarray, size: Tuple[int, int]) -> Image.Image:
+        """Model output for one image back to an alpha mask at its original size"""
+        low, high = float(pred.min()), float(pred.max())
+        pred = (pred - low) / (high - low) if high > low else np.zeros_like(pred)
+        mask = Image.fromarray((pred.clip(0, 1) * 255).astype(np.uint8), mode='L')
+        return mask.resize(size, Image.Resampling.LANCZOS)
+    
+    def _run_batch(self, inner_session, batch: np.ndarray) -> np.ndarray:
+        """One ONNX Runtime call for the batch, or one per image if the model's batch axis is fixed"""
+        model_input = inner_session.get_inputs()[0]
+        if self._batching_supported is None and isinstance(model_input.shape[0], int):
+            self._batching_supported = model_input.shape[0] != 1
+        
+        if len(batch) > 1 and self._batching_supported is not False:
+            try:
+                output = inner_session.run(None, {model_input.name: batch})[0]
+                self._batching_supported = True
+                return output[:, 0]
+            except Exception as e:
+                print(f"Batched rembg inference not supported by {self.model_name}, running per image: {e}")
+                self._batching_supported = False
+        
+        return np.concatenate([
+            inner_session.run(None, {model_input.name: batch[i:i + 1]})[0][:, 0]
+            for i in range(len(batch))
+        ])
+    
+    def predict_masks(self, images: List[Image.Image], batch_size: Optional[int] = None,
+                      record: bool = True) -> List[Image.Image]:
+        """Alpha masks ('L', same size as each input) from batched model runs"""
+        if not images:
+            return []
+        side, mean, std = MODEL_INPUTS.get(self.model_name, _U2NET_INPUT)
+        batch_size = batch_size or self.get_batch_size()
+        prepared = [self._prepare(img, side, mean, std) for img in images]
+        
+        masks: List[Image.Image] = []
+        with self.session() as session:
+            for start in range(0, len(prepared), batch_size):
+                chunk = prepared[start:start + batch_size]
+                batch = np.stack([array for array, _ in chunk]).astype(np.float32, copy=False)
+                started = time.perf_counter()
+                preds = self._run_batch(session.inner_session, batch)
+                if record:
+                    self._record_inference(time.perf_counter() - started, len(chunk))
+                masks.extend(self._to_mask(pred, size) for pred, (_, size) in zip(preds, chunk))
+        return masks
+    
+    def calibrate(self, candidates: Tuple[int, ...] = (1, 2, 4, 8), size: Tuple[int, int] = (370, 320),
+                  rounds: int = 2) -> int:
+        """Time each candidate batch size on dummy stamps and keep the fastest per image"""
+        rng = np.random.default_rng(0)
+        images = [
+            Image.fromarray(rng.integers(0, 256, (size[1], size[0], 3), dtype=np.uint8))
+            for _ in range(max(candidates) * rounds)
+        ]
+        self.predict_masks(images[:1], batch_size=1, record=False)  # make sure a session is loaded
+        
+        timings: Dict[int, float] = {}
+        for candidate in sorted(candidates):
+            if candidate > 1 and self._batching_supported is False:
+                break
+            count = candidate * rounds
+            started = time.perf_counter()
+            self.predict_masks(images[:count], batch_size=candidate, record=False)
+            timings[candidate] = (time.perf_counter() - started) / count
+        
+        best = min(timings, key=timings.get)
+        self.calibration = timings
+        print("rembg batch calibration: " + ", ".join(
+            f"{candidate}={seconds * 1000:.0f}ms/img" for candidate, seconds in timings.items()
+        ) + f" -> {best}")
+        return best
+    
+    def get_batch_size(self) -> int:
+        """REMBG_BATCH_SIZE, or the calibrated size when it is 'auto'.
+        
+        Calibrates here only if warm_up() did not already do so."""
+        if self.batch_size is not None:
+            return self.batch_size
+        with self._calibrate_lock:
+            if self.batch_size is None:
+                calibrated = _calibrated_batch_sizes.get(self.model_name)
+                if calibrated is None:
+                    try:
+                        calibrated = _calibrated_batch_sizes[self.model_name] = self.calibrate()
+                    except Exception as e:
+                        print(f"Error calibrating rembg batch size: {e}")
+                        calibrated = 1
+                self.batch_size = calibrated
+        return self.batch_size
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+            load_seconds: List[float] = list(stats.pop('load_seconds'))
+        stats.update(
+            model=self.model_name,
+            pool_size=self.pool_size,
+            batch_size=self.batch_size,
+            batching_supported=self._batching_supported,
+            load_seconds_total=sum(load_seconds),
+            load_seconds_max=max(load_seconds) if load_seconds else None,
+            avg_inference_seconds=stats['inference_seconds'] / stats['images'] if stats['images'] else None
+        )
+        return stats
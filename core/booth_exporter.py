@@ -6,6 +6,8 @@ from fpdf import FPDF
 from PIL import Image
 from dotenv import load_dotenv
 
+from .font_registry import font_registry
+
 load_dotenv()
 
 class BoothExporter:
@@ -33,10 +35,11 @@ class BoothExporter:
         pdf.add_page()
         
         # Set font (fallback to default if Japanese font not available)
-        try:
-            pdf.add_font('NotoSansJP', '', './fonts/NotoSansJP-Regular.ttf', uni=True)
+        # fpdf2 subsets fonts per document, so only the path lookup is shared
+        if font_registry.available():
+            pdf.add_font('NotoSansJP', '', font_registry.primary_path, uni=True)
             pdf.set_font('NotoSansJP', size=12)
-        except:
+        else:
             pdf.set_font('Arial', size=12)
         
         # Title page
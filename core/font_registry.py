@@ -0,0 +1,170 @@
+import bisect
+import os
+import struct
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+from PIL import ImageFont
+from dotenv import load_dotenv
+
+load_dotenv()
+
+def read_cmap_ranges(path: str) -> List[Tuple[int, int]]:
+    """Sorted, merged code point ranges a TrueType/OpenType font maps (cmap format 12 or 4)"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    
+    offset = 0
+    if data[:4] == b'ttcf':
+        # Font collection: use the first face, as ImageFont.truetype does by default
+        offset = struct.unpack_from('>I', data, 12)[0]
+    num_tables = struct.unpack_from('>H', data, offset + 4)[0]
+    cmap = None
+    for i in range(num_tables):
+        tag, _, table_offset, _ = struct.unpack_from('>4sIII', data, offset + 12 + 16 * i)
+        if tag == b'cmap':
+            cmap = table_offset
+            break
+    if cmap is None:
+        raise ValueError(f"No cmap table in {path}")
+    
+    subtables = {}
+    for i in range(struct.unpack_from('>H', data, cmap + 2)[0]):
+        platform, encoding, sub_offset = struct.unpack_from('>HHI', data, cmap + 4 + 8 * i)
+        if platform == 0 or (platform == 3 and encoding in (1, 10)):
+            fmt = struct.unpack_from('>H', data, cmap + sub_offset)[0]
+            subtables.setdefault(fmt, cmap + sub_offset)
+    
+    ranges: List[Tuple[int, int]] = []
+    if 12 in subtables:
+        # Segmented coverage: full Unicode including emoji planes
+        table = subtables[12]
+        for i in range(struct.unpack_from('>I', data, table + 12)[0]):
+            start, end, _ = struct.unpack_from('>III', data, table + 16 + 12 * i)
+            ranges.append((start, end))
+    elif 4 in subtables:
+        # Segment mapping to delta values: BMP only
+        table = subtables[4]
+        seg_count = struct.unpack_from('>H', data, table + 6)[0] // 2
+        ends = struct.unpack_from(f'>{seg_count}H', data, table + 14)
+        starts = struct.unpack_from(f'>{seg_count}H', data, table + 16 + 2 * seg_count)
+        ranges.extend((start, end) for start, end in zip(starts, ends) if start != 0xFFFF)
+    else:
+        raise ValueError(f"No Unicode cmap subtable in {path}")
+    
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class FontRegistry:
+    """Process-wide cache of loaded fonts with a glyph coverage index.
+    
+    Each (face, size) is loaded once and shared by every ImageProcessor,
+    grid and layout in the process. The primary face is FONT_PATH;
+    FONT_FALLBACK_PATHS lists further faces (e.g. an emoji or symbol font).
+    Their cmap tables are read once into range lists, so each character is
+    routed to the first face that has a glyph for it without trial
+    rendering."""
+    
+    def __init__(self, primary_path: Optional[str] = None, fallback_paths: Optional[List[str]] = None):
+        self.primary_path = primary_path or os.getenv('FONT_PATH', './fonts/NotoSansJP-Regular.ttf')
+        if fallback_paths is None:
+            fallback_paths = [path.strip() for path in os.getenv('FONT_FALLBACK_PATHS', '').split(',') if path.strip()]
+        self.faces = [self.primary_path] + [path for path in fallback_paths if path != self.primary_path]
+        
+        self._lock = threading.Lock()
+        self._fonts: Dict[Tuple[str, int], Any] = {}
+        self._coverage: Optional[Dict[str, Tuple[List[int], List[int]]]] = None
+        self._face_for_char: Dict[str, str] = {}
+        self._warned: set = set()
+        self._stats = {'loads': 0, 'hits': 0}
+    
+    def _warn_once(self, path: str, message: str):
+        if path not in self._warned:
+            self._warned.add(path)
+            print(message)
+    
+    def get(self, size: int, path: Optional[str] = None):
+        """Font for (face, size), loaded on first use; Pillow's default font if the face is missing"""
+        path = path or self.primary_path
+        key = (path, size)
+        font = self._fonts.get(key)
+        if font is not None:
+            self._stats['hits'] += 1
+            return font
+        
+        with self._lock:
+            font = self._fonts.get(key)
+            if font is None:
+                try:
+                    font = ImageFont.truetype(path, size)
+                except OSError as e:
+                    self._warn_once(path, f"Warning: Could not load font {path}: {e}; using default font instead")
+                    try:
+                        font = ImageFont.load_default(size)
+                    except TypeError:
+                        # Pillow < 10.1 has a single fixed-size bitmap default
+                        font = ImageFont.load_default()
+                self._fonts[key] = font
+                self._stats['loads'] += 1
+        return font
+    
+    def available(self, path: Optional[str] = None) -> bool:
+        """Whether the face file exists and has a readable cmap"""
+        return (path or self.primary_path) in self._get_coverage()
+    
+    def _get_coverage(self) -> Dict[str, Tuple[List[int], List[int]]]:
+        """Per-face (starts, ends) range index, read once for all faces"""
+        if self._coverage is None:
+            with self._lock:
+                if self._coverage is None:
+                    coverage = {}
+                    for path in self.faces:
+                        try:
+                            ranges = read_cmap_ranges(path)
+                            coverage[path] = ([start for start, _ in ranges], [end for _, end in ranges])
+                        except (OSError, ValueError, struct.error) as e:
+                            self._warn_once(f"cmap:{path}", f"Warning: No glyph coverage for font {path}: {e}")
+                    self._coverage = coverage
+        return self._coverage
+    
+    def covers(self, path: str, char: str) -> bool:
+        ranges = self._get_coverage().get(path)
+        if ranges is None:
+            return False
+        starts, ends = ranges
+        i = bisect.bisect_right(starts, ord(char)) - 1
+        return i >= 0 and ord(char) <= ends[i]
+    
+    def face_for(self, char: str) -> str:
+        """First face with a glyph for char (the primary face if none has one)"""
+        face = self._face_for_char.get(char)
+        if face is None:
+            face = self.primary_path
+            if not char.isspace() and not self.covers(self.primary_path, char):
+                face = next((path for path in self.faces[1:] if self.covers(path, char)), self.primary_path)
+            self._face_for_char[char] = face
+        return face
+    
+    def split_runs(self, text: str) -> List[Tuple[str, str]]:
+        """text as (run, face) pieces, each drawable with a single font"""
+        runs: List[Tuple[str, str]] = []
+        for char in text:
+            face = self.face_for(char)
+            if runs and runs[-1][1] == face:
+                runs[-1] = (runs[-1][0] + char, face)
+            else:
+                runs.append((char, face))
+        return runs
+    
+    def getlength(self, text: str, size: int) -> float:
+        """Advance width of text, with each run measured in its own face"""
+        return sum(self.get(size, face).getlength(run) for run, face in self.split_runs(text))
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return dict(self._stats, faces=list(self.faces), loaded=len(self._fonts))
+
+font_registry = FontRegistry()
@@ -0,0 +1,201 @@
+import heapq
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, Any, List, Optional, Set
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Priority classes, most urgent first
+PRIORITY_INTERACTIVE = 0  # A user is waiting on a single stamp (regenerate)
+PRIORITY_SAMPLE = 1       # Sample stamps for direction review
+PRIORITY_FULL = 2         # Full 40-stamp runs
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: 'interactive',
+    PRIORITY_SAMPLE: 'sample',
+    PRIORITY_FULL: 'full'
+}
+
+class _QueuedJob:
+    __slots__ = ('rank', 'sequence', 'priority', 'model_key', 'tag', 'submitted_at', 'future', 'fn', 'args', 'kwargs')
+    
+    def __init__(self, rank, sequence, priority, model_key, tag, submitted_at, future, fn, args, kwargs):
+        self.rank = rank
+        self.sequence = sequence
+        self.priority = priority
+        self.model_key = model_key
+        self.tag = tag
+        self.submitted_at = submitted_at
+        self.future = future
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+    
+    def __lt__(self, other: "_QueuedJob") -> bool:
+        return (self.rank, self.sequence) < (other.rank, other.sequence)
+
+class GenerationQueue:
+    """Central priority queue in front of the SD backends.
+    
+    A fixed number of worker threads (normally one per backend) take the
+    most urgent job first, so a stamp regeneration never waits behind a full
+    run's backlog. Waiting jobs age: every SD_QUEUE_AGING seconds in the
+    queue is worth one priority class (interactive > sample > full), so a
+    full run still progresses while samples and regenerations keep arriving.
+    Because every job ages at the same rate, the effective rank is simply
+    priority * aging + submit time, which keeps the queue a plain heap.
+    
+    Jobs may carry a model key (checkpoint + LoRA set). When the head job's
+    model is not loaded on any idle backend (loaded_models, e.g.
+    SDBackendPool.idle_loaded_models), a worker takes a job for a model that
+    is loaded instead, provided it ranks within SD_QUEUE_AFFINITY seconds of
+    the head, so the pool can route it to that backend without a swap. Real
+    swaps are counted by the pool per backend.
+    
+    Jobs may also carry a tag (e.g. a set id) so a caller can withdraw all
+    of its still-queued work at once with cancel()."""
+    
+    def __init__(self, workers: int = 1, aging_seconds: Optional[float] = None,
+                 affinity_seconds: Optional[float] = None,
+                 loaded_models: Optional[Callable[[], Set[str]]] = None):
+        if aging_seconds is None:
+            aging_seconds = float(os.getenv('SD_QUEUE_AGING', 60))
+        if affinity_seconds is None:
+            affinity_seconds = float(os.getenv('SD_QUEUE_AFFINITY', 20))
+        self.workers = max(1, workers)
+        self.aging_seconds = aging_seconds
+        self.affinity_seconds = affinity_seconds
+        self.loaded_models = loaded_models
+        
+        self._cond = threading.Condition()
+        self._heap: List[_QueuedJob] = []
+        self._sequence = itertools.count()
+        self._threads: List[threading.Thread] = []
+        self._running = 0
+        self._stopped = False
+        self._stats = {
+            name: {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+            for name in PRIORITY_NAMES.values()
+        }
+        self.affinity_picks = 0
+    
+    def _ensure_workers(self):
+        """Start worker threads on first use (caller holds the lock)"""
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._worker_loop, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+    
+    def submit(self, priority: int, fn: Callable, *args, model_key: Optional[str] = None,
+               tag: Optional[str] = None, **kwargs) -> Future:
+        """Queue fn(*args, **kwargs) at the given priority and return its Future"""
+        future: Future = Future()
+        submitted_at = time.time()
+        rank = priority * self.aging_seconds + submitted_at
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError("Generation queue is shut down")
+            self._ensure_workers()
+            heapq.heappush(self._heap, _QueuedJob(
+                rank, next(self._sequence), priority, model_key, tag, submitted_at, future, fn, args, kwargs
+            ))
+            self._stats[PRIORITY_NAMES[priority]]['submitted'] += 1
+            self._cond.notify()
+        return future
+    
+    def run(self, priority: int, fn: Callable, *args, model_key: Optional[str] = None,
+            tag: Optional[str] = None, **kwargs):
+        """Queue fn and block until it has run, returning its result"""
+        return self.submit(priority, fn, *args, model_key=model_key, tag=tag, **kwargs).result()
+    
+    def cancel(self, tag: str) -> int:
+        """Drop every queued job with this tag, cancelling its Future; running jobs are left alone"""
+        with self._cond:
+            cancelled = [job for job in self._heap if job.tag == tag]
+            if not cancelled:
+                return 0
+            self._heap = [job for job in self._heap if job.tag != tag]
+            heapq.heapify(self._heap)
+            for job in cancelled:
+                job.future.cancel()
+                self._stats[PRIORITY_NAMES[job.priority]]['cancelled'] += 1
+        return len(cancelled)
+    
+    def _take_next(self) -> _QueuedJob:
+        """Pop the head job, or a nearly-as-urgent one for an already loaded model (caller holds the lock)"""
+        head = self._heap[0]
+        loaded = self.loaded_models() if self.loaded_models and head.model_key is not None else set()
+        if not loaded or head.model_key in loaded:
+            return heapq.heappop(self._heap)
+        
+        candidates = [
+            job for job in self._heap
+            if job.model_key in loaded and job.rank <= head.rank + self.affinity_seconds
+        ]
+        if not candidates:
+            return heapq.heappop(self._heap)
+        
+        job = min(candidates)
+        self._heap.remove(job)
+        heapq.heapify(self._heap)
+        self.affinity_picks += 1
+        return job
+    
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while not self._heap and not self._stopped:
+                    self._cond.wait()
+                if not self._heap:
+                    return
+                job = self._take_next()
+                self._running += 1
+                stats = self._stats[PRIORITY_NAMES[job.priority]]
+                waited = time.time() - job.submitted_at
+                stats['wait_seconds'] += waited
+                stats['max_wait_seconds'] = max(stats['max_wait_seconds'], waited)
+            
+            future = job.future
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(job.fn(*job.args, **job.kwargs))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    if not future.cancelled():
+                        stats['completed' if future.exception() is None else 'failed'] += 1
+    
+    def shutdown(self):
+        """Stop workers once the queued jobs have run"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Queue depth and per-class wait times"""
+        with self._cond:
+            by_class = {}
+            for name, stats in self._stats.items():
+                started = stats['submitted'] - stats['cancelled'] - sum(
+                    1 for job in self._heap if PRIORITY_NAMES[job.priority] == name
+                )
+                by_class[name] = dict(
+                    stats,
+                    queued=stats['submitted'] - stats['cancelled'] - started,
+                    avg_wait_seconds=stats['wait_seconds'] / started if started else 0.0
+                )
+            return {
+                'workers': self.workers,
+                'queued': len(self._heap),
+                'running': self._running,
+                'affinity_picks': self.affinity_picks,
+                'classes': by_class
+            }
@@ -0,0 +1,216 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+from PIL import Image, ImageDraw
+from dotenv import load_dotenv
+
+from .font_registry import FontRegistry
+
+load_dotenv()
+
+class GridBuilder:
+    """Review grids patched in place instead of recomposed from scratch.
+    
+    Each grid is saved with a small manifest recording which image (by
+    content hash) sits in each slot. A rebuild with the same layout only
+    decodes, scales and pastes the slots whose image changed, and
+    update_stamp() patches a single regenerated stamp into every grid that
+    shows it. Scaled tiles are kept in an LRU keyed by content hash
+    (GRID_TILE_CACHE tiles), so a stamp shown in both the sample and the
+    full grid is decoded once. File hashes are cached by (size, mtime) so
+    unchanged stamps cost one stat()."""
+    
+    background = (240, 240, 240, 255)
+    
+    def __init__(self, output_dir: Path, font_registry: FontRegistry,
+                 tile_size: Tuple[int, int] = (370, 320), cache_size: Optional[int] = None):
+        self.output_dir = Path(output_dir)
+        self.font_registry = font_registry
+        self.tile_size = tile_size
+        self.padding = 10
+        self.text_height = 30
+        self.cache_size = cache_size or int(os.getenv('GRID_TILE_CACHE', 96))
+        
+        self._lock = threading.Lock()
+        self._tiles: "OrderedDict[str, Image.Image]" = OrderedDict()
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}  # path -> (size, mtime_ns, sha1)
+        # Last grids built, so patching does not decode grid.png again: key -> (mtime_ns, grid, manifest)
+        self._grids: "OrderedDict[Tuple[str, bool], Tuple[int, Image.Image, Dict[str, Any]]]" = OrderedDict()
+        self._stats = {'builds': 0, 'full_builds': 0, 'tiles_patched': 0, 'tiles_reused': 0, 'tile_cache_hits': 0}
+    
+    def _paths(self, set_id: str, is_sample: bool) -> Tuple[Path, Path]:
+        name = f"{'sample_' if is_sample else ''}grid"
+        set_dir = self.output_dir / set_id
+        return set_dir / f"{name}.png", set_dir / f"{name}.json"
+    
+    def _content_key(self, image_path: Optional[str]) -> Optional[str]:
+        """sha1 of the file, re-hashed only when its size or mtime changes"""
+        if not image_path:
+            return None
+        try:
+            stat = os.stat(image_path)
+        except OSError:
+            return None
+        cached = self._hashes.get(image_path)
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        with open(image_path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        self._hashes[image_path] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+    
+    def _tile(self, key: str, image_path: str) -> Image.Image:
+        """Stamp scaled to the tile size, from the cache when possible"""
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            self._stats['tile_cache_hits'] += 1
+            return tile
+        with Image.open(image_path) as img:
+            tile = img.convert('RGBA')
+            if tile.size != self.tile_size:
+                tile = tile.resize(self.tile_size, Image.Resampling.LANCZOS)
+        self._tiles[key] = tile
+        if len(self._tiles) > self.cache_size:
+            self._tiles.popitem(last=False)
+        return tile
+    
+    def _slot_origin(self, index: int, cols: int) -> Tuple[int, int]:
+        row, col = divmod(index, cols)
+        stamp_width, stamp_height = self.tile_size
+        return (
+            self.padding + col * (stamp_width + self.padding),
+            self.padding + row * (stamp_height + self.text_height + self.padding)
+        )
+    
+    def _draw_slot(self, grid: Image.Image, index: int, cols: int, number: int,
+                   key: Optional[str], image_path: Optional[str]):
+        """Clear one slot and draw its stamp and number label"""
+        stamp_width, stamp_height = self.tile_size
+        x, y = self._slot_origin(index, cols)
+        draw = ImageDraw.Draw(grid)
+        draw.rectangle([x, y, x + stamp_width, y + stamp_height + 5 + self.text_height], fill=self.background)
+        
+        if key is not None:
+            try:
+                tile = self._tile(key, image_path)
+                grid.paste(tile, (x, y), tile)
+            except Exception as e:
+                print(f"Error loading stamp {number}: {e}")
+                # Draw placeholder
+                draw.rectangle([x, y, x + stamp_width, y + stamp_height], fill=(200, 200, 200, 255))
+        
+        # Draw number
+        font = self.font_registry.get(20)
+        text_y = y + stamp_height + 5
+        number_text = f"{number:02d}"
+        text_bbox = draw.textbbox((x, text_y), number_text, font=font)
+        text_x = x + (stamp_width - (text_bbox[2] - text_bbox[0])) // 2
+        draw.rectangle([x, text_y, x + stamp_width, text_y + self.text_height], fill=(50, 50, 50, 200))
+        draw.text((text_x, text_y), number_text, fill=(255, 255, 255, 255), font=font)
+    
+    def _load(self, set_id: str, is_sample: bool) -> Tuple[Optional[Image.Image], Optional[Dict[str, Any]]]:
+        grid_path, manifest_path = self._paths(set_id, is_sample)
+        if not grid_path.exists() or not manifest_path.exists():
+            return None, None
+        cached = self._grids.get((set_id, is_sample))
+        if cached and cached[0] == grid_path.stat().st_mtime_ns:
+            return cached[1], json.loads(json.dumps(cached[2]))
+        try:
+            manifest = json.loads(manifest_path.read_text(encoding='utf-8'))
+            with Image.open(grid_path) as img:
+                grid = img.convert('RGBA')
+            if grid.size != tuple(manifest['size']):
+                return None, None
+            return grid, manifest
+        except Exception as e:
+            print(f"Error loading grid manifest for {set_id}: {e}")
+            return None, None
+    
+    def _save(self, set_id: str, is_sample: bool, grid: Image.Image, manifest: Dict[str, Any]) -> str:
+        grid_path, manifest_path = self._paths(set_id, is_sample)
+        grid_path.parent.mkdir(parents=True, exist_ok=True)
+        # A review image: favour encode speed over size
+        grid.save(grid_path, "PNG", compress_level=1)
+        manifest_path.write_text(json.dumps(manifest), encoding='utf-8')
+        self._grids[(set_id, is_sample)] = (grid_path.stat().st_mtime_ns, grid, manifest)
+        self._grids.move_to_end((set_id, is_sample))
+        if len(self._grids) > 4:
+            self._grids.popitem(last=False)
+        return str(grid_path)
+    
+    def build(self, set_id: str, stamps: List[Dict], is_sample: bool = False) -> str:
+        """Create or patch the grid for stamps, redrawing only slots whose image changed"""
+        if not stamps:
+            return ""
+        
+        # Grid configuration
+        cols = 5 if is_sample else 8
+        rows = (len(stamps) + cols - 1) // cols
+        stamp_width, stamp_height = self.tile_size
+        size = [
+            cols * (stamp_width + self.padding) + self.padding,
+            rows * (stamp_height + self.text_height + self.padding) + self.padding
+        ]
+        
+        with self._lock:
+            self._stats['builds'] += 1
+            grid, manifest = self._load(set_id, is_sample)
+            if grid is None or manifest.get('cols') != cols or manifest.get('size') != size:
+                self._stats['full_builds'] += 1
+                grid = Image.new('RGBA', tuple(size), self.background)
+                manifest = {'cols': cols, 'size': size, 'slots': []}
+            
+            old_slots = manifest['slots']
+            changed = not old_slots or len(old_slots) != len(stamps)
+            slots = []
+            for i, stamp in enumerate(stamps):
+                number = stamp.get('number', i + 1)
+                image_path = stamp.get('image_path')
+                key = self._content_key(image_path)
+                slot = {'number': number, 'key': key, 'image_path': image_path}
+                if i < len(old_slots) and old_slots[i]['number'] == number and old_slots[i]['key'] == key:
+                    self._stats['tiles_reused'] += 1
+                else:
+                    self._draw_slot(grid, i, cols, number, key, image_path)
+                    self._stats['tiles_patched'] += 1
+                    changed = True
+                slots.append(slot)
+            
+            # Slots left over from a longer previous list on the last row
+            for i in range(len(stamps), len(old_slots)):
+                x, y = self._slot_origin(i, cols)
+                ImageDraw.Draw(grid).rectangle(
+                    [x, y, x + stamp_width, y + stamp_height + 5 + self.text_height], fill=self.background
+                )
+            
+            manifest['slots'] = slots
+            if not changed:
+                return str(self._paths(set_id, is_sample)[0])
+            return self._save(set_id, is_sample, grid, manifest)
+    
+    def update_stamp(self, set_id: str, stamp_number: int, image_path: str) -> List[str]:
+        """Patch one regenerated stamp into every existing grid of the set that shows it"""
+        updated = []
+        with self._lock:
+            key = self._content_key(image_path)
+            for is_sample in (True, False):
+                grid, manifest = self._load(set_id, is_sample)
+                if grid is None:
+                    continue
+                index = next((i for i, slot in enumerate(manifest['slots']) if slot['number'] == stamp_number), None)
+                if index is None:
+                    continue
+                self._draw_slot(grid, index, manifest['cols'], stamp_number, key, image_path)
+                self._stats['tiles_patched'] += 1
+                manifest['slots'][index].update(key=key, image_path=image_path)
+                updated.append(self._save(set_id, is_sample, grid, manifest))
+        return updated
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, cached_tiles=len(self._tiles))
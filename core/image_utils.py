@@ -1,11 +1,20 @@
 import os
+import threading
+import time
 from pathlib import Path
-from PIL import Image, ImageDraw, ImageFont
-import rembg
-from typing import List, Tuple, Optional
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+from typing import List, Tuple, Optional, Dict, Union
 import io
 from dotenv import load_dotenv
 
+from .background_remover import BackgroundRemover
+from .font_registry import font_registry
+from .grid_builder import GridBuilder
+from .lora_dataset import LoRADatasetExporter
+from .text_effects import TextStyle, draw_text, draw_text_runs
+from .text_layout import TextLayoutEngine
+
 load_dotenv()
 
 class ImageProcessor:
@@ -15,68 +24,276 @@ class ImageProcessor:
         self.output_dir.mkdir(parents=True, exist_ok=True)
         self.lora_export_dir.mkdir(parents=True, exist_ok=True)
         
-        # Load font
-        self.font_path = os.getenv('FONT_PATH', './fonts/NotoSansJP-Regular.ttf')
+        # Explicit, pooled rembg sessions (REMBG_MODEL, REMBG_SESSIONS)
+        self.background_remover = BackgroundRemover()
+        
+        # Fast flood-fill matting for plain backdrops; rembg only when it is unsure
+        self.background_mode = os.getenv('BG_REMOVAL_MODE', 'auto').lower()  # auto / fast / rembg
+        self.fast_bg_tolerance = float(os.getenv('BG_FAST_TOLERANCE', 24))
+        self.fast_bg_feather = float(os.getenv('BG_FAST_FEATHER', 1.0))
+        self.fast_bg_min_confidence = float(os.getenv('BG_FAST_MIN_CONFIDENCE', 0.8))
+        self._background_stats_lock = threading.Lock()
+        self.background_stats = {'fast': 0, 'rembg': 0, 'fast_seconds': 0.0}
+        
+        # Load font (FONT_PATH and FONT_FALLBACK_PATHS, shared process-wide)
+        self.font_registry = font_registry
+        self.font_path = self.font_registry.primary_path
         self._load_fonts()
+        
+        # Review grids patched tile by tile (GRID_TILE_CACHE)
+        self.grid_builder = GridBuilder(self.output_dir, self.font_registry)
+        
+        # Incremental LoRA dataset sync (LORA_EXPORT_MODE, LORA_EXPORT_WORKERS)
+        self.lora_dataset = LoRADatasetExporter(self.lora_export_dir)
+        
+        # Caption fill, outline, shadow and gradient (TEXT_*)
+        self.text_style = TextStyle.from_env()
+        
+        # Measured auto-fit layout with kinsoku wrapping (TEXT_MIN_SIZE, TEXT_MAX_SIZE, TEXT_MAX_LINES)
+        try:
+            self.text_layout: Optional[TextLayoutEngine] = TextLayoutEngine(self.font_registry)
+        except Exception as e:
+            print(f"Warning: Text layout disabled, using fixed font sizes: {e}")
+            self.text_layout = None
     
     def _load_fonts(self):
         """Load fonts for text composition"""
         try:
-            # Try to load the specified font
-            self.font_normal = ImageFont.truetype(self.font_path, 24)
-            self.font_small = ImageFont.truetype(self.font_path, 18)
-            self.font_large = ImageFont.truetype(self.font_path, 32)
+            # The registry falls back to Pillow's default font if FONT_PATH is missing
+            self.font_normal = self.font_registry.get(24)
+            self.font_small = self.font_registry.get(18)
+            self.font_large = self.font_registry.get(32)
         except Exception as e:
-            print(f"Warning: Could not load font {self.font_path}: {e}")
-            print("Using default font instead")
-            # Fallback to default font
-            try:
-                self.font_normal = ImageFont.load_default()
-                self.font_small = ImageFont.load_default()
-                self.font_large = ImageFont.load_default()
-            except:
-                self.font_normal = self.font_small = self.font_large = None
+            print(f"Warning: Could not load any font: {e}")
+            self.font_normal = self.font_small = self.font_large = None
     
-    def remove_background(self, image_data: bytes) -> bytes:
-        """Remove background from image using rembg"""
+    @staticmethod
+    def _flood_from_border(candidate: np.ndarray) -> np.ndarray:
+        """Pixels of candidate 4-connected to the image border"""
+        reached = np.zeros_like(candidate)
+        
+        # Coarse pass on 4x4 blocks that are entirely candidate; a subset of the
+        # true result that lets the full-resolution pass converge in a few steps
+        height, width = candidate.shape
+        blocks = candidate[:height // 4 * 4, :width // 4 * 4].reshape(height // 4, 4, width // 4, 4).all(axis=(1, 3))
+        if blocks.size:
+            coarse = np.zeros_like(blocks)
+            coarse[[0, -1], :] = blocks[[0, -1], :]
+            coarse[:, [0, -1]] = blocks[:, [0, -1]]
+            while True:
+                grown = coarse.copy()
+                grown[1:] |= coarse[:-1]
+                grown[:-1] |= coarse[1:]
+                grown[:, 1:] |= coarse[:, :-1]
+                grown[:, :-1] |= coarse[:, 1:]
+                grown &= blocks
+                if np.array_equal(grown, coarse):
+                    break
+                coarse = grown
+            reached[:height // 4 * 4, :width // 4 * 4] = coarse.repeat(4, axis=0).repeat(4, axis=1)
+        
+        reached[[0, -1], :] |= candidate[[0, -1], :]
+        reached[:, [0, -1]] |= candidate[:, [0, -1]]
+        while True:
+            grown = reached.copy()
+            grown[1:] |= reached[:-1]
+            grown[:-1] |= reached[1:]
+            grown[:, 1:] |= reached[:, :-1]
+            grown[:, :-1] |= reached[:, 1:]
+            grown &= candidate
+            if np.array_equal(grown, reached):
+                return reached
+            reached = grown
+    
+    def _fast_background_mask(self, img: Image.Image) -> Tuple[Image.Image, float]:
+        """Alpha mask for a near-uniform backdrop and a 0-1 confidence that it is right.
+        
+        The backdrop colour is the median of the border pixels. Pixels within
+        BG_FAST_TOLERANCE of it (and softly up to 2.5x that) that connect to
+        the border become transparent, and the mask edge is feathered."""
+        rgb = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'), dtype=np.float32)
+        border = np.concatenate([rgb[0], rgb[-1], rgb[1:-1, 0], rgb[1:-1, -1]])
+        backdrop = np.median(border, axis=0)
+        # In place: rgb is our own float copy, so no extra full-size temporaries
+        rgb -= backdrop
+        np.square(rgb, out=rgb)
+        distance = np.sqrt(rgb.sum(axis=2))
+        
+        low = self.fast_bg_tolerance
+        high = low * 2.5
+        background = self._flood_from_border(distance < high)
+        alpha = np.ones(distance.shape, dtype=np.float32)
+        alpha[background] = np.clip((distance[background] - low) / (high - low), 0.0, 1.0)
+        mask = Image.fromarray((alpha * 255).astype(np.uint8), mode='L')
+        if self.fast_bg_feather > 0:
+            mask = mask.filter(ImageFilter.GaussianBlur(self.fast_bg_feather))
+        
+        # Confidence: a clean backdrop along the border, a thin soft edge rather
+        # than a gradient or shadow, and a plausible amount of foreground
+        border_distance = np.concatenate([distance[0], distance[-1], distance[1:-1, 0], distance[1:-1, -1]])
+        uniformity = float((border_distance < low).mean())
+        foreground = float((~background).mean())
+        ambiguous = float((background & (distance >= low)).sum()) / max(1.0, float((~background).sum()))
+        edge_score = float(np.clip(1.0 - max(0.0, ambiguous - 0.05) / 0.2, 0.0, 1.0))
+        area_score = 1.0 if 0.03 <= foreground <= 0.95 else 0.0
+        return mask, uniformity * edge_score * area_score
+    
+    def _count_background(self, method: str, seconds: float = 0.0):
+        with self._background_stats_lock:
+            self.background_stats[method] += 1
+            if method == 'fast':
+                self.background_stats['fast_seconds'] += seconds
+    
+    def _try_fast_background(self, img: Image.Image) -> Optional[Image.Image]:
+        """Mask from the fast path, or None if rembg should decide"""
+        if self.background_mode == 'rembg':
+            return None
+        start = time.perf_counter()
         try:
+            mask, confidence = self._fast_background_mask(img)
+        except Exception as e:
+            print(f"Error in fast background removal: {e}")
+            return None
+        if self.background_mode != 'fast' and confidence < self.fast_bg_min_confidence:
+            return None
+        self._count_background('fast', time.perf_counter() - start)
+        return mask
+    
+    @staticmethod
+    def _decode(image_data: Union[bytes, Image.Image]) -> Image.Image:
+        """Decode SD output once; PIL images are passed through untouched"""
+        if isinstance(image_data, Image.Image):
+            return image_data
+        img = Image.open(io.BytesIO(image_data))
+        img.load()
+        return img
+    
+    @staticmethod
+    def _encode(img: Image.Image) -> bytes:
+        buffer = io.BytesIO()
+        img.save(buffer, "PNG")
+        return buffer.getvalue()
+    
+    @staticmethod
+    def _cutout(img: Image.Image, mask: Image.Image) -> Image.Image:
+        """Apply mask as the alpha channel (in place when img is already RGBA)"""
+        if img.mode != 'RGBA':
+            img = img.convert('RGBA')
+        img.putalpha(mask)
+        return img
+    
+    def _remove_background_image(self, img: Image.Image) -> Image.Image:
+        """RGBA cutout of a decoded image, using rembg only when the fast path is unsure"""
+        try:
+            mask = self._try_fast_background(img)
+            if mask is not None:
+                return self._cutout(img, mask)
+            
             # Remove background
-            output_data = rembg.remove(image_data)
-            return output_data
+            output = self.background_remover.remove_image(img)
+            self._count_background('rembg')
+            return output
         except Exception as e:
             print(f"Error removing background: {e}")
-            return image_data
+            return img
     
-    def save_stamp_image(self, set_id: str, stamp_number: int, image_data: bytes, 
-                        phrase: str = "", is_sample: bool = False) -> str:
-        """Save stamp image with transparent background and text composition"""
-        # Remove background
-        transparent_data = self.remove_background(image_data)
+    def _remove_background_images(self, images: List[Image.Image]) -> List[Image.Image]:
+        """Fast path per image, one batched rembg run for the rest"""
+        try:
+            masks = [self._try_fast_background(img) for img in images]
+            unsure = [i for i, mask in enumerate(masks) if mask is None]
+            if unsure:
+                for i, mask in zip(unsure, self.predict_alpha_masks([images[i] for i in unsure])):
+                    masks[i] = mask
+                    self._count_background('rembg')
+        except Exception as e:
+            print(f"Error in batched background removal: {e}")
+            return [self._remove_background_image(img) for img in images]
         
+        return [self._cutout(img, mask) for img, mask in zip(images, masks)]
+    
+    def remove_background(self, image_data: bytes) -> bytes:
+        """Remove background from PNG bytes (the save path works on decoded images)"""
+        return self._encode(self._remove_background_image(self._decode(image_data)))
+    
+    def predict_alpha_masks(self, images: List[Union[bytes, Image.Image]],
+                            batch_size: Optional[int] = None) -> List[Image.Image]:
+        """Per-image alpha masks from one batched matting run (REMBG_BATCH_SIZE)"""
+        return self.background_remover.predict_masks([self._decode(img) for img in images], batch_size)
+    
+    def remove_backgrounds(self, images: List[bytes]) -> List[bytes]:
+        """Batched remove_background"""
+        return [self._encode(img) for img in self._remove_background_images([self._decode(data) for data in images])]
+    
+    def save_stamp_images(self, set_id: str, stamps: List[Tuple[int, Union[bytes, Image.Image], str]],
+                          is_sample: bool = False, draft: bool = False) -> List[str]:
+        """Save several stamps, removing their backgrounds in one batch"""
+        transparent = self._remove_background_images([self._decode(image_data) for _, image_data, _ in stamps])
+        return [
+            self._save_transparent(set_id, stamp_number, img, phrase, draft)
+            for (stamp_number, _, phrase), img in zip(stamps, transparent)
+        ]
+    
+    def save_stamp_image(self, set_id: str, stamp_number: int, image_data: Union[bytes, Image.Image],
+                        phrase: str = "", is_sample: bool = False, draft: bool = False) -> str:
+        """Save stamp image with transparent background and text composition.
+        
+        Drafts go to drafts/preview_NN.png, so stamp_NN.png only ever holds a
+        full-quality stamp."""
+        # Decode once; every stage below works on the same in-memory image
+        img = self._remove_background_image(self._decode(image_data))
+        return self._save_transparent(set_id, stamp_number, img, phrase, draft)
+    
+    def _save_transparent(self, set_id: str, stamp_number: int, img: Image.Image, phrase: str,
+                          draft: bool = False) -> str:
+        """Compose the caption onto a background-removed image and encode it, once"""
         # Create filename
-        filename = f"stamp_{stamp_number:02d}.png"
-        set_dir = self.output_dir / set_id
+        if draft:
+            filename = f"preview_{stamp_number:02d}.png"
+            set_dir = self.output_dir / set_id / "drafts"
+        else:
+            filename = f"stamp_{stamp_number:02d}.png"
+            set_dir = self.output_dir / set_id
         set_dir.mkdir(parents=True, exist_ok=True)
         
-        # Save image with text composition
+        # Add text if phrase is provided (the cutout is ours, so draw on it directly)
         image_path = set_dir / filename
-        with Image.open(io.BytesIO(transparent_data)) as img:
-            # Add text if phrase is provided
-            if phrase and self.font_normal:
-                img = self._add_text_to_image(img, phrase)
-            
-            img.save(image_path, "PNG")
+        if phrase and self.font_normal:
+            img = self._add_text_to_image(img, phrase, in_place=True)
         
+        # Write then rename: a LoRA dataset hardlink to the previous stamp keeps its content
+        temp = image_path.with_name(f".{filename}.{os.getpid()}.{threading.get_ident()}")
+        img.save(temp, "PNG")
+        os.replace(temp, image_path)
         return str(image_path)
     
-    def _add_text_to_image(self, img: Image.Image, text: str) -> Image.Image:
-        """Add text to image with white color and black outline"""
-        # Convert to RGBA if necessary
+    def save_draft_source(self, set_id: str, stamp_number: int, image_data: bytes) -> str:
+        """Keep the raw SD output of a draft sample for upscaling on approval"""
+        draft_dir = self.output_dir / set_id / "drafts"
+        draft_dir.mkdir(parents=True, exist_ok=True)
+        draft_path = draft_dir / f"stamp_{stamp_number:02d}.png"
+        draft_path.write_bytes(image_data)
+        return str(draft_path)
+    
+    def get_draft_source(self, set_id: str, stamp_number: int) -> Optional[str]:
+        """Raw draft image saved by save_draft_source, if any"""
+        draft_path = self.output_dir / set_id / "drafts" / f"stamp_{stamp_number:02d}.png"
+        return str(draft_path) if draft_path.exists() else None
+    
+    def _add_text_to_image(self, img: Image.Image, text: str, in_place: bool = False) -> Image.Image:
+        """Add text to image with white fill and black outline (TEXT_* style)"""
+        # Convert to RGBA if necessary (conversion already yields a new image)
         if img.mode != 'RGBA':
-            img = img.convert('RGBA')
+            img_copy = img.convert('RGBA')
+        elif in_place:
+            img_copy = img
+        else:
+            # Create a copy to avoid modifying original
+            img_copy = img.copy()
+        
+        if self.text_layout is not None:
+            return self._draw_fitted_text(img_copy, text)
         
-        # Create a copy to avoid modifying original
-        img_copy = img.copy()
         draw = ImageDraw.Draw(img_copy)
         
         # Choose font size based on text length
@@ -108,23 +325,29 @@ class ImageProcessor:
         if y < 0:
             y = img_height - text_height - 5
         
-        # Draw black outline (multiple times with small offsets)
-        outline_width = 2
-        outline_color = (0, 0, 0, 255)  # Black with full opacity
-        fill_color = (255, 255, 255, 255)  # White with full opacity
-        
-        # Draw outline
-        for dx in range(-outline_width, outline_width + 1):
-            for dy in range(-outline_width, outline_width + 1):
-                if dx == 0 and dy == 0:
-                    continue  # Skip center position
-                draw.text((x + dx, y + dy), text, font=font, fill=outline_color)
-        
-        # Draw main text
-        draw.text((x, y), text, font=font, fill=fill_color)
+        # Outline, shadow and fill from one glyph rasterisation
+        try:
+            draw_text(img_copy, (x, y), text, font, self.text_style)
+        except Exception as e:
+            # Fonts without getbbox (very old Pillow bitmap fonts): plain text
+            print(f"Error rendering text effects: {e}")
+            draw.text((x, y), text, font=font, fill=self.text_style.fill)
         
         return img_copy
     
+    def _draw_fitted_text(self, img: Image.Image, text: str) -> Image.Image:
+        """Draw text in the bottom band at the largest size that fits, wrapped with kinsoku rules"""
+        img_width, img_height = img.size
+        padding = 20
+        margin = self.text_style.padding()
+        box = (img_width - 2 * (padding // 2 + margin), int(img_height * 0.3))
+        layout = self.text_layout.layout(text, box)
+        
+        bottom = img_height - padding if layout.fits else img_height - 5
+        for x, y, runs in layout.positions(0, img_width, bottom):
+            draw_text_runs(img, (x, max(0, y)), runs, self.text_style)
+        return img
+    
     def _choose_font_size(self, text: str):
         """Choose appropriate font size based on text length"""
         if not self.font_normal:
@@ -141,103 +364,20 @@ class ImageProcessor:
     
     def create_grid_image(self, set_id: str, stamps: List[Dict], 
                          is_sample: bool = False) -> str:
-        """Create a grid image for review"""
-        if not stamps:
-            return ""
-        
-        # Grid configuration
-        cols = 5 if is_sample else 8
-        rows = (len(stamps) + cols - 1) // cols
-        
-        stamp_width, stamp_height = 370, 320
-        padding = 10
-        text_height = 30
-        
-        grid_width = cols * (stamp_width + padding) + padding
-        grid_height = rows * (stamp_height + text_height + padding) + padding
-        
-        # Create grid image
-        grid_img = Image.new('RGBA', (grid_width, grid_height), (240, 240, 240, 255))
-        draw = ImageDraw.Draw(grid_img)
-        
-        # Try to load font
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except:
-            font = ImageFont.load_default()
-        
-        for i, stamp in enumerate(stamps):
-            row = i // cols
-            col = i % cols
-            
-            x = padding + col * (stamp_width + padding)
-            y = padding + row * (stamp_height + text_height + padding)
-            
-            # Load and paste stamp image
-            if stamp.get('image_path') and os.path.exists(stamp['image_path']):
-                try:
-                    with Image.open(stamp['image_path']) as img:
-                        # Resize if necessary
-                        img = img.resize((stamp_width, stamp_height), Image.Resampling.LANCZOS)
-                        grid_img.paste(img, (x, y), img)
-                except Exception as e:
-                    print(f"Error loading stamp {stamp.get('number', i)}: {e}")
-                    # Draw placeholder
-                    draw.rectangle([x, y, x + stamp_width, y + stamp_height], 
-                                 fill=(200, 200, 200, 255))
-            
-            # Draw number
-            text_y = y + stamp_height + 5
-            number_text = f"{stamp.get('number', i + 1):02d}"
-            text_bbox = draw.textbbox((x, text_y), number_text, font=font)
-            text_width = text_bbox[2] - text_bbox[0]
-            text_x = x + (stamp_width - text_width) // 2
-            
-            # Draw text background
-            draw.rectangle([x, text_y, x + stamp_width, text_y + text_height], 
-                         fill=(50, 50, 50, 200))
-            draw.text((text_x, text_y), number_text, fill=(255, 255, 255, 255), font=font)
-        
-        # Save grid image
-        filename = f"{'sample_' if is_sample else ''}grid.png"
-        grid_path = self.output_dir / set_id / filename
-        grid_img.save(grid_path, "PNG")
-        
-        return str(grid_path)
+        """Create a grid image for review (only changed stamps are redrawn)"""
+        return self.grid_builder.build(set_id, stamps, is_sample)
     
-    def export_for_lora(self, set_id: str, stamps: List[Dict]) -> None:
-        """Export stamps for LoRA training"""
-        lora_set_dir = self.lora_export_dir / set_id
-        lora_set_dir.mkdir(parents=True, exist_ok=True)
-        
-        for stamp in stamps:
-            if not stamp.get('image_path') or not os.path.exists(stamp['image_path']):
-                continue
-            
-            stamp_number = stamp.get('number', 0)
-            phrase = stamp.get('phrase', '')
-            prompt = stamp.get('prompt', '')
-            
-            # Copy image
-            image_filename = f"{stamp_number:03d}.png"
-            image_path = Path(stamp['image_path'])
-            lora_image_path = lora_set_dir / image_filename
-            
-            try:
-                with Image.open(image_path) as img:
-                    img.save(lora_image_path, "PNG")
-            except Exception as e:
-                print(f"Error copying image for LoRA: {e}")
-                continue
-            
-            # Create caption file
-            caption_filename = f"{stamp_number:03d}.txt"
-            caption_path = lora_set_dir / caption_filename
-            
-            # Use prompt as caption, fallback to phrase
-            caption = prompt if prompt else phrase
-            with open(caption_path, 'w', encoding='utf-8') as f:
-                f.write(caption)
+    def update_grid_stamp(self, set_id: str, stamp_number: int, image_path: str) -> List[str]:
+        """Patch one regenerated stamp into the set's existing grids"""
+        return self.grid_builder.update_stamp(set_id, stamp_number, image_path)
+    
+    def export_for_lora(self, set_id: str, stamps: List[Dict]) -> Dict:
+        """Export stamps for LoRA training, copying only images and captions that changed"""
+        return self.lora_dataset.export(set_id, stamps)
+    
+    def accept_lora_rewrites(self, set_id: str, image_paths: List[str]) -> int:
+        """Keep the dataset's full-quality copies of stamps optimized after export"""
+        return self.lora_dataset.accept_rewrites(set_id, image_paths)
     
     def resize_image(self, image_path: str, width: int, height: int) -> str:
         """Resize image to specified dimensions"""
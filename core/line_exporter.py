@@ -0,0 +1,255 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, List, Tuple, Iterator
+from PIL import Image
+from dotenv import load_dotenv
+
+from .png_optimizer import PNGOptimizer
+
+load_dotenv()
+
+# LINE Creators Market stamp requirements
+STAMP_MAX_SIZE = (370, 320)
+MAIN_SIZE = (240, 240)
+TAB_SIZE = (96, 74)
+ALLOWED_COUNTS = (8, 16, 24, 32, 40)
+# Alpha below this counts as empty when trimming and checking margins (feathered halos)
+ALPHA_THRESHOLD = 16
+# Read size when copying spilled assets into the zip stream
+CHUNK_SIZE = 64 * 1024
+
+class LinePackage:
+    """Derived, validated submission assets for one set, spilled to a work directory until zipped"""
+    
+    __slots__ = ('set_id', 'assets', 'issues', 'warnings', 'seconds', 'work_dir')
+    
+    def __init__(self, set_id: str, assets: List[Tuple[str, str, int]], issues: List[str],
+                 warnings: List[str], seconds: float, work_dir: Optional[str] = None):
+        self.set_id = set_id
+        self.assets = assets  # (zip name, spilled file, bytes)
+        self.issues = issues
+        self.warnings = warnings
+        self.seconds = seconds
+        self.work_dir = work_dir
+    
+    @property
+    def ok(self) -> bool:
+        return not self.issues
+    
+    @property
+    def total_bytes(self) -> int:
+        return sum(size for _, _, size in self.assets)
+    
+    def cleanup(self):
+        """Remove the spilled assets; the package cannot be zipped afterwards"""
+        if self.work_dir:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.work_dir = None
+
+class _ChunkWriter(io.RawIOBase):
+    """Write-only, unseekable sink that hands the zip out in chunks as it is written"""
+    
+    def __init__(self):
+        self.chunks: List[bytes] = []
+        self.position = 0
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self.position
+    
+    def drain(self) -> bytes:
+        chunks, self.chunks = self.chunks, []
+        return b''.join(chunks)
+
+class LineExporter:
+    """Build the LINE Creators Market submission zip from a set's stamps.
+    
+    Every asset is derived from the stored stamp PNGs in parallel: each
+    stamp is trimmed to its content, given a LINE_MARGIN margin, scaled
+    down to fit 370x320 with even dimensions and optimized against the
+    per-file limit; main.png (240x240) and tab.png (96x74) are fitted from
+    the main stamp. Each file is validated for dimensions, margins and
+    bytes, then spilled to a temporary directory, so only one file per
+    worker is ever held in memory. The zip is streamed from those files
+    (stored entries, data descriptors) straight to a file or an HTTP
+    response without being assembled in memory."""
+    
+    def __init__(self, output_dir: str, png_optimizer: Optional[PNGOptimizer] = None):
+        self.output_dir = Path(output_dir)
+        self.line_dir = self.output_dir / "line"
+        self.line_dir.mkdir(parents=True, exist_ok=True)
+        self.png_optimizer = png_optimizer or PNGOptimizer()
+        self.margin = int(os.getenv('LINE_MARGIN', 10))
+        self.max_zip_bytes = int(os.getenv('LINE_ZIP_MAX_BYTES', 20000000))
+    
+    @staticmethod
+    def _content_bbox(img: Image.Image) -> Optional[Tuple[int, int, int, int]]:
+        return img.getchannel('A').point(lambda a: 255 if a >= ALPHA_THRESHOLD else 0).getbbox()
+    
+    def _fit(self, img: Image.Image, size: Tuple[int, int], margin: int, fixed: bool) -> Image.Image:
+        """Content of img scaled into size with margin; a fixed-size or even-sized canvas"""
+        img = img.convert('RGBA')
+        bbox = self._content_bbox(img)
+        if bbox is None:
+            raise ValueError("画像が完全に透明です")
+        content = img.crop(bbox)
+        
+        # Only ever scale down: stamps are generated at full size already
+        scale = min(1.0, (size[0] - 2 * margin) / content.width, (size[1] - 2 * margin) / content.height)
+        if scale < 1.0:
+            content = content.resize(
+                (max(1, int(content.width * scale)), max(1, int(content.height * scale))), Image.Resampling.LANCZOS
+            )
+        
+        if fixed:
+            canvas_size = size
+        else:
+            # LINE requires even width and height
+            canvas_size = tuple(min(limit, (length + 2 * margin + 1) // 2 * 2)
+                                for length, limit in zip(content.size, size))
+        canvas = Image.new('RGBA', canvas_size, (0, 0, 0, 0))
+        canvas.paste(content, ((canvas_size[0] - content.width) // 2, (canvas_size[1] - content.height) // 2))
+        return canvas
+    
+    def _validate(self, name: str, img: Image.Image, data: bytes, size: Tuple[int, int],
+                  margin: int, fixed: bool) -> List[str]:
+        issues = []
+        width, height = img.size
+        if fixed and (width, height) != size:
+            issues.append(f"{name}: {width}x{height}px (必要: {size[0]}x{size[1]}px)")
+        if not fixed and (width > size[0] or height > size[1]):
+            issues.append(f"{name}: {width}x{height}px (上限: {size[0]}x{size[1]}px)")
+        if width % 2 or height % 2:
+            issues.append(f"{name}: 幅と高さは偶数である必要があります ({width}x{height}px)")
+        bbox = self._content_bbox(img.convert('RGBA'))
+        if bbox and min(bbox[0], bbox[1], width - bbox[2], height - bbox[3]) < margin:
+            issues.append(f"{name}: 余白が{margin}px未満です")
+        if len(data) > self.png_optimizer.max_bytes:
+            issues.append(f"{name}: {len(data) / 1024:.0f}KB (上限: {self.png_optimizer.max_bytes / 1000:.0f}KB)")
+        return issues
+    
+    def _derive(self, work_dir: str, name: str, source: str, size: Tuple[int, int], margin: int,
+                fixed: bool) -> Tuple[str, Optional[str], int, List[str]]:
+        """(zip name, spilled png, bytes, issues) for one asset"""
+        try:
+            with Image.open(source) as img:
+                fitted = self._fit(img, size, margin, fixed)
+            data, _ = self.png_optimizer.optimize_image(fitted)
+            issues = self._validate(name, fitted, data, size, margin, fixed)
+            path = os.path.join(work_dir, name)
+            with open(path, 'wb') as f:
+                f.write(data)
+            return name, path, len(data), issues
+        except Exception as e:
+            return name, None, 0, [f"{name}: {e}"]
+    
+    def build(self, set_id: str, stamps: List[Dict], count: Optional[int] = None,
+              main_number: Optional[int] = None) -> LinePackage:
+        """Derive and validate every asset of the submission into a work directory; no zip is written"""
+        start = time.time()
+        issues: List[str] = []
+        warnings: List[str] = []
+        
+        stamps = sorted(
+            (stamp for stamp in stamps if stamp.get('image_path') and Path(stamp['image_path']).exists()),
+            key=lambda stamp: stamp['number']
+        )
+        if count is None:
+            # Largest submittable count; the rest of the set is left out
+            count = max((allowed for allowed in ALLOWED_COUNTS if allowed <= len(stamps)), default=len(stamps))
+        if count not in ALLOWED_COUNTS:
+            issues.append(f"スタンプ数は{'/'.join(map(str, ALLOWED_COUNTS))}枚のいずれかである必要があります ({count}枚)")
+        elif count > len(stamps):
+            issues.append(f"画像のあるスタンプが{len(stamps)}枚しかありません ({count}枚必要)")
+        if len(stamps) > count:
+            excluded = ', '.join(f"{stamp['number']:02d}" for stamp in stamps[count:])
+            warnings.append(f"{len(stamps)}枚中{count}枚を使用します (除外: {excluded})")
+        stamps = stamps[:count]
+        if not stamps:
+            return LinePackage(set_id, [], issues or ["画像のあるスタンプがありません"], warnings, time.time() - start)
+        
+        main_stamp = next((stamp for stamp in stamps if stamp['number'] == main_number), stamps[0])
+        jobs = [
+            (f"{i:02d}.png", stamp['image_path'], STAMP_MAX_SIZE, self.margin, False)
+            for i, stamp in enumerate(stamps, start=1)
+        ]
+        jobs += [
+            ("main.png", main_stamp['image_path'], MAIN_SIZE, self.margin, True),
+            ("tab.png", main_stamp['image_path'], TAB_SIZE, max(1, self.margin // 5), True)
+        ]
+        
+        work_dir = tempfile.mkdtemp(prefix=f".{set_id}.", dir=str(self.line_dir))
+        with ThreadPoolExecutor(max_workers=self.png_optimizer.workers) as executor:
+            results = list(executor.map(lambda job: self._derive(work_dir, *job), jobs))
+        
+        assets = []
+        for name, path, asset_bytes, asset_issues in results:
+            issues.extend(asset_issues)
+            if path is not None:
+                assets.append((name, path, asset_bytes))
+        package = LinePackage(set_id, assets, issues, warnings, time.time() - start, work_dir)
+        if package.total_bytes > self.max_zip_bytes:
+            issues.append(f"ZIP全体が{package.total_bytes / 1000000:.1f}MBです (上限: {self.max_zip_bytes / 1000000:.0f}MB)")
+        if not package.ok:
+            # Not submittable: nothing will be zipped from it
+            package.cleanup()
+        return package
+    
+    def iter_zip(self, package: LinePackage) -> Iterator[bytes]:
+        """The submission zip as a stream of chunks; the spilled assets are removed afterwards"""
+        if package.work_dir is None:
+            raise ValueError(f"LINE package for {package.set_id} is invalid or was already zipped")
+        sink = _ChunkWriter()
+        try:
+            # PNGs are already deflated: store them
+            with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as archive:
+                for name, path, asset_bytes in package.assets:
+                    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+                    info.file_size = asset_bytes
+                    with open(path, 'rb') as source, archive.open(info, 'w') as entry:
+                        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                            entry.write(chunk)
+                            yield sink.drain()
+                    yield sink.drain()
+            yield sink.drain()
+        finally:
+            package.cleanup()
+    
+    def write_zip(self, package: LinePackage, zip_path: Optional[str] = None) -> str:
+        """Stream the zip to disk (output/line/<set_id>.zip by default)"""
+        zip_path = Path(zip_path) if zip_path else self.line_dir / f"{package.set_id}.zip"
+        zip_path.parent.mkdir(parents=True, exist_ok=True)
+        temp = zip_path.with_name(f".{zip_path.name}.{os.getpid()}.{threading.get_ident()}")
+        try:
+            with open(temp, 'wb') as f:
+                for chunk in self.iter_zip(package):
+                    f.write(chunk)
+            os.replace(temp, zip_path)
+        except BaseException:
+            # Never leave a partial zip behind (the assets are already gone via iter_zip)
+            temp.unlink(missing_ok=True)
+            package.cleanup()
+            raise
+        return str(zip_path)
+    
+    def export_for_line(self, set_id: str, stamps: List[Dict], count: Optional[int] = None,
+                        main_number: Optional[int] = None) -> Tuple[Optional[str], LinePackage]:
+        """Build and, if it validates, write the submission zip: (zip path or None, package)"""
+        package = self.build(set_id, stamps, count, main_number)
+        if not package.ok:
+            return None, package
+        return self.write_zip(package), package
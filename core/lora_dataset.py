@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Files this exporter owns in a set's dataset directory
+DATASET_FILE = re.compile(r'^\d{3}\.(png|txt)$')
+MANIFEST_NAME = '.manifest.json'
+
+class LoRADatasetExporter:
+    """Incremental sync of a set's stamps into its LoRA training directory.
+    
+    A manifest next to the dataset records, for every NNN.png, the source
+    file's size, mtime and sha1, and for every NNN.txt the sha1 of its
+    caption. A re-export only copies (or hardlinks, LORA_EXPORT_MODE)
+    images whose source changed and rewrites captions whose text changed;
+    files for stamps no longer in the set are removed. Unchanged sources
+    are recognised from one stat() each, so re-exporting a large unchanged
+    set costs milliseconds."""
+    
+    def __init__(self, lora_export_dir: Path, mode: Optional[str] = None, workers: Optional[int] = None):
+        self.lora_export_dir = Path(lora_export_dir)
+        self.mode = (mode or os.getenv('LORA_EXPORT_MODE', 'copy')).lower()  # copy / hardlink
+        self.workers = max(1, workers or int(os.getenv('LORA_EXPORT_WORKERS', 4)))
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _file_hash(path: str) -> str:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    
+    def _load_manifest(self, set_dir: Path) -> Dict[str, Dict[str, Any]]:
+        try:
+            return json.loads((set_dir / MANIFEST_NAME).read_text(encoding='utf-8')).get('files', {})
+        except (OSError, ValueError):
+            return {}
+    
+    def _save_manifest(self, set_dir: Path, files: Dict[str, Dict[str, Any]]):
+        manifest_path = set_dir / MANIFEST_NAME
+        temp = manifest_path.with_name(f"{MANIFEST_NAME}.{os.getpid()}.{threading.get_ident()}")
+        temp.write_text(json.dumps({'files': files}, ensure_ascii=False), encoding='utf-8')
+        os.replace(temp, manifest_path)
+    
+    def _place(self, source: str, target: Path) -> str:
+        """Copy or hardlink source to target atomically; returns the method used"""
+        temp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}")
+        if self.mode == 'hardlink':
+            try:
+                os.link(source, temp)
+                os.replace(temp, target)
+                return 'linked'
+            except OSError:
+                # Different filesystem or no link support: copy instead
+                pass
+        shutil.copyfile(source, temp)
+        os.replace(temp, target)
+        return 'copied'
+    
+    def _sync_image(self, set_dir: Path, name: str, source: str,
+                    previous: Optional[Dict[str, Any]]) -> Tuple[str, Optional[Dict[str, Any]], str]:
+        """(name, manifest entry, action) for one image"""
+        try:
+            stat = os.stat(source)
+            target = set_dir / name
+            if (previous and previous.get('source') == source and previous.get('size') == stat.st_size
+                    and previous.get('mtime_ns') == stat.st_mtime_ns and target.exists()):
+                return name, previous, 'unchanged'
+            
+            key = self._file_hash(source)
+            entry = {'source': source, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'key': key}
+            if previous and previous.get('key') == key and target.exists():
+                # Touched but identical: only the recorded stat changes
+                return name, entry, 'unchanged'
+            return name, entry, self._place(source, target)
+        except Exception as e:
+            print(f"Error copying image for LoRA: {e}")
+            return name, None, 'failed'
+    
+    def _sync_caption(self, set_dir: Path, name: str, caption: str,
+                      previous: Optional[Dict[str, Any]]) -> Tuple[str, Optional[Dict[str, Any]], str]:
+        key = hashlib.sha1(caption.encode('utf-8')).hexdigest()
+        target = set_dir / name
+        if previous and previous.get('key') == key and target.exists():
+            return name, previous, 'unchanged'
+        try:
+            with open(target, 'w', encoding='utf-8') as f:
+                f.write(caption)
+            return name, {'key': key}, 'captions'
+        except OSError as e:
+            print(f"Error writing caption for LoRA: {e}")
+            return name, None, 'failed'
+    
+    def export(self, set_id: str, stamps: List[Dict]) -> Dict[str, Any]:
+        """Bring the set's dataset directory in line with stamps; returns what was done"""
+        start = time.time()
+        set_dir = self.lora_export_dir / set_id
+        set_dir.mkdir(parents=True, exist_ok=True)
+        stats = {'copied': 0, 'linked': 0, 'captions': 0, 'unchanged': 0, 'removed': 0, 'failed': 0}
+        
+        with self._lock:
+            manifest = self._load_manifest(set_dir)
+            tasks = []
+            for stamp in stamps:
+                if not stamp.get('image_path') or not os.path.exists(stamp['image_path']):
+                    continue
+                stamp_number = stamp.get('number', 0)
+                image_name = f"{stamp_number:03d}.png"
+                caption_name = f"{stamp_number:03d}.txt"
+                # Use prompt as caption, fallback to phrase
+                caption = stamp.get('prompt', '') or stamp.get('phrase', '')
+                tasks.append((self._sync_image, image_name, stamp['image_path']))
+                tasks.append((self._sync_caption, caption_name, caption))
+            
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = list(executor.map(
+                    lambda task: task[0](set_dir, task[1], task[2], manifest.get(task[1])), tasks
+                ))
+            
+            files = {}
+            for name, entry, action in results:
+                stats[action] += 1
+                if entry is not None:
+                    files[name] = entry
+            
+            # Stale files: stamps removed or renumbered since the last export
+            for path in set_dir.iterdir():
+                if DATASET_FILE.match(path.name) and path.name not in files:
+                    try:
+                        path.unlink()
+                        stats['removed'] += 1
+                    except OSError as e:
+                        print(f"Error removing stale LoRA file {path}: {e}")
+            
+            if files != manifest:
+                self._save_manifest(set_dir, files)
+        
+        stats['seconds'] = time.time() - start
+        return stats
+    
+    def accept_rewrites(self, set_id: str, sources: List[str]) -> int:
+        """Record exported sources that were since rewritten in place (PNG
+        optimisation) as current, so later syncs keep the full-quality copies
+        already in the dataset; returns how many entries were updated"""
+        set_dir = self.lora_export_dir / set_id
+        sources = set(sources)
+        updated = 0
+        with self._lock:
+            manifest = self._load_manifest(set_dir)
+            for name, entry in manifest.items():
+                if entry.get('source') not in sources or not (set_dir / name).exists():
+                    continue
+                try:
+                    stat = os.stat(entry['source'])
+                    if stat.st_size == entry.get('size') and stat.st_mtime_ns == entry.get('mtime_ns'):
+                        continue
+                    entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, key=self._file_hash(entry['source']))
+                    updated += 1
+                except OSError as e:
+                    print(f"Error recording LoRA source {entry['source']}: {e}")
+            if updated:
+                self._save_manifest(set_dir, manifest)
+        return updated
@@ -0,0 +1,153 @@
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Dict, Any, List, Tuple
+import numpy as np
+from PIL import Image, features
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# zlib strategies: default, Z_FILTERED, Z_RLE (flat artwork often compresses best with RLE)
+ZLIB_STRATEGIES = (0, 1, 3)
+PALETTE_COLORS = (256, 192, 128, 96, 64, 48, 32, 16)
+
+class PNGOptimizer:
+    """Re-encode stamps to fit LINE's per-file limit and shrink uploads.
+    
+    Each image is re-encoded without metadata at the strongest zlib settings
+    over several strategies. An 8-bit palette with per-entry alpha replaces
+    it when visually equivalent (PNG_QUANTIZE_MAX_ERROR) or when the file
+    would exceed PNG_MAX_BYTES, trying fewer colours until it fits."""
+    
+    def __init__(self, max_bytes: Optional[int] = None, workers: Optional[int] = None,
+                 quantize: Optional[str] = None):
+        # LINE rejects stamp images over 1MB
+        self.max_bytes = max_bytes or int(os.getenv('PNG_MAX_BYTES', 1000000))
+        self.quantize = (quantize or os.getenv('PNG_QUANTIZE', 'auto')).lower()  # auto / always / never
+        self.max_error = float(os.getenv('PNG_QUANTIZE_MAX_ERROR', 1.5))
+        self.workers = max(1, workers or int(os.getenv('PNG_OPTIMIZE_WORKERS', min(4, os.cpu_count() or 1))))
+        # libimagequant gives better palettes with alpha when Pillow is built with it
+        self.quantize_method = (
+            Image.Quantize.LIBIMAGEQUANT if features.check_feature('libimagequant') else Image.Quantize.FASTOCTREE
+        )
+        
+        self._lock = threading.Lock()
+        self._stats = {'files': 0, 'rewritten': 0, 'quantized': 0, 'over_budget': 0,
+                       'bytes_before': 0, 'bytes_after': 0}
+    
+    @staticmethod
+    def _encode(img: Image.Image, **params) -> bytes:
+        buffer = io.BytesIO()
+        img.save(buffer, "PNG", **params)
+        return buffer.getvalue()
+    
+    @staticmethod
+    def _prepare(img: Image.Image) -> Image.Image:
+        """RGB or RGBA copy without metadata; alpha is dropped when fully opaque"""
+        img = img.convert('RGBA') if img.mode not in ('RGB', 'RGBA') else img.copy()
+        if img.mode == 'RGBA' and img.getchannel('A').getextrema() == (255, 255):
+            img = img.convert('RGB')
+        img.info = {}
+        return img
+    
+    def _lossless(self, img: Image.Image) -> bytes:
+        """Smallest level-9 encoding over the zlib strategies"""
+        return min(
+            (self._encode(img, optimize=True, compress_type=strategy) for strategy in ZLIB_STRATEGIES),
+            key=len
+        )
+    
+    def _palette(self, img: Image.Image, colors: int) -> Tuple[bytes, float]:
+        """Palette encoding with alpha, and its mean error against img (premultiplied, 0-255)"""
+        method = self.quantize_method if img.mode == 'RGBA' else Image.Quantize.MEDIANCUT
+        quantized = img.quantize(colors=colors, method=method)
+        original = np.asarray(img.convert('RGBA'), dtype=np.float32)
+        restored = np.asarray(quantized.convert('RGBA'), dtype=np.float32)
+        original[..., :3] *= original[..., 3:] / 255
+        restored[..., :3] *= restored[..., 3:] / 255
+        error = float(np.abs(original - restored).mean())
+        return self._encode(quantized, optimize=True), error
+    
+    def optimize_image(self, img: Image.Image) -> Tuple[bytes, str]:
+        """Best encoding of img within the budget: (png bytes, method)"""
+        img = self._prepare(img)
+        data, method = self._lossless(img), 'lossless'
+        if self.quantize == 'never':
+            return data, method
+        
+        for colors in PALETTE_COLORS:
+            palette_data, error = self._palette(img, colors)
+            over_budget = len(data) > self.max_bytes
+            if len(palette_data) < len(data) and (over_budget or self.quantize == 'always' or error <= self.max_error):
+                data, method = palette_data, f'palette{colors}'
+            # Fewer colours only when still over budget
+            if len(data) <= self.max_bytes:
+                break
+        return data, method
+    
+    def optimize_file(self, path: str) -> Dict[str, Any]:
+        """Optimise one PNG in place, keeping the original when it is already smaller"""
+        path = Path(path)
+        before = path.stat().st_size
+        with Image.open(path) as img:
+            data, method = self.optimize_image(img)
+        
+        rewritten = len(data) < before
+        if rewritten:
+            # Write then rename so a reader never sees a partial file
+            temp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+            temp.write_bytes(data)
+            os.replace(temp, path)
+        after = len(data) if rewritten else before
+        
+        result = {
+            'path': str(path),
+            'bytes_before': before,
+            'bytes_after': after,
+            'method': method if rewritten else 'unchanged',
+            'fits': after <= self.max_bytes
+        }
+        with self._lock:
+            self._stats['files'] += 1
+            self._stats['rewritten'] += rewritten
+            self._stats['quantized'] += rewritten and method != 'lossless'
+            self._stats['over_budget'] += not result['fits']
+            self._stats['bytes_before'] += before
+            self._stats['bytes_after'] += after
+        return result
+    
+    def optimize_files(self, paths: List[str]) -> Dict[str, Any]:
+        """Optimise files in parallel and summarise the bytes saved"""
+        def run(path: str) -> Optional[Dict[str, Any]]:
+            try:
+                return self.optimize_file(path)
+            except Exception as e:
+                print(f"Error optimizing {path}: {e}")
+                return None
+        
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = [result for result in executor.map(run, paths) if result]
+        
+        bytes_before = sum(result['bytes_before'] for result in results)
+        bytes_after = sum(result['bytes_after'] for result in results)
+        return {
+            'files': results,
+            'bytes_before': bytes_before,
+            'bytes_after': bytes_after,
+            'bytes_saved': bytes_before - bytes_after,
+            'over_budget': [result['path'] for result in results if not result['fits']],
+            'seconds': time.time() - start
+        }
+    
+    def optimize_set(self, set_dir: str) -> Dict[str, Any]:
+        """Optimise every stamp_NN.png of a set directory"""
+        return self.optimize_files([str(path) for path in sorted(Path(set_dir).glob('stamp_*.png'))])
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,189 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+from .image_utils import ImageProcessor
+
+load_dotenv()
+
+# ImageProcessor owned by each worker process (set by _init_worker)
+_worker_processor: Optional[ImageProcessor] = None
+
+def _init_worker(output_dir: str, lora_export_dir: str, threads: int):
+    global _worker_processor
+    # Share the cores between workers instead of each ONNX session sizing its pools to the whole machine
+    if int(os.getenv('REMBG_INTRA_OP_THREADS', 0)) <= 0:
+        sessions = max(1, int(os.getenv('REMBG_SESSIONS', 1)))
+        os.environ['REMBG_INTRA_OP_THREADS'] = str(max(1, threads // sessions))
+    # Also caps numpy and rembg sessions built outside our SessionOptions
+    os.environ.setdefault('OMP_NUM_THREADS', str(threads))
+    _worker_processor = ImageProcessor(output_dir, lora_export_dir)
+    try:
+        _worker_processor.background_remover.warm_up()
+    except Exception as e:
+        # An initializer exception would break the whole pool; remove_background copes later
+        print(f"Error warming up rembg sessions: {e}")
+
+def _ping() -> int:
+    return os.getpid()
+
+def _save_stamp(set_id: str, stamp_number: int, image_data: bytes, phrase: str, is_sample: bool,
+                draft: bool) -> str:
+    return _worker_processor.save_stamp_image(set_id, stamp_number, image_data, phrase, is_sample, draft)
+
+def _save_stamps(set_id: str, stamps: List[Tuple[int, bytes, str]], is_sample: bool, draft: bool) -> List[str]:
+    return _worker_processor.save_stamp_images(set_id, stamps, is_sample, draft)
+
+class PostProcessPool:
+    """Bounded process pool for stamp post-processing (rembg, text, PNG save).
+    
+    Generation threads hand each SD result to the pool and go straight back
+    to the GPU queue, so stamp N is matted and captioned while stamp N+1 is
+    being sampled. At most POSTPROCESS_MAX_PENDING submissions (a stamp or
+    one SD batch of stamps) are in flight;
+    submit() blocks beyond that, which keeps memory bounded and slows the
+    generation loop to the speed of post-processing. POSTPROCESS_WORKERS=0
+    runs everything in-process instead.
+    
+    Each worker holds its own ImageProcessor and rembg model, so the
+    default is a small fixed count (2). The cores are split between the
+    workers: each gets POSTPROCESS_WORKER_THREADS (default cores / workers)
+    ONNX intra-op threads unless REMBG_INTRA_OP_THREADS is set."""
+    
+    def __init__(self, image_processor: ImageProcessor, workers: Optional[int] = None,
+                 max_pending: Optional[int] = None):
+        self.image_processor = image_processor
+        if workers is None:
+            workers = int(os.getenv('POSTPROCESS_WORKERS', 2))
+        self.workers = max(0, workers)
+        self.worker_threads = int(os.getenv('POSTPROCESS_WORKER_THREADS', 0)) or max(
+            1, (os.cpu_count() or 1) // max(1, self.workers)
+        )
+        if max_pending is None:
+            max_pending = int(os.getenv('POSTPROCESS_MAX_PENDING', max(1, self.workers) * 2))
+        self.max_pending = max(1, max_pending)
+        
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'pending': 0,
+            'backpressure_waits': 0,
+            'backpressure_seconds': 0.0
+        }
+    
+    @property
+    def in_process(self) -> bool:
+        return self.workers == 0
+    
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._executor_lock:
+            if self._executor is None:
+                # spawn, not fork: onnxruntime's thread pools are not fork-safe
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                    initargs=(
+                        str(self.image_processor.output_dir), str(self.image_processor.lora_export_dir),
+                        self.worker_threads
+                    )
+                )
+            return self._executor
+    
+    def warm_up(self):
+        """Start the worker processes so their rembg sessions load before the first stamp"""
+        if self.in_process:
+            self.image_processor.background_remover.warm_up_in_background()
+            return
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(_ping)
+    
+    def _acquire_slot(self):
+        if self._slots.acquire(blocking=False):
+            return
+        start = time.perf_counter()
+        self._slots.acquire()
+        with self._stats_lock:
+            self._stats['backpressure_waits'] += 1
+            self._stats['backpressure_seconds'] += time.perf_counter() - start
+    
+    def _on_done(self, future: Future):
+        self._slots.release()
+        with self._stats_lock:
+            self._stats['pending'] -= 1
+            self._stats['completed' if not future.cancelled() and future.exception() is None else 'failed'] += 1
+    
+    def submit(self, set_id: str, stamp_number: int, image_data: bytes,
+               phrase: str = "", is_sample: bool = False, draft: bool = False) -> Future:
+        """Post-process and save one stamp; the Future resolves to its image path.
+        
+        Blocks while max_pending submissions are already in flight."""
+        return self._submit(
+            self.image_processor.save_stamp_image, _save_stamp,
+            (set_id, stamp_number, image_data, phrase, is_sample, draft)
+        )
+    
+    def submit_batch(self, set_id: str, stamps: List[Tuple[int, bytes, str]],
+                     is_sample: bool = False, draft: bool = False) -> Future:
+        """Post-process (number, image_data, phrase) stamps with one batched rembg run;
+        the Future resolves to their image paths in order"""
+        return self._submit(self.image_processor.save_stamp_images, _save_stamps,
+                            (set_id, stamps, is_sample, draft))
+    
+    def _submit(self, local_fn, worker_fn, args: tuple) -> Future:
+        self._acquire_slot()
+        with self._stats_lock:
+            self._stats['submitted'] += 1
+            self._stats['pending'] += 1
+        
+        future: Future
+        try:
+            if self.in_process:
+                future = Future()
+                try:
+                    future.set_result(local_fn(*args))
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                try:
+                    future = self._get_executor().submit(worker_fn, *args)
+                except BrokenProcessPool as e:
+                    # A worker died (e.g. out of memory); start a fresh pool for this submission
+                    print(f"Post-processing pool broken, restarting: {e}")
+                    with self._executor_lock:
+                        self._executor = None
+                    future = self._get_executor().submit(worker_fn, *args)
+        except Exception:
+            self._slots.release()
+            with self._stats_lock:
+                self._stats['pending'] -= 1
+                self._stats['failed'] += 1
+            raise
+        future.add_done_callback(self._on_done)
+        return future
+    
+    def save(self, set_id: str, stamp_number: int, image_data: bytes,
+             phrase: str = "", is_sample: bool = False, draft: bool = False) -> str:
+        """Blocking variant of submit"""
+        return self.submit(set_id, stamp_number, image_data, phrase, is_sample, draft).result()
+    
+    def shutdown(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            return dict(self._stats, workers=self.workers, max_pending=self.max_pending)
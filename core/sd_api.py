@@ -1,28 +1,398 @@
+import asyncio
 import requests
 import json
 import base64
-import io
-from typing import Optional, Dict, Any
-from PIL import Image
+import random
+import time
+import threading
+from typing import Optional, Dict, Any, List, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 import os
 from dotenv import load_dotenv
 
+from .sd_cache import reference_cache, result_cache, GenerationResultCache
+from .sd_progress import ProgressMonitor
+
 load_dotenv()
 
+# Per-thread record of the TCP/TLS connect time of the request in flight.
+# urllib3 opens connections in the calling thread, so a thread-local is enough
+# to attribute connect time to the request that caused it.
+_connect_timer = threading.local()
+
+class _TimedConnectMixin:
+    """Record how long establishing a new connection took"""
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            _connect_timer.elapsed = getattr(_connect_timer, 'elapsed', 0.0) + time.perf_counter() - start
+
+class _TimedHTTPConnection(_TimedConnectMixin, HTTPConnection):
+    pass
+
+class _TimedHTTPSConnection(_TimedConnectMixin, HTTPSConnection):
+    pass
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter whose pools report connect time"""
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool
+        }
+
+class SDAPIError(Exception):
+    """Classified failure of a Stable Diffusion API call"""
+    transient = False
+    
+    def __init__(self, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class SDTransientError(SDAPIError):
+    """Failure worth retrying: timeouts, dropped connections, 5xx, 429"""
+    transient = True
+
+class SDPermanentError(SDAPIError):
+    """Failure that will repeat on retry: bad payload, 4xx, malformed response"""
+
+class SDCircuitOpenError(SDTransientError):
+    """The backend's circuit breaker is open and dispatch is paused"""
+
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def classify_error(error: Exception) -> SDAPIError:
+    """Map requests/JSON exceptions to SDTransientError or SDPermanentError"""
+    if isinstance(error, SDAPIError):
+        return error
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        error_class = SDTransientError if status in TRANSIENT_STATUS_CODES else SDPermanentError
+        return error_class(f"HTTP {status}: {error}", status)
+    if isinstance(error, (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                          requests.exceptions.ChunkedEncodingError)):
+        return SDTransientError(str(error))
+    return SDPermanentError(f"{type(error).__name__}: {error}")
+
+class CircuitBreaker:
+    """Stop dispatching to a backend after repeated transient failures.
+    
+    closed: requests flow. open: requests wait (up to max_wait) for the reset
+    timeout to pass. half_open: a single trial request is let through; its
+    outcome closes or re-opens the circuit."""
+    
+    def __init__(self, name: str):
+        self.name = name
+        self.failure_threshold = int(os.getenv('SD_BREAKER_THRESHOLD', 5))
+        self.reset_timeout = float(os.getenv('SD_BREAKER_RESET', 30))
+        self.max_wait = float(os.getenv('SD_BREAKER_MAX_WAIT', 60))
+        
+        self._lock = threading.Lock()
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self.opens = 0
+        self.rejections = 0
+    
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == 'open' and time.time() - self.opened_at < self.reset_timeout
+    
+    def _try_acquire(self) -> Optional[float]:
+        """None if a request may proceed, else seconds to wait before asking again"""
+        with self._lock:
+            if self.state == 'closed':
+                return None
+            if self.state == 'open':
+                remaining = self.opened_at + self.reset_timeout - time.time()
+                if remaining > 0:
+                    return remaining
+                self.state = 'half_open'
+            if not self._trial_in_flight:
+                self._trial_in_flight = True
+                return None
+            return 0.5
+    
+    def wait_for_permission(self) -> bool:
+        """Block while the circuit is open; False if it stays open past max_wait"""
+        deadline = time.time() + self.max_wait
+        while True:
+            wait = self._try_acquire()
+            if wait is None:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                with self._lock:
+                    self.rejections += 1
+                return False
+            time.sleep(min(wait, remaining, 1.0))
+    
+    async def wait_for_permission_async(self) -> bool:
+        """wait_for_permission for event-loop callers: waits without blocking the loop"""
+        deadline = time.time() + self.max_wait
+        while True:
+            wait = self._try_acquire()
+            if wait is None:
+                return True
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                with self._lock:
+                    self.rejections += 1
+                return False
+            await asyncio.sleep(min(wait, remaining, 1.0))
+    
+    def record_success(self):
+        with self._lock:
+            if self.state != 'closed':
+                print(f"Circuit closed for {self.name}")
+            self.state = 'closed'
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+    
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            self._trial_in_flight = False
+            if self.state == 'half_open' or (
+                    self.state == 'closed' and self.consecutive_failures >= self.failure_threshold):
+                self.state = 'open'
+                self.opened_at = time.time()
+                self.opens += 1
+                print(f"Circuit opened for {self.name} after {self.consecutive_failures} failures")
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'state': self.state,
+                'consecutive_failures': self.consecutive_failures,
+                'opens': self.opens,
+                'rejections': self.rejections
+            }
+
+def _parse_timeout(value: Optional[str], default: tuple) -> tuple:
+    """Parse "connect,read" (or a single read timeout) into a requests timeout tuple"""
+    if not value:
+        return default
+    parts = [float(p) for p in value.split(',') if p.strip()]
+    if len(parts) == 1:
+        return (default[0], parts[0])
+    return (parts[0], parts[1])
+
+def model_key(prompt, checkpoint: Optional[str] = None) -> str:
+    """Identify the checkpoint and LoRA set a request needs loaded on the WebUI"""
+    prompts = prompt if isinstance(prompt, list) else [prompt]
+    loras = sorted({m.group(0) for p in prompts for m in GenerationResultCache.LORA_PATTERN.finditer(p)})
+    return f"{checkpoint or 'default'}|{','.join(loras)}"
+
 class StableDiffusionAPI:
-    def __init__(self):
-        self.base_url = os.getenv('SD_WEBUI_URL', 'http://localhost:7860')
+    def __init__(self, base_url: Optional[str] = None):
+        self.base_url = (base_url or os.getenv('SD_WEBUI_URL', 'http://localhost:7860')).rstrip('/')
         self.txt2img_endpoint = f"{self.base_url}/sdapi/v1/txt2img"
         self.img2img_endpoint = f"{self.base_url}/sdapi/v1/img2img"
+        
+        # Connection pool settings
+        self.pool_size = int(os.getenv('SD_POOL_SIZE', 4))
+        self.keep_alive = os.getenv('SD_KEEP_ALIVE', 'true').lower() not in ('0', 'false', 'no')
+        
+        # Per-endpoint (connect, read) timeouts in seconds
+        self.timeouts = {
+            'generate': _parse_timeout(os.getenv('SD_TIMEOUT_GENERATE'), (5.0, 300.0)),
+            'query': _parse_timeout(os.getenv('SD_TIMEOUT_QUERY'), (5.0, 10.0)),
+            'health': _parse_timeout(os.getenv('SD_TIMEOUT_HEALTH'), (3.0, 5.0))
+        }
+        
+        self._session: Optional[requests.Session] = None
+        self._session_lock = threading.Lock()
+        
+        # Step-level progress of in-flight generations
+        self.progress = ProgressMonitor(self.base_url, self._get_session, self.timeouts['query'])
+        
+        # ControlNet unit that keeps a character reference when img2img starts from another image
+        self.controlnet_module = os.getenv('SD_CONTROLNET_REFERENCE_MODULE', 'reference_only')
+        self.controlnet_weight = float(os.getenv('SD_CONTROLNET_REFERENCE_WEIGHT', 0.8))
+        
+        # Retry with jittered exponential backoff, and a breaker per backend
+        self.max_retries = int(os.getenv('SD_RETRY_MAX', 3))
+        self.retry_base = float(os.getenv('SD_RETRY_BASE', 1.0))
+        self.retry_cap = float(os.getenv('SD_RETRY_CAP', 30.0))
+        self.breaker = CircuitBreaker(self.base_url)
+        self._resilience_stats = {
+            'retries': 0,
+            'transient_errors': 0,
+            'permanent_errors': 0,
+            'gave_up': 0
+        }
+        
+        # Transport timings
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'new_connections': 0,
+            'connect': 0.0,
+            'wait': 0.0,
+            'transfer': 0.0,
+            'decode': 0.0,
+            'bytes': 0
+        }
     
-    def generate_image(self, prompt: str, negative_prompt: str = "", 
-                      width: int = 370, height: int = 320, 
-                      cfg_scale: float = 7.0, steps: int = 30,
-                      sampler_name: str = "DPM++ 2M Karras",
-                      seed: int = -1, reference_image_path: Optional[str] = None,
-                      denoising_strength: float = 0.6) -> Optional[bytes]:
-        """Generate image using Stable Diffusion API"""
+    def _get_session(self) -> requests.Session:
+        """Get the shared pooled session, creating it on first use"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = _TimedHTTPAdapter(
+                        pool_connections=1,
+                        pool_maxsize=self.pool_size,
+                        pool_block=True
+                    )
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    session.headers['Connection'] = 'keep-alive' if self.keep_alive else 'close'
+                    self._session = session
+        return self._session
+    
+    def close(self):
+        """Close pooled connections"""
+        with self._session_lock:
+            if self._session is not None:
+                self._session.close()
+                self._session = None
+    
+    def _request(self, method: str, url: str, timeout_key: str, **kwargs) -> requests.Response:
+        """Send a request through the pool and record connect/wait/transfer timings.
+        
+        The body is read eagerly so the connection returns to the pool
+        before the caller starts decoding."""
+        _connect_timer.elapsed = 0.0
+        start = time.perf_counter()
+        response = self._get_session().request(
+            method, url, timeout=self.timeouts[timeout_key], stream=True, **kwargs
+        )
+        headers_at = time.perf_counter()
+        body = response.content
+        done = time.perf_counter()
+        
+        connect = _connect_timer.elapsed
+        self._local.timing = {
+            'url': url,
+            'status': response.status_code,
+            'reused_connection': connect == 0.0,
+            'connect': connect,
+            'wait': headers_at - start - connect,
+            'transfer': done - headers_at,
+            'decode': 0.0,
+            'bytes': len(body)
+        }
+        self._record_timing()
+        return response
+    
+    def _record_timing(self, decode: float = 0.0):
+        """Fold the calling thread's last request into the aggregate stats"""
+        timing = getattr(self._local, 'timing', None)
+        if timing is None:
+            return
+        with self._stats_lock:
+            if decode:
+                # Decode is measured after the transport stats were recorded
+                timing['decode'] = decode
+                self._stats['decode'] += decode
+                return
+            self._stats['requests'] += 1
+            if not timing['reused_connection']:
+                self._stats['new_connections'] += 1
+            for key in ('connect', 'wait', 'transfer', 'bytes'):
+                self._stats[key] += timing[key]
+    
+    def _count(self, key: str):
+        with self._stats_lock:
+            self._resilience_stats[key] += 1
+    
+    def get_resilience_stats(self) -> Dict[str, Any]:
+        """Retry counters and circuit breaker state"""
+        with self._stats_lock:
+            stats = dict(self._resilience_stats)
+        stats['breaker'] = self.breaker.get_stats()
+        return stats
+    
+    def _post_generate(self, endpoint: str, payload: Dict[str, Any], steps: int,
+                       images: int = 1) -> requests.Response:
+        """POST a generation request with retries and circuit breaking.
         
+        Transient failures are retried with full-jitter exponential backoff;
+        anything else, or exhausting the retries, raises a classified SDAPIError."""
+        attempt = 0
+        while True:
+            if not self.breaker.wait_for_permission():
+                raise SDCircuitOpenError(f"Circuit open for {self.base_url}")
+            try:
+                with self.progress.track(steps, images):
+                    response = self._request('POST', endpoint, 'generate', json=payload)
+                response.raise_for_status()
+            except Exception as e:
+                error = classify_error(e)
+                if not error.transient:
+                    # The server answered, so it is up even if the request was bad
+                    self.breaker.record_success()
+                    self._count('permanent_errors')
+                    raise error from e
+                
+                self.breaker.record_failure()
+                self._count('transient_errors')
+                if attempt >= self.max_retries:
+                    self._count('gave_up')
+                    raise error from e
+                
+                attempt += 1
+                self._count('retries')
+                delay = random.uniform(0, min(self.retry_cap, self.retry_base * 2 ** (attempt - 1)))
+                print(f"Transient SD error ({error}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            
+            self.breaker.record_success()
+            return response
+    
+    def get_last_timings(self) -> Optional[Dict[str, Any]]:
+        """Timings of the last request made from the calling thread"""
+        timing = getattr(self._local, 'timing', None)
+        return dict(timing) if timing else None
+    
+    def get_transport_stats(self) -> Dict[str, Any]:
+        """Aggregate transport timings across all requests"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        if stats['requests']:
+            for key in ('connect', 'wait', 'transfer', 'decode'):
+                stats[f'avg_{key}'] = stats[key] / stats['requests']
+        return stats
+    
+    def _build_payload(self, prompt, negative_prompt: str = "",
+                       width: int = 370, height: int = 320,
+                       cfg_scale: float = 7.0, steps: int = 30,
+                       sampler_name: str = "DPM++ 2M Karras",
+                       seed: int = -1, reference_image_path: Optional[str] = None,
+                       denoising_strength: float = 0.6,
+                       checkpoint: Optional[str] = None,
+                       control_image_path: Optional[str] = None) -> Tuple[str, Dict[str, Any]]:
+        """Build the request payload and pick txt2img or img2img.
+        
+        control_image_path adds a ControlNet reference unit, so the character
+        is kept when init_images is something else (e.g. a draft being refined).
+        Raises if the reference image cannot be read."""
         payload = {
             "prompt": prompt,
             "negative_prompt": negative_prompt,
@@ -35,63 +405,211 @@ class StableDiffusionAPI:
             "save_images": False,
             "send_images": True
         }
+        if checkpoint:
+            # Leave the checkpoint loaded so following requests for it skip the swap
+            payload["override_settings"] = {"sd_model_checkpoint": checkpoint}
+            payload["override_settings_restore_afterwards"] = False
+        if control_image_path and os.path.exists(control_image_path):
+            payload["alwayson_scripts"] = {"controlnet": {"args": [{
+                "image": reference_cache.get_encoded(control_image_path, width, height),
+                "module": self.controlnet_module,
+                "model": "None",
+                "weight": self.controlnet_weight
+            }]}}
         
         # Use img2img if reference image is provided
         if reference_image_path and os.path.exists(reference_image_path):
-            try:
-                with Image.open(reference_image_path) as img:
-                    # Convert to RGB if necessary
-                    if img.mode != 'RGB':
-                        img = img.convert('RGB')
-                    
-                    # Resize to target dimensions
-                    img = img.resize((width, height), Image.Resampling.LANCZOS)
-                    
-                    # Convert to bytes
-                    img_bytes = io.BytesIO()
-                    img.save(img_bytes, format='PNG')
-                    img_bytes.seek(0)
-                    img_b64 = base64.b64encode(img_bytes.getvalue()).decode()
-                    
-                    payload.update({
-                        "init_images": [img_b64],
-                        "denoising_strength": denoising_strength
-                    })
-                    
-                    endpoint = self.img2img_endpoint
-            except Exception as e:
-                print(f"Error processing reference image: {e}")
-                return None
-        else:
-            endpoint = self.txt2img_endpoint
+            payload.update({
+                "init_images": [reference_cache.get_encoded(reference_image_path, width, height)],
+                "denoising_strength": denoising_strength
+            })
+            
+            return self.img2img_endpoint, payload
+        
+        return self.txt2img_endpoint, payload
+    
+    def generate_image(self, prompt: str, negative_prompt: str = "", 
+                      width: int = 370, height: int = 320, 
+                      cfg_scale: float = 7.0, steps: int = 30,
+                      sampler_name: str = "DPM++ 2M Karras",
+                      seed: int = -1, reference_image_path: Optional[str] = None,
+                      denoising_strength: float = 0.6,
+                      checkpoint: Optional[str] = None,
+                      raise_errors: bool = False,
+                      control_image_path: Optional[str] = None) -> Optional[bytes]:
+        """Generate image using Stable Diffusion API
         
+        Returns None on failure, or raises the classified SDAPIError when
+        raise_errors is set."""
         try:
-            response = requests.post(endpoint, json=payload, timeout=300)
-            response.raise_for_status()
+            endpoint, payload = self._build_payload(
+                prompt, negative_prompt, width, height, cfg_scale, steps,
+                sampler_name, seed, reference_image_path, denoising_strength, checkpoint,
+                control_image_path
+            )
+            cache_key = result_cache.make_key(payload, reference_image_path)
+        except Exception as e:
+            print(f"Error processing reference image: {e}")
+            if raise_errors:
+                raise SDPermanentError(f"Error processing reference image: {e}") from e
+            return None
+        
+        # Identical, seeded requests are served from disk without touching the server
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response = self._post_generate(endpoint, payload, steps)
             
-            result = response.json()
+            decode_start = time.perf_counter()
+            try:
+                result = response.json()
+            except ValueError as e:
+                raise SDPermanentError(f"Error parsing API response: {e}") from e
             if 'images' in result and len(result['images']) > 0:
                 # Get the generated image
                 image_data = base64.b64decode(result['images'][0])
+                self._record_timing(decode=time.perf_counter() - decode_start)
+                result_cache.put(cache_key, image_data)
                 return image_data
             else:
-                print("No images in response")
-                return None
+                raise SDPermanentError("No images in response")
                 
-        except requests.exceptions.RequestException as e:
+        except SDAPIError as e:
             print(f"Error calling Stable Diffusion API: {e}")
-            return None
-        except json.JSONDecodeError as e:
-            print(f"Error parsing API response: {e}")
+            if raise_errors:
+                raise
             return None
         except Exception as e:
             print(f"Unexpected error: {e}")
+            if raise_errors:
+                raise SDPermanentError(f"Unexpected error: {e}") from e
             return None
     
+    def generate_batch(self, prompts: List[str], negative_prompts: Optional[List[str]] = None,
+                       width: int = 370, height: int = 320,
+                       cfg_scale: float = 7.0, steps: int = 30,
+                       sampler_name: str = "DPM++ 2M Karras",
+                       seed: int = -1, reference_image_path: Optional[str] = None,
+                       denoising_strength: float = 0.6,
+                       n_iter: int = 1,
+                       checkpoint: Optional[str] = None,
+                       raise_errors: bool = False,
+                       control_image_path: Optional[str] = None) -> List[Tuple[Optional[bytes], int]]:
+        """Generate several images in one request using batch_size / n_iter.
+        
+        Image i is sampled with seed + i, as SD WebUI does for batches.
+        Returns (image_data, seed) pairs in prompt order; image_data is None
+        for images that could not be generated. With raise_errors, a failed
+        request raises the classified SDAPIError instead.
+        
+        Each image is cached under the key of the equivalent generate_image
+        request, so the two paths share hits. The request is skipped when
+        every image is cached; otherwise the whole batch is rendered."""
+        count = len(prompts)
+        if count == 0:
+            return []
+        if n_iter < 1 or count % n_iter != 0:
+            raise ValueError(f"{count} prompts cannot be split into {n_iter} iterations")
+        negative_prompts = negative_prompts or [""] * count
+        expected_seeds = [seed + i if seed != -1 else -1 for i in range(count)]
+        
+        # Identical prompts are sent as plain strings; differing prompts as
+        # per-image lists, which WebUI expands to one prompt per image
+        prompt = prompts[0] if len(set(prompts)) == 1 else list(prompts)
+        negative_prompt = negative_prompts[0] if len(set(negative_prompts)) == 1 else list(negative_prompts)
+        
+        try:
+            endpoint, payload = self._build_payload(
+                prompt, negative_prompt, width, height, cfg_scale, steps,
+                sampler_name, seed, reference_image_path, denoising_strength, checkpoint,
+                control_image_path
+            )
+            
+            def image_key(i: int, image_seed: int) -> Optional[str]:
+                single = dict(payload, prompt=prompts[i], negative_prompt=negative_prompts[i], seed=image_seed)
+                return result_cache.make_key(single, reference_image_path)
+            
+            cache_keys = [image_key(i, s) for i, s in enumerate(expected_seeds)]
+        except Exception as e:
+            print(f"Error processing reference image: {e}")
+            if raise_errors:
+                raise SDPermanentError(f"Error processing reference image: {e}") from e
+            return [(None, s) for s in expected_seeds]
+        
+        cached = [result_cache.get(key) for key in cache_keys]
+        if all(image_data is not None for image_data in cached):
+            return list(zip(cached, expected_seeds))
+        
+        batch_payload = dict(payload, batch_size=count // n_iter, n_iter=n_iter, do_not_save_grid=True)
+        
+        try:
+            try:
+                response = self._post_generate(endpoint, batch_payload, steps, count)
+            except SDPermanentError as e:
+                if e.status_code != 422 or not (isinstance(prompt, list) or isinstance(negative_prompt, list)):
+                    raise
+                # This WebUI build rejects per-image prompts; fall back to single requests
+                print("Batch prompts rejected by SD WebUI, generating images one by one")
+                return [
+                    (self.generate_image(p, n, width, height, cfg_scale, steps, sampler_name,
+                                         s, reference_image_path, denoising_strength,
+                                         checkpoint=checkpoint, raise_errors=raise_errors,
+                                         control_image_path=control_image_path), s)
+                    for p, n, s in zip(prompts, negative_prompts, expected_seeds)
+                ]
+            
+            decode_start = time.perf_counter()
+            try:
+                result = response.json()
+            except ValueError as e:
+                raise SDPermanentError(f"Error parsing API response: {e}") from e
+            images = result.get('images') or []
+            # A grid image may be prepended to the batch; keep the last `count` images
+            images = images[-count:]
+            
+            try:
+                info = json.loads(result.get('info') or '{}')
+                seeds = [int(s) for s in info.get('all_seeds', [])][:count]
+            except (ValueError, TypeError):
+                seeds = []
+            if len(seeds) != count:
+                seeds = expected_seeds
+            
+            decoded = [base64.b64decode(image) for image in images]
+            self._record_timing(decode=time.perf_counter() - decode_start)
+            
+            if len(decoded) < count:
+                print(f"Expected {count} images in response, got {len(decoded)}")
+                decoded += [None] * (count - len(decoded))
+            for i, (image_data, image_seed) in enumerate(zip(decoded, seeds)):
+                if image_data is not None and cached[i] is None:
+                    key = cache_keys[i] if image_seed == expected_seeds[i] else image_key(i, image_seed)
+                    result_cache.put(key, image_data)
+            return list(zip(decoded, seeds))
+            
+        except SDAPIError as e:
+            print(f"Error calling Stable Diffusion API: {e}")
+            if raise_errors:
+                raise
+        except Exception as e:
+            print(f"Unexpected error: {e}")
+            if raise_errors:
+                raise SDPermanentError(f"Unexpected error: {e}") from e
+        return [(None, s) for s in expected_seeds]
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Hit/miss counters of the reference and result caches"""
+        return {
+            'reference': reference_cache.get_stats(),
+            'result': result_cache.get_stats()
+        }
+    
     def get_available_samplers(self) -> list:
         """Get list of available samplers from SD WebUI"""
         try:
-            response = requests.get(f"{self.base_url}/sdapi/v1/samplers", timeout=10)
+            response = self._request('GET', f"{self.base_url}/sdapi/v1/samplers", 'query')
             response.raise_for_status()
             return response.json()
         except Exception as e:
@@ -101,7 +619,7 @@ class StableDiffusionAPI:
     def test_connection(self) -> bool:
         """Test connection to SD WebUI"""
         try:
-            response = requests.get(f"{self.base_url}/", timeout=5)
+            response = self._request('GET', f"{self.base_url}/", 'health')
             return response.status_code == 200
         except:
             return False
@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import json
+import os
+import random
+from typing import Optional, Dict, Any, Tuple
+import aiohttp
+from dotenv import load_dotenv
+
+from .sd_api import (
+    SDAPIError, SDTransientError, SDPermanentError, SDCircuitOpenError, TRANSIENT_STATUS_CODES,
+    StableDiffusionAPI, model_key
+)
+from .sd_backend_pool import SDBackendPool, SDBackend
+from .sd_cache import result_cache
+
+load_dotenv()
+
+class AsyncStableDiffusionAPI:
+    """asyncio counterpart of SDBackendPool.generate_image.
+    
+    Each call reserves a backend from the pool (least loaded, model
+    affinity, ejection), serves seeded repeats from the shared result cache,
+    and goes through that backend's circuit breaker and retry policy, so an
+    event loop can drive many generations with the same semantics as the
+    workflow's threads. Requests run on one aiohttp session whose connector
+    limit (SD_ASYNC_MAX_CONNECTIONS) bounds in-flight calls. Cancelling a
+    call closes its connection and releases the backend without counting a
+    failure; with SD_INTERRUPT_ON_CANCEL the backend's current job is
+    interrupted as well, which is only safe when nothing else shares it."""
+    
+    def __init__(self, pool: SDBackendPool):
+        self.pool = pool
+        self.max_connections = int(os.getenv('SD_ASYNC_MAX_CONNECTIONS', 100))
+        self.interrupt_on_cancel = os.getenv('SD_INTERRUPT_ON_CANCEL', 'false').lower() not in ('0', 'false', 'no')
+        
+        self._session: Optional[aiohttp.ClientSession] = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, *exc_info):
+        await self.close()
+    
+    @staticmethod
+    def _timeout(api: StableDiffusionAPI, timeout_key: str) -> aiohttp.ClientTimeout:
+        connect, read = api.timeouts[timeout_key]
+        return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+    
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Create the session lazily so it binds to the running event loop"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                force_close=not self.pool.backends[0].api.keep_alive
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+    
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+    
+    async def _acquire(self, model: str) -> SDBackend:
+        """pool.acquire off the loop (it may wait for an ejected backend to be re-admitted)"""
+        acquiring = asyncio.ensure_future(asyncio.to_thread(self.pool.acquire, model))
+        try:
+            return await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            # The thread cannot be stopped; hand its reservation back once it lands
+            acquiring.add_done_callback(
+                lambda future: future.cancelled() or future.exception() or self.pool.release(future.result(), True)
+            )
+            raise
+    
+    async def _post_generate(self, api: StableDiffusionAPI, endpoint: str, payload: Dict[str, Any],
+                             steps: int) -> Dict[str, Any]:
+        """POST with the backend's retries and circuit breaker; the decoded JSON response"""
+        attempt = 0
+        while True:
+            if not await api.breaker.wait_for_permission_async():
+                raise SDCircuitOpenError(f"Circuit open for {api.base_url}")
+            try:
+                with api.progress.track(steps):
+                    async with self._get_session().post(
+                        endpoint, json=payload, timeout=self._timeout(api, 'generate')
+                    ) as response:
+                        body = await response.read()
+                        status = response.status
+                if status >= 400:
+                    error_class = SDTransientError if status in TRANSIENT_STATUS_CODES else SDPermanentError
+                    raise error_class(f"HTTP {status}: {body[:200]!r}", status)
+                try:
+                    result = json.loads(body)
+                except ValueError as e:
+                    raise SDPermanentError(f"Error parsing API response: {e}") from e
+            except (aiohttp.ClientError, asyncio.TimeoutError, SDAPIError) as e:
+                error = e if isinstance(e, SDAPIError) else SDTransientError(f"{type(e).__name__}: {e}")
+                if not error.transient:
+                    # The server answered, so it is up even if the request was bad
+                    api.breaker.record_success()
+                    api._count('permanent_errors')
+                    raise error from e
+                
+                api.breaker.record_failure()
+                api._count('transient_errors')
+                if attempt >= api.max_retries:
+                    api._count('gave_up')
+                    raise error from e
+                
+                attempt += 1
+                api._count('retries')
+                delay = random.uniform(0, min(api.retry_cap, api.retry_base * 2 ** (attempt - 1)))
+                print(f"Transient SD error ({error}), retry {attempt}/{api.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            
+            api.breaker.record_success()
+            return result
+    
+    async def _generate_on(self, backend: SDBackend, prompt: str, negative_prompt: str, width: int, height: int,
+                           cfg_scale: float, steps: int, sampler_name: str, seed: int,
+                           reference_image_path: Optional[str], denoising_strength: float,
+                           checkpoint: Optional[str], control_image_path: Optional[str]) -> bytes:
+        api = backend.api
+        
+        def prepare() -> Tuple[str, Dict[str, Any], Optional[str]]:
+            endpoint, payload = api._build_payload(
+                prompt, negative_prompt, width, height, cfg_scale, steps, sampler_name, seed,
+                reference_image_path, denoising_strength, checkpoint, control_image_path
+            )
+            return endpoint, payload, result_cache.make_key(payload, reference_image_path)
+        
+        try:
+            # Reading, encoding and hashing the reference image is blocking file/CPU work
+            endpoint, payload, cache_key = await asyncio.to_thread(prepare)
+        except Exception as e:
+            raise SDPermanentError(f"Error processing reference image: {e}") from e
+        
+        cached = await asyncio.to_thread(result_cache.get, cache_key)
+        if cached is not None:
+            return cached
+        
+        result = await self._post_generate(api, endpoint, payload, steps)
+        if not result.get('images'):
+            raise SDPermanentError("No images in response")
+        image_data = base64.b64decode(result['images'][0])
+        await asyncio.to_thread(result_cache.put, cache_key, image_data)
+        return image_data
+    
+    async def generate_image(self, prompt: str, negative_prompt: str = "",
+                             width: int = 370, height: int = 320,
+                             cfg_scale: float = 7.0, steps: int = 30,
+                             sampler_name: str = "DPM++ 2M Karras",
+                             seed: int = -1, reference_image_path: Optional[str] = None,
+                             denoising_strength: float = 0.6,
+                             checkpoint: Optional[str] = None,
+                             raise_errors: bool = False,
+                             control_image_path: Optional[str] = None) -> Optional[bytes]:
+        """Generate an image on the pool without blocking the event loop.
+        
+        Returns None on failure, or raises the classified SDAPIError when
+        raise_errors is set."""
+        backend = await self._acquire(model_key(prompt, checkpoint))
+        success = False
+        try:
+            image_data = await self._generate_on(
+                backend, prompt, negative_prompt, width, height, cfg_scale, steps, sampler_name, seed,
+                reference_image_path, denoising_strength, checkpoint, control_image_path
+            )
+            success = True
+            return image_data
+        except asyncio.CancelledError:
+            # Nobody is waiting any more; that says nothing about the backend's health
+            success = True
+            if self.interrupt_on_cancel:
+                # Stop the WebUI from finishing a job nobody is waiting for
+                await asyncio.shield(self.interrupt(backend))
+            raise
+        except SDAPIError as e:
+            # The backend answered; the request itself was bad
+            success = not e.transient
+            print(f"Error calling Stable Diffusion API: {e}")
+            if raise_errors:
+                raise
+            return None
+        finally:
+            self.pool.release(backend, success)
+    
+    async def interrupt(self, backend: SDBackend) -> bool:
+        """Ask a backend's WebUI to abort the job it is currently running"""
+        try:
+            async with self._get_session().post(
+                f"{backend.url}/sdapi/v1/interrupt", timeout=self._timeout(backend.api, 'query')
+            ) as response:
+                return response.status == 200
+        except Exception as e:
+            print(f"Error interrupting SD job: {e}")
+            return False
+    
+    async def test_connection(self) -> bool:
+        """True if at least one backend answers"""
+        for backend in self.pool.backends:
+            try:
+                async with self._get_session().get(
+                    f"{backend.url}/", timeout=self._timeout(backend.api, 'health')
+                ) as response:
+                    if response.status == 200:
+                        return True
+            except Exception:
+                continue
+        return False
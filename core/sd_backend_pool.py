@@ -0,0 +1,243 @@
+import os
+import threading
+import time
+from typing import Optional, Dict, Any, List, Set
+from dotenv import load_dotenv
+
+from .sd_api import StableDiffusionAPI, SDPermanentError, model_key
+from .sd_progress import progress_registry
+
+load_dotenv()
+
+class SDBackend:
+    """One SD WebUI instance and its dispatch state"""
+    def __init__(self, url: str):
+        self.url = url
+        self.api = StableDiffusionAPI(url)
+        self.healthy = True
+        self.outstanding = 0
+        self.consecutive_failures = 0
+        self.completed = 0
+        self.failed = 0
+        self.ejected_at: Optional[float] = None
+        self.loaded_model: Optional[str] = None
+        self.model_switches = 0
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'healthy': self.healthy,
+            'outstanding': self.outstanding,
+            'consecutive_failures': self.consecutive_failures,
+            'completed': self.completed,
+            'failed': self.failed,
+            'ejected_at': self.ejected_at,
+            'breaker': self.api.breaker.get_stats()['state'],
+            'loaded_model': self.loaded_model,
+            'model_switches': self.model_switches
+        }
+
+class SDBackendPool:
+    """Load-balance SD requests across several WebUI instances.
+    
+    Requests go to the healthy backend with the fewest outstanding requests.
+    A backend is ejected after repeated request failures or a failed health
+    probe, and re-admitted once a probe succeeds again. Backends whose circuit
+    breaker is open are skipped while any other backend is available, and among
+    equally loaded backends one that already has the request's checkpoint and
+    LoRA set loaded is preferred. The pool exposes the
+    same generation methods as StableDiffusionAPI so callers can use either."""
+    
+    def __init__(self, urls: Optional[List[str]] = None):
+        if urls is None:
+            urls_env = os.getenv('SD_WEBUI_URLS') or os.getenv('SD_WEBUI_URL', 'http://localhost:7860')
+            urls = [url.strip() for url in urls_env.split(',') if url.strip()]
+        if not urls:
+            raise ValueError("At least one SD WebUI URL is required")
+        
+        self.backends = [SDBackend(url) for url in urls]
+        for backend in self.backends:
+            progress_registry.register_monitor(backend.api.progress)
+        self.health_interval = float(os.getenv('SD_HEALTH_INTERVAL', 30))
+        self.max_failures = int(os.getenv('SD_MAX_FAILURES', 3))
+        
+        self._cond = threading.Condition()
+        self._stop_event = threading.Event()
+        self._health_thread: Optional[threading.Thread] = None
+    
+    @property
+    def base_url(self) -> str:
+        return self.backends[0].url
+    
+    # Health management
+    
+    def start_health_checks(self):
+        """Start the background health probe thread"""
+        if self._health_thread and self._health_thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._health_thread = threading.Thread(target=self._health_loop, daemon=True)
+        self._health_thread.start()
+    
+    def stop_health_checks(self):
+        """Stop the background health probe thread"""
+        self._stop_event.set()
+    
+    def _health_loop(self):
+        while not self._stop_event.wait(self.health_interval):
+            self.probe()
+    
+    def probe(self) -> int:
+        """Probe every backend once; returns the number of healthy backends"""
+        for backend in self.backends:
+            ok = backend.api.test_connection()
+            with self._cond:
+                if ok:
+                    if not backend.healthy:
+                        print(f"SD backend re-admitted: {backend.url}")
+                    backend.healthy = True
+                    backend.consecutive_failures = 0
+                    backend.ejected_at = None
+                    self._cond.notify_all()
+                elif backend.healthy:
+                    self._eject(backend, "health probe failed")
+        return len(self.healthy_backends())
+    
+    def _eject(self, backend: SDBackend, reason: str):
+        """Mark a backend unhealthy (caller holds the lock)"""
+        backend.healthy = False
+        backend.ejected_at = time.time()
+        print(f"SD backend ejected ({reason}): {backend.url}")
+    
+    def healthy_backends(self) -> List[SDBackend]:
+        with self._cond:
+            return [backend for backend in self.backends if backend.healthy]
+    
+    def idle_loaded_models(self) -> Set[str]:
+        """Models loaded on healthy backends with nothing in flight, i.e. where the next request goes"""
+        with self._cond:
+            return {
+                backend.loaded_model for backend in self.backends
+                if backend.healthy and backend.outstanding == 0 and backend.loaded_model
+            }
+    
+    def capacity(self) -> int:
+        """Number of backends requests can currently be fanned out to"""
+        return max(1, len(self.healthy_backends()))
+    
+    # Dispatch
+    
+    def acquire(self, model: Optional[str] = None) -> SDBackend:
+        """Reserve the healthy backend with the fewest outstanding requests.
+        
+        If every backend is ejected, wait up to one health interval for a
+        re-admission, then fall back to the least-failing backend so the
+        caller gets a real error instead of hanging."""
+        deadline = time.time() + self.health_interval
+        with self._cond:
+            while True:
+                healthy = [backend for backend in self.backends if backend.healthy]
+                if healthy:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    healthy = [min(self.backends, key=lambda b: b.consecutive_failures)]
+                    break
+                self._cond.wait(remaining)
+            
+            # Prefer backends that are not cooling down behind an open breaker
+            closed = [backend for backend in healthy if not backend.api.breaker.is_open()]
+            backend = min(closed or healthy, key=lambda b: (
+                b.outstanding, model is not None and b.loaded_model != model, b.completed
+            ))
+            backend.outstanding += 1
+            if model is not None:
+                if backend.loaded_model not in (None, model):
+                    backend.model_switches += 1
+                backend.loaded_model = model
+            return backend
+    
+    def release(self, backend: SDBackend, success: bool):
+        """Return a backend reserved with acquire and record the outcome"""
+        with self._cond:
+            backend.outstanding -= 1
+            if success:
+                backend.completed += 1
+                backend.consecutive_failures = 0
+            else:
+                backend.failed += 1
+                backend.consecutive_failures += 1
+                if backend.healthy and backend.consecutive_failures >= self.max_failures:
+                    self._eject(backend, f"{backend.consecutive_failures} consecutive failures")
+            self._cond.notify_all()
+    
+    # StableDiffusionAPI interface
+    
+    @staticmethod
+    def _model_for(prompt, kwargs: Dict[str, Any]) -> str:
+        return model_key(prompt, kwargs.get('checkpoint'))
+    
+    def generate_image(self, prompt: str, *args, **kwargs) -> Optional[bytes]:
+        """Generate one image on the least-loaded healthy backend"""
+        backend = self.acquire(self._model_for(prompt, kwargs))
+        success = False
+        try:
+            image_data = backend.api.generate_image(prompt, *args, **kwargs)
+            success = image_data is not None
+            return image_data
+        except SDPermanentError:
+            # The backend answered; the request itself was bad
+            success = True
+            raise
+        finally:
+            self.release(backend, success)
+    
+    def generate_batch(self, prompts: List[str], *args, **kwargs) -> list:
+        """Generate a batch on the least-loaded healthy backend"""
+        backend = self.acquire(self._model_for(prompts, kwargs))
+        success = False
+        try:
+            results = backend.api.generate_batch(prompts, *args, **kwargs)
+            success = any(image_data for image_data, _ in results)
+            return results
+        except SDPermanentError:
+            success = True
+            raise
+        finally:
+            self.release(backend, success)
+    
+    def get_available_samplers(self) -> list:
+        for backend in self.healthy_backends() or self.backends:
+            samplers = backend.api.get_available_samplers()
+            if samplers:
+                return samplers
+        return []
+    
+    def test_connection(self) -> bool:
+        """True if at least one backend answers"""
+        return self.probe() > 0
+    
+    def close(self):
+        self.stop_health_checks()
+        for backend in self.backends:
+            backend.api.close()
+    
+    def get_status(self) -> List[Dict[str, Any]]:
+        """Dispatch and health state of every backend"""
+        with self._cond:
+            return [backend.to_dict() for backend in self.backends]
+    
+    def set_stall_callback(self, callback):
+        """Call callback(url, snapshot) when a backend's progress stops moving"""
+        for backend in self.backends:
+            backend.api.progress.on_stall = callback
+    
+    def get_cache_stats(self) -> Dict[str, Any]:
+        # Caches are process-wide, so any backend reports the same numbers
+        return self.backends[0].api.get_cache_stats()
+    
+    def get_transport_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {backend.url: backend.api.get_transport_stats() for backend in self.backends}
+    
+    def get_resilience_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {backend.url: backend.api.get_resilience_stats() for backend in self.backends}
@@ -0,0 +1,257 @@
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Any
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+class ReferenceImageCache:
+    """LRU cache of reference images, ready to send as img2img init_images.
+    
+    Entries are keyed by path, mtime, file size and target size, so editing or
+    replacing the reference file naturally misses and the stale entry ages out.
+    The cache stores the final base64 string and is capped by its total size."""
+    
+    def __init__(self, max_bytes: Optional[int] = None):
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('SD_REFERENCE_CACHE_MB', 64)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[tuple, str]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def _key(path: str, width: int, height: int) -> tuple:
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, width, height)
+    
+    @staticmethod
+    def _encode(path: str, width: int, height: int) -> str:
+        """Open, convert to RGB, resize and base64-encode a reference image"""
+        with Image.open(path) as img:
+            # Convert to RGB if necessary
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            
+            # Resize to target dimensions
+            img = img.resize((width, height), Image.Resampling.LANCZOS)
+            
+            # Convert to bytes
+            img_bytes = io.BytesIO()
+            img.save(img_bytes, format='PNG')
+            return base64.b64encode(img_bytes.getvalue()).decode()
+    
+    def get_encoded(self, path: str, width: int, height: int) -> str:
+        """Base64 PNG of the reference image resized to width x height"""
+        key = self._key(path, width, height)
+        with self._lock:
+            encoded = self._entries.get(key)
+            if encoded is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+        
+        # Encode outside the lock; concurrent misses for the same key are harmless
+        encoded = self._encode(path, width, height)
+        self._put(key, encoded)
+        return encoded
+    
+    def _put(self, key: tuple, encoded: str):
+        size = len(encoded)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = encoded
+            self._size += size
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+class GenerationResultCache:
+    """Disk-backed, content-addressed cache of generated images.
+    
+    The key is a hash of everything that determines the output: prompt,
+    negative prompt, seed, sampler, steps, cfg, size, denoising strength, the
+    reference image content and LoRA tags. Requests with a random seed (-1)
+    are never cached. Files are evicted least-recently-used first once the
+    cache directory exceeds its size budget."""
+    
+    # Payload fields that do not affect the generated image
+    IGNORED_FIELDS = ('init_images', 'save_images', 'send_images')
+    LORA_PATTERN = re.compile(r'<lora:([^:>]+)(?::([^>]*))?>')
+    
+    def __init__(self, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.enabled = os.getenv('SD_RESULT_CACHE', 'true').lower() not in ('0', 'false', 'no')
+        self.cache_dir = Path(cache_dir or os.getenv('SD_RESULT_CACHE_DIR', './data/sd_cache'))
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('SD_RESULT_CACHE_MB', 1024)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        
+        self._lock = threading.Lock()
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # key -> file size, oldest first
+        self._size = 0
+        self._loaded = False
+        self._file_hashes: Dict[tuple, str] = {}
+        
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+    
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.png"
+    
+    def _load_index(self):
+        """Scan the cache directory once, ordering entries by last use (caller holds the lock)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.cache_dir.exists():
+            return
+        entries = []
+        for path in self.cache_dir.glob('*/*.png'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, path.stem, stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._size += size
+    
+    def file_hash(self, path: str) -> str:
+        """SHA-256 of a file, memoized by path, mtime and size"""
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            digest = self._file_hashes.get(memo_key)
+        if digest is None:
+            # Hash outside the lock; concurrent callers at worst hash the same file twice
+            with open(path, 'rb') as f:
+                digest = hashlib.sha256(f.read()).hexdigest()
+            with self._lock:
+                self._file_hashes[memo_key] = digest
+        return digest
+    
+    def make_key(self, payload: Dict[str, Any], reference_image_path: Optional[str] = None) -> Optional[str]:
+        """Cache key for an SD payload, or None if the result is not reproducible"""
+        if not self.enabled or payload.get('seed', -1) == -1:
+            return None
+        
+        material = {k: v for k, v in payload.items() if k not in self.IGNORED_FIELDS}
+        prompts = payload.get('prompt', '')
+        prompts = prompts if isinstance(prompts, list) else [prompts]
+        material['lora'] = sorted({m.group(0) for p in prompts for m in self.LORA_PATTERN.finditer(p)})
+        if 'init_images' in payload:
+            if not reference_image_path:
+                return None
+            material['reference_sha256'] = self.file_hash(reference_image_path)
+        
+        canonical = json.dumps(material, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+    
+    def get(self, key: Optional[str]) -> Optional[bytes]:
+        """Cached image bytes for key, or None on a miss"""
+        if key is None:
+            return None
+        path = self._path(key)
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # Keep LRU order across restarts
+        except OSError:
+            with self._lock:
+                self._forget(key)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+    
+    def put(self, key: Optional[str], data: bytes):
+        """Store image bytes under key and evict old entries beyond the budget"""
+        if key is None or not data or len(data) > self.max_bytes:
+            return
+        path = self._path(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Error writing SD result cache: {e}")
+            return
+        
+        with self._lock:
+            self._load_index()
+            self._forget(key)
+            self._index[key] = len(data)
+            self._size += len(data)
+            self.stores += 1
+            while self._size > self.max_bytes and self._index:
+                old_key = next(iter(self._index))
+                self._forget(old_key)
+                self.evictions += 1
+                try:
+                    self._path(old_key).unlink()
+                except OSError:
+                    pass
+    
+    def _forget(self, key: str):
+        """Drop key from the index (caller holds the lock)"""
+        size = self._index.pop(key, None)
+        if size is not None:
+            self._size -= size
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._load_index()
+            lookups = self.hits + self.misses
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._index),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions
+            }
+
+# Shared by every StableDiffusionAPI instance in the process
+reference_cache = ReferenceImageCache()
+result_cache = GenerationResultCache()
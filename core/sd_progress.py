@@ -0,0 +1,235 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Callable, List
+from dotenv import load_dotenv
+
+load_dotenv()
+
+class ProgressMonitor:
+    """Poll a WebUI's /sdapi/v1/progress endpoint while requests are in flight.
+    
+    Polling starts with the first tracked request and stops when the last one
+    finishes. The latest snapshot carries step progress, the WebUI's ETA, a
+    live it/s estimate and a stall flag raised when progress stops moving."""
+    
+    def __init__(self, base_url: str, session_getter: Callable, timeout: tuple = (3.0, 5.0)):
+        self.base_url = base_url
+        self._get_session = session_getter
+        self.timeout = timeout
+        self.poll_interval = float(os.getenv('SD_PROGRESS_INTERVAL', 1.0))
+        self.stall_seconds = float(os.getenv('SD_STALL_SECONDS', 60))
+        self.on_stall: Optional[Callable[[str, Dict[str, Any]], None]] = None
+        
+        self._lock = threading.Lock()
+        self._active = 0
+        self._thread: Optional[threading.Thread] = None
+        self._snapshot: Dict[str, Any] = self._idle_snapshot()
+        self._last_sample: Optional[tuple] = None  # (time, job_no, step)
+        self._last_change = time.time()
+        self._stall_reported = False
+        self.last_stamp_it_per_sec: Optional[float] = None
+    
+    @staticmethod
+    def _idle_snapshot() -> Dict[str, Any]:
+        return {
+            'active': False,
+            'progress': 0.0,
+            'eta_seconds': None,
+            'step': 0,
+            'steps': 0,
+            'job_no': 0,
+            'job_count': 0,
+            'it_per_sec': None,
+            'stalled': False
+        }
+    
+    @contextmanager
+    def track(self, steps: int, images: int = 1):
+        """Monitor progress for the duration of one generation request"""
+        with self._lock:
+            self._active += 1
+            if self._active == 1:
+                self._last_sample = None
+                self._last_change = time.time()
+                self._stall_reported = False
+                self._snapshot = dict(self._idle_snapshot(), active=True)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._poll_loop, daemon=True)
+                self._thread.start()
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._active -= 1
+                if elapsed > 0:
+                    # End-to-end sampling rate including queueing and transfer
+                    self.last_stamp_it_per_sec = steps * images / elapsed
+                if self._active == 0:
+                    self._snapshot = dict(self._idle_snapshot(), it_per_sec=self._snapshot.get('it_per_sec'))
+    
+    def _poll_loop(self):
+        while True:
+            with self._lock:
+                if self._active == 0:
+                    # Decided and cleared under the lock track() starts pollers
+                    # with, so a request arriving now always gets a new one
+                    self._thread = None
+                    return
+            try:
+                response = self._get_session().get(
+                    f"{self.base_url}/sdapi/v1/progress",
+                    params={'skip_current_image': 'true'},
+                    timeout=self.timeout
+                )
+                if response.status_code == 200:
+                    self._update(response.json())
+            except Exception as e:
+                print(f"Error polling SD progress: {e}")
+            self._check_stall()
+            time.sleep(self.poll_interval)
+    
+    def _update(self, data: Dict[str, Any]):
+        state = data.get('state') or {}
+        now = time.time()
+        step = int(state.get('sampling_step') or 0)
+        job_no = int(state.get('job_no') or 0)
+        
+        with self._lock:
+            if self._active == 0:
+                return
+            it_per_sec = self._snapshot.get('it_per_sec')
+            if self._last_sample is not None:
+                last_time, last_job, last_step = self._last_sample
+                if job_no == last_job and step > last_step and now > last_time:
+                    rate = (step - last_step) / (now - last_time)
+                    # Smooth over poll jitter
+                    it_per_sec = rate if it_per_sec is None else 0.7 * it_per_sec + 0.3 * rate
+            if self._last_sample is None or (job_no, step) != self._last_sample[1:]:
+                self._last_change = now
+                self._stall_reported = False
+            self._last_sample = (now, job_no, step)
+            
+            self._snapshot = {
+                'active': True,
+                'progress': float(data.get('progress') or 0.0),
+                'eta_seconds': data.get('eta_relative'),
+                'step': step,
+                'steps': int(state.get('sampling_steps') or 0),
+                'job_no': job_no,
+                'job_count': int(state.get('job_count') or 0),
+                'it_per_sec': it_per_sec,
+                'stalled': False
+            }
+    
+    def _check_stall(self):
+        with self._lock:
+            if self._active == 0 or time.time() - self._last_change < self.stall_seconds:
+                return
+            self._snapshot['stalled'] = True
+            if self._stall_reported:
+                return
+            self._stall_reported = True
+            snapshot = dict(self._snapshot)
+        print(f"SD generation appears stalled on {self.base_url}")
+        if self.on_stall:
+            try:
+                self.on_stall(self.base_url, snapshot)
+            except Exception as e:
+                print(f"Error in stall callback: {e}")
+    
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            snapshot = dict(self._snapshot)
+            snapshot['last_stamp_it_per_sec'] = self.last_stamp_it_per_sec
+            return snapshot
+
+class GenerationProgressRegistry:
+    """Process-wide view of running generations for the workflow, web API and Slack"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sets: Dict[str, Dict[str, Any]] = {}
+        self._monitors: Dict[str, ProgressMonitor] = {}
+    
+    def register_monitor(self, monitor: ProgressMonitor):
+        with self._lock:
+            self._monitors[monitor.base_url] = monitor
+    
+    def start(self, set_id: str, stage: str, total: int, done: int = 0):
+        with self._lock:
+            self._sets[set_id] = {
+                'set_id': set_id,
+                'stage': stage,
+                'total': total,
+                'done': done,
+                'initial_done': done,
+                'started_at': time.time(),
+                'finished_at': None
+            }
+    
+    def update(self, set_id: str, done: int):
+        with self._lock:
+            if set_id in self._sets:
+                self._sets[set_id]['done'] = done
+    
+    def finish(self, set_id: str):
+        with self._lock:
+            if set_id in self._sets:
+                self._sets[set_id]['finished_at'] = time.time()
+    
+    def _summarize(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        summary = dict(entry)
+        end = entry['finished_at'] or time.time()
+        elapsed = end - entry['started_at']
+        rendered = entry['done'] - entry['initial_done']
+        remaining = entry['total'] - entry['done']
+        summary['elapsed_seconds'] = elapsed
+        summary['seconds_per_stamp'] = elapsed / rendered if rendered else None
+        summary['eta_seconds'] = (
+            summary['seconds_per_stamp'] * remaining if rendered and not entry['finished_at'] else None
+        )
+        return summary
+    
+    def get(self, set_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._sets.get(set_id)
+            if entry is None:
+                return None
+            summary = self._summarize(entry)
+        summary['backends'] = self.get_backend_snapshots()
+        return summary
+    
+    def get_all(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            summaries = [self._summarize(entry) for entry in self._sets.values()]
+        return summaries
+    
+    def get_backend_snapshots(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            monitors = list(self._monitors.values())
+        return {monitor.base_url: monitor.snapshot() for monitor in monitors}
+
+progress_registry = GenerationProgressRegistry()
+
+def format_progress(summary: Dict[str, Any]) -> str:
+    """Human readable progress line for Slack"""
+    text = f"{summary['done']}/{summary['total']}枚完了"
+    details = []
+    if summary.get('eta_seconds') is not None:
+        minutes, seconds = divmod(int(summary['eta_seconds']), 60)
+        details.append(f"残り約{minutes}分{seconds:02d}秒")
+    rates = [
+        snapshot['it_per_sec'] for snapshot in summary.get('backends', {}).values()
+        if snapshot.get('it_per_sec')
+    ]
+    if rates:
+        details.append(f"{sum(rates):.1f} it/s")
+    if any(snapshot.get('stalled') for snapshot in summary.get('backends', {}).values()):
+        details.append("⚠️ 停止中のGPUあり")
+    if details:
+        text += f" ({', '.join(details)})"
+    return text
@@ -0,0 +1,121 @@
+import os
+from typing import Optional, List, Tuple
+from PIL import Image, ImageChops, ImageColor, ImageDraw, ImageFilter
+
+Color = Tuple[int, int, int, int]
+
+def parse_color(value: str) -> Color:
+    """'#rrggbb', '#rrggbbaa' or a CSS colour name as RGBA"""
+    color = ImageColor.getcolor(value.strip(), 'RGBA')
+    return tuple(color)
+
+class TextStyle:
+    """Fill, outline, drop shadow and optional vertical gradient for a caption"""
+    
+    def __init__(self, fill: Color = (255, 255, 255, 255), outline: Color = (0, 0, 0, 255),
+                 outline_width: int = 2, outline_method: str = 'dilate',
+                 shadow: Optional[Color] = None, shadow_offset: Tuple[int, int] = (3, 3),
+                 shadow_blur: float = 2.0, gradient: Optional[Tuple[Color, Color]] = None):
+        if outline_method not in ('dilate', 'stroke'):
+            raise ValueError(f"Unsupported outline method: {outline_method} (choose from dilate, stroke)")
+        self.fill = fill
+        self.outline = outline
+        self.outline_width = max(0, outline_width)
+        self.outline_method = outline_method
+        self.shadow = shadow
+        self.shadow_offset = shadow_offset
+        self.shadow_blur = max(0.0, shadow_blur)
+        self.gradient = gradient
+    
+    @classmethod
+    def from_env(cls) -> "TextStyle":
+        """Style from TEXT_* environment variables"""
+        shadow = os.getenv('TEXT_SHADOW', '')
+        gradient = os.getenv('TEXT_GRADIENT', '')
+        return cls(
+            fill=parse_color(os.getenv('TEXT_FILL', '#ffffff')),
+            outline=parse_color(os.getenv('TEXT_OUTLINE', '#000000')),
+            outline_width=int(os.getenv('TEXT_OUTLINE_WIDTH', 2)),
+            outline_method=os.getenv('TEXT_OUTLINE_METHOD', 'dilate').lower(),
+            shadow=parse_color(shadow) if shadow else None,
+            shadow_blur=float(os.getenv('TEXT_SHADOW_BLUR', 2.0)),
+            gradient=tuple(parse_color(c) for c in gradient.split(',', 1)) if ',' in gradient else None
+        )
+    
+    def padding(self) -> int:
+        """Margin the outline and shadow need around the glyph box"""
+        pad = self.outline_width
+        if self.shadow is not None:
+            pad += max(abs(self.shadow_offset[0]), abs(self.shadow_offset[1])) + int(self.shadow_blur * 3 + 0.5)
+        return pad + 1
+
+def _colored(size: Tuple[int, int], color: Color, mask: Image.Image) -> Image.Image:
+    """Solid colour layer whose alpha is mask scaled by the colour's own alpha"""
+    layer = Image.new('RGBA', size, color[:3] + (0,))
+    alpha = color[3]
+    layer.putalpha(mask if alpha == 255 else mask.point(lambda v: v * alpha // 255))
+    return layer
+
+def _gradient(size: Tuple[int, int], top: Color, bottom: Color, y0: int, height: int) -> Image.Image:
+    """Vertical gradient from top to bottom over rows y0 .. y0 + height"""
+    ramp = Image.new('L', size, 0)
+    ramp.paste(Image.linear_gradient('L').resize((size[0], max(1, height))), (0, y0))
+    ramp.paste(255, (0, y0 + max(1, height), size[0], size[1]))
+    return Image.composite(Image.new('RGBA', size, bottom), Image.new('RGBA', size, top), ramp)
+
+def render_text_layer(text: str, font, style: TextStyle) -> Tuple[Image.Image, Tuple[int, int]]:
+    """RGBA layer with the styled caption and the position of the text origin inside it"""
+    left, top, right, bottom = font.getbbox(text)
+    pad = style.padding()
+    size = (right - left + 2 * pad, bottom - top + 2 * pad)
+    origin = (pad - left, pad - top)
+    
+    # The single FreeType rasterisation everything else is derived from
+    glyph = Image.new('L', size, 0)
+    ImageDraw.Draw(glyph).text(origin, text, font=font, fill=255)
+    
+    outline = glyph
+    if style.outline_width:
+        if style.outline_method == 'stroke':
+            outline = Image.new('L', size, 0)
+            ImageDraw.Draw(outline).text(origin, text, font=font, fill=255,
+                                         stroke_width=style.outline_width, stroke_fill=255)
+        else:
+            # Square dilation: the same footprint as drawing at every offset within the width
+            outline = glyph.filter(ImageFilter.MaxFilter(2 * style.outline_width + 1))
+    
+    layer = Image.new('RGBA', size, (0, 0, 0, 0))
+    if style.shadow is not None:
+        shadow = ImageChops.offset(outline, *style.shadow_offset)
+        if style.shadow_blur:
+            shadow = shadow.filter(ImageFilter.GaussianBlur(style.shadow_blur))
+        layer.alpha_composite(_colored(size, style.shadow, shadow))
+    if style.outline_width:
+        layer.alpha_composite(_colored(size, style.outline, outline))
+    
+    if style.gradient is not None:
+        fill = _gradient(size, style.gradient[0], style.gradient[1], pad, bottom - top)
+        fill.putalpha(ImageChops.multiply(fill.getchannel('A'), glyph))
+    else:
+        fill = _colored(size, style.fill, glyph)
+    layer.alpha_composite(fill)
+    return layer, origin
+
+def draw_text(img: Image.Image, xy: Tuple[int, int], text: str, font, style: TextStyle) -> Image.Image:
+    """Composite the styled caption onto an RGBA image in place, text origin at xy"""
+    layer, origin = render_text_layer(text, font, style)
+    x, y = xy[0] - origin[0], xy[1] - origin[1]
+    # alpha_composite rejects negative destinations; clip the layer instead
+    img.alpha_composite(layer, dest=(max(0, x), max(0, y)), source=(max(0, -x), max(0, -y)))
+    return img
+
+def draw_text_runs(img: Image.Image, xy: Tuple[int, int], runs: List[Tuple[str, object]],
+                   style: TextStyle) -> Image.Image:
+    """draw_text for a line made of (text, font) runs, e.g. a fallback face for emoji,
+    with every run on the first run's baseline"""
+    x, y = xy
+    ascent = runs[0][1].getmetrics()[0] if runs else 0
+    for text, font in runs:
+        draw_text(img, (int(x), y + ascent - font.getmetrics()[0]), text, font, style)
+        x += font.getlength(text)
+    return img
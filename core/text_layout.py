@@ -0,0 +1,176 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, Any, List, Tuple
+from dotenv import load_dotenv
+
+from .font_registry import FontRegistry
+
+load_dotenv()
+
+# Japanese line-breaking rules (kinsoku shori)
+# Characters that must not start a line: closing brackets, punctuation, small kana, prolonged sound mark
+NO_LINE_START = set(
+    "、。，．,.・：；:;？！?!‼⁇⁈⁉゛゜ヽヾゝゞ々〻ー―‐〜～…‥"
+    "）)］]｝}」』】〕〉》〙〗〟’”｠»"
+    "ぁぃぅぇぉっゃゅょゎゕゖァィゥェォッャュョヮヵヶㇰㇱㇲㇳㇴㇵㇶㇷㇸㇹㇺㇻㇼㇽㇾㇿ"
+)
+# Characters that must not end a line: opening brackets
+NO_LINE_END = set("（(［[｛{「『【〔〈《〘〖〝‘“｟«")
+
+def _is_word_char(char: str) -> bool:
+    """Half-width letters and digits, which are kept together as words"""
+    return char.isascii() and (char.isalnum() or char in "'-_")
+
+def split_units(text: str) -> List[str]:
+    """Break opportunities: each full-width character, each half-width word, each space"""
+    units: List[str] = []
+    for char in text:
+        if units and _is_word_char(char) and _is_word_char(units[-1][-1]):
+            units[-1] += char
+        else:
+            units.append(char)
+    return units
+
+class TextLayout:
+    """A phrase wrapped and sized to fit a box"""
+    
+    __slots__ = ('font', 'font_size', 'lines', 'line_runs', 'line_widths', 'line_height', 'width', 'height', 'fits')
+    
+    def __init__(self, font, font_size: int, lines: List[str], line_runs: List[List[Tuple[str, Any]]],
+                 line_widths: List[int], line_height: int, fits: bool):
+        self.font = font
+        self.line_runs = line_runs
+        self.font_size = font_size
+        self.lines = lines
+        self.line_widths = line_widths
+        self.line_height = line_height
+        self.width = max(line_widths) if line_widths else 0
+        self.height = line_height * len(lines)
+        self.fits = fits
+    
+    def positions(self, box_x: int, box_width: int, bottom: int) -> List[Tuple[int, int, List[Tuple[str, Any]]]]:
+        """(x, y, [(run, font), ...]) for each line, centred in the box and stacked up from bottom"""
+        top = bottom - self.height
+        return [
+            (box_x + (box_width - width) // 2, top + i * self.line_height, runs)
+            for i, (runs, width) in enumerate(zip(self.line_runs, self.line_widths))
+        ]
+
+class TextLayoutEngine:
+    """Fit captions by measuring, not by counting characters.
+    
+    A bounded binary search over font sizes finds the largest size at which
+    the phrase, wrapped with kinsoku rules into at most TEXT_MAX_LINES lines,
+    fits the box. Characters the primary face lacks (emoji, symbols) are
+    measured and drawn in the registry's fallback faces. Layouts are
+    memoised by (phrase, fonts, box), so re-rendering the same captions
+    across a set or its variations costs a dictionary lookup."""
+    
+    def __init__(self, registry: FontRegistry, min_size: Optional[int] = None, max_size: Optional[int] = None,
+                 max_lines: Optional[int] = None, line_spacing: float = 0.15, cache_size: int = 1024):
+        self.registry = registry
+        self.min_size = min_size or int(os.getenv('TEXT_MIN_SIZE', 14))
+        self.max_size = max(self.min_size, max_size or int(os.getenv('TEXT_MAX_SIZE', 40)))
+        self.max_lines = max(1, max_lines or int(os.getenv('TEXT_MAX_LINES', 2)))
+        self.line_spacing = line_spacing
+        self.cache_size = cache_size
+        
+        self._cache: "OrderedDict[tuple, TextLayout]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+        
+        # Fail early (and let the caller fall back) without a scalable font
+        if not hasattr(self.registry.get(self.min_size), 'getmetrics'):
+            raise ValueError(f"{self.registry.primary_path} did not load as a scalable font")
+    
+    def _wrap(self, text: str, size: int, max_width: int) -> Optional[List[str]]:
+        """Greedy kinsoku-aware wrap, or None if a single unit is wider than max_width"""
+        lines: List[str] = []
+        for paragraph in text.split('\n'):
+            units = split_units(paragraph.strip())
+            while units:
+                # Longest prefix that fits
+                end = 0
+                while end < len(units) and self.registry.getlength(''.join(units[:end + 1]), size) <= max_width:
+                    end += 1
+                if end == 0:
+                    return None
+                
+                if end < len(units):
+                    # Back off so the next line does not start, nor this one end, with a forbidden character
+                    cut = end
+                    while cut > 1 and (units[cut] in NO_LINE_START or units[cut - 1] in NO_LINE_END):
+                        cut -= 1
+                    if units[cut] not in NO_LINE_START and units[cut - 1] not in NO_LINE_END:
+                        end = cut
+                
+                lines.append(''.join(units[:end]).rstrip())
+                units = units[end:]
+                while units and units[0] == ' ':
+                    units = units[1:]
+        return lines
+    
+    def _measure(self, size: int, lines: List[str]) -> Tuple[List[List[Tuple[str, Any]]], List[int], int]:
+        """Per-line font runs, rendered widths and line pitch from real bboxes and metrics"""
+        line_runs, widths = [], []
+        for line in lines:
+            runs = [(run, self.registry.get(size, face)) for run, face in self.registry.split_runs(line)]
+            if len(runs) == 1:
+                left, _, right, _ = runs[0][1].getbbox(line)
+                widths.append(right - left)
+            else:
+                widths.append(int(sum(font.getlength(run) for run, font in runs) + 0.5))
+            line_runs.append(runs)
+        ascent, descent = self.registry.get(size).getmetrics()
+        return line_runs, widths, int((ascent + descent) * (1 + self.line_spacing))
+    
+    def _try_size(self, text: str, size: int, box: Tuple[int, int]) -> Optional[TextLayout]:
+        lines = self._wrap(text, size, box[0])
+        if lines is None or len(lines) > self.max_lines:
+            return None
+        line_runs, widths, line_height = self._measure(size, lines)
+        if max(widths, default=0) > box[0] or line_height * len(lines) > box[1]:
+            return None
+        return TextLayout(self.registry.get(size), size, lines, line_runs, widths, line_height, fits=True)
+    
+    def _fit(self, text: str, box: Tuple[int, int]) -> TextLayout:
+        low, high = self.min_size, self.max_size
+        best: Optional[TextLayout] = None
+        while low <= high:
+            size = (low + high) // 2
+            layout = self._try_size(text, size, box)
+            if layout is not None:
+                best = layout
+                low = size + 1
+            else:
+                high = size - 1
+        if best is not None:
+            return best
+        
+        # Does not fit even at the minimum size: wrap as well as possible and report it
+        lines = self._wrap(text, self.min_size, box[0]) or [text]
+        line_runs, widths, line_height = self._measure(self.min_size, lines)
+        return TextLayout(self.registry.get(self.min_size), self.min_size, lines, line_runs, widths, line_height, fits=False)
+    
+    def layout(self, text: str, box: Tuple[int, int]) -> TextLayout:
+        """Largest layout of text that fits box (width, height), memoised"""
+        key = (text, tuple(self.registry.faces), tuple(box))
+        with self._lock:
+            layout = self._cache.get(key)
+            if layout is not None:
+                self._cache.move_to_end(key)
+                self._stats['hits'] += 1
+                return layout
+            self._stats['misses'] += 1
+        
+        layout = self._fit(text, box)
+        with self._lock:
+            self._cache[key] = layout
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return layout
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._stats, cached=len(self._cache))
@@ -0,0 +1,168 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Dict, Any, Tuple
+from PIL import Image
+from dotenv import load_dotenv
+
+load_dotenv()
+
+THUMBNAIL_FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg')
+}
+
+class ThumbnailCache:
+    """Resized WebP/JPEG previews of generated images, cached on disk.
+    
+    Derivatives are keyed by the source file's content hash, width and
+    format, so a regenerated stamp gets a new file and a new ETag while
+    unchanged ones are served straight from THUMB_CACHE_DIR. Requested
+    widths are snapped up to THUMB_WIDTHS, and derivatives are evicted
+    least-recently-used first once the directory exceeds THUMB_CACHE_MB, so
+    previews of replaced images do not accumulate."""
+    
+    def __init__(self, output_dir: Path, cache_dir: Optional[str] = None, max_bytes: Optional[int] = None):
+        self.output_dir = Path(output_dir)
+        # Outside output_dir: that is mounted at /static, which would serve the cache past the ETag route
+        self.cache_dir = Path(cache_dir or os.getenv('THUMB_CACHE_DIR', './data/thumbs'))
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if self.output_dir.resolve() in self.cache_dir.resolve().parents:
+            print(f"Warning: THUMB_CACHE_DIR {self.cache_dir} is inside {self.output_dir} and will be served by /static")
+        self.widths = sorted(int(w) for w in os.getenv('THUMB_WIDTHS', '160,320,640,1280').split(','))
+        self.quality = int(os.getenv('THUMB_QUALITY', 80))
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('THUMB_CACHE_MB', 256)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        
+        self._lock = threading.Lock()
+        self._hashes: Dict[str, Tuple[int, int, str]] = {}  # path -> (size, mtime_ns, sha1)
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # derivative -> file size, oldest first
+        self._size = 0
+        self._loaded = False
+        self._stats = {'hits': 0, 'created': 0, 'evictions': 0}
+    
+    def _load_index(self):
+        """Scan the cache directory once, ordering derivatives by last use (caller holds the lock)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        entries = []
+        for path in self.cache_dir.glob('*/*'):
+            if path.name.startswith('.'):
+                continue  # Half-written temp file
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, f"{path.parent.name}/{path.name}", stat.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._size += size
+    
+    def _touch(self, key: str, size: int):
+        """Mark a derivative as most recently used and evict beyond the budget"""
+        with self._lock:
+            self._load_index()
+            self._size += size - self._index.pop(key, 0)
+            self._index[key] = size
+            while self._size > self.max_bytes and len(self._index) > 1:
+                old_key, old_size = self._index.popitem(last=False)
+                self._size -= old_size
+                self._stats['evictions'] += 1
+                try:
+                    (self.cache_dir / old_key).unlink()
+                except OSError:
+                    pass
+    
+    def resolve(self, relative_path: str) -> Optional[Path]:
+        """Source file under output_dir, or None if missing or outside it"""
+        root = self.output_dir.resolve()
+        path = (root / relative_path).resolve()
+        if root not in path.parents or not path.is_file() or self.cache_dir.resolve() in path.parents:
+            return None
+        return path
+    
+    def snap_width(self, width: int) -> int:
+        return next((w for w in self.widths if w >= width), self.widths[-1])
+    
+    def source_hash(self, path: Path) -> str:
+        """sha1 of the source, recomputed only when its size or mtime changes"""
+        stat = path.stat()
+        with self._lock:
+            cached = self._hashes.get(str(path))
+        if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+            return cached[2]
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        with self._lock:
+            self._hashes[str(path)] = (stat.st_size, stat.st_mtime_ns, digest)
+        return digest
+    
+    def version(self, relative_path: str) -> Optional[str]:
+        """Cache-busting token for URLs: the source hash that also prefixes the ETag"""
+        path = self.resolve(relative_path)
+        return self.source_hash(path)[:20] if path else None
+    
+    def is_current(self, path: Path, version: Optional[str]) -> bool:
+        """True if a URL's version token still matches the source file"""
+        return version is not None and version == self.source_hash(path)[:20]
+    
+    def get(self, path: Path, width: int, fmt: str = 'webp') -> Tuple[Path, str, str]:
+        """(derivative path, strong ETag, media type), creating the derivative if needed"""
+        if fmt not in THUMBNAIL_FORMATS:
+            raise ValueError(f"Unsupported thumbnail format: {fmt} (choose from {', '.join(THUMBNAIL_FORMATS)})")
+        pil_format, media_type = THUMBNAIL_FORMATS[fmt]
+        width = self.snap_width(width)
+        digest = self.source_hash(path)
+        name = f"{digest[:20]}_{width}.{fmt}"
+        key = f"{digest[:2]}/{name}"
+        target = self.cache_dir / key
+        etag = f'"{digest[:20]}-{width}-{fmt}"'
+        
+        try:
+            os.utime(target)  # Keep LRU order across restarts
+            size = target.stat().st_size
+        except OSError:
+            size = None
+        if size is not None:
+            self._touch(key, size)
+            with self._lock:
+                self._stats['hits'] += 1
+            return target, etag, media_type
+        
+        with Image.open(path) as img:
+            img.draft('RGB', (width, width))  # JPEG sources decode at reduced size
+            # Convert before resizing: Pillow resizes palette images with nearest-neighbour
+            # whatever filter is asked for, and optimized stamps are often palette PNGs
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            if img.width > width:
+                img = img.resize((width, max(1, round(img.height * width / img.width))), Image.Resampling.LANCZOS)
+            if fmt == 'jpeg' and img.mode == 'RGBA':
+                # No alpha in JPEG: flatten transparent stamps onto white
+                rgba = img
+                img = Image.new('RGB', rgba.size, (255, 255, 255))
+                img.paste(rgba, mask=rgba.getchannel('A'))
+            
+            target.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so concurrent requests never serve a partial file
+            temp = target.with_name(f".{name}.{os.getpid()}.{threading.get_ident()}")
+            if fmt == 'webp':
+                img.save(temp, pil_format, quality=self.quality, method=4)
+            else:
+                img.save(temp, pil_format, quality=self.quality, optimize=True, progressive=True)
+            os.replace(temp, target)
+        
+        self._touch(key, target.stat().st_size)
+        with self._lock:
+            self._stats['created'] += 1
+        return target, etag, media_type
+    
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            self._load_index()
+            return dict(self._stats, widths=self.widths, entries=len(self._index),
+                        bytes=self._size, max_bytes=self.max_bytes)
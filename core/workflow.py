@@ -1,15 +1,23 @@
 import asyncio
 import threading
 import random
+from concurrent.futures import ThreadPoolExecutor, CancelledError, wait, FIRST_COMPLETED
 from typing import Dict, List, Optional, Callable
 from pathlib import Path
 import os
 
 from .gemini import GeminiClient
-from .sd_api import StableDiffusionAPI
+from .sd_api import SDAPIError, SDCircuitOpenError, model_key
+from .sd_backend_pool import SDBackendPool
+from .sd_async import AsyncStableDiffusionAPI
+from .sd_progress import progress_registry, format_progress
+from .generation_queue import GenerationQueue, PRIORITY_INTERACTIVE, PRIORITY_SAMPLE, PRIORITY_FULL
 from .image_utils import ImageProcessor
+from .postprocess_pool import PostProcessPool
+from .png_optimizer import PNGOptimizer
 from .lora_trainer import LoRATrainer
 from .booth_exporter import BoothExporter
+from .line_exporter import LineExporter
 from ..db.models import StampSet, Stamp
 from ..db.crud import StampSetCRUD, StampCRUD
 from ..db.models import init_db, get_session
@@ -17,25 +25,64 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+# Generation parameters shared by every stamp request
+STAMP_WIDTH = 370
+STAMP_HEIGHT = 320
+DEFAULT_STEPS = 30
+DEFAULT_SAMPLER = "DPM++ 2M Karras"
+
 class StampWorkflowManager:
     def __init__(self):
         self.gemini = GeminiClient()
-        self.sd_api = StableDiffusionAPI()
+        # Pool of SD WebUI backends (SD_WEBUI_URLS, falls back to SD_WEBUI_URL)
+        self.sd_api = SDBackendPool()
+        self.sd_api.start_health_checks()
+        # Every SD call goes through one priority queue, one worker per backend
+        self.generation_queue = GenerationQueue(
+            workers=int(os.getenv('SD_QUEUE_WORKERS', len(self.sd_api.backends))),
+            loaded_models=self.sd_api.idle_loaded_models
+        )
+        # Non-blocking client for callers running on an event loop (e.g. the Slack bot)
+        self.async_sd_api = AsyncStableDiffusionAPI(self.sd_api)
         self.image_processor = ImageProcessor(
             os.getenv('OUTPUT_DIR', './output'),
             os.getenv('LORA_EXPORT_DIR', './lora_export')
         )
+        # rembg, captioning and PNG encoding run in worker processes so the
+        # GPU can sample the next stamp meanwhile; load their models now
+        self.postprocessor = PostProcessPool(self.image_processor)
+        self.postprocessor.warm_up()
+        # Finished stamps are re-encoded to fit LINE's per-file limit (PNG_MAX_BYTES, PNG_QUANTIZE)
+        self.png_optimizer = PNGOptimizer()
         self.lora_trainer = LoRATrainer()
         self.booth_exporter = BoothExporter(
             os.getenv('OUTPUT_DIR', './output')
         )
+        # LINE Creators Market submission zip (main/tab/01..40.png)
+        self.line_exporter = LineExporter(
+            os.getenv('OUTPUT_DIR', './output'), self.png_optimizer
+        )
         
         # Initialize database
         db_path = os.getenv('DB_PATH', './data/stamps.db')
         self.engine = init_db(db_path)
         
+        # Checkpoint to request (None = whatever the WebUI has loaded)
+        self.checkpoint = os.getenv('SD_CHECKPOINT') or None
+        
+        # Draft samples: fewer steps and a smaller canvas for fast review; approved
+        # drafts are upscaled with img2img (or re-rendered from the same seed)
+        self.draft_samples = os.getenv('SD_DRAFT_SAMPLES', 'true').lower() not in ('0', 'false', 'no')
+        self.draft_steps = int(os.getenv('SD_DRAFT_STEPS', 12))
+        self.draft_scale = float(os.getenv('SD_DRAFT_SCALE', 0.5))
+        self.draft_upscale_denoise = float(os.getenv('SD_DRAFT_UPSCALE_DENOISE', 0.45))
+        
+        # Number of compatible stamps sent to SD WebUI in one request (1 = no batching)
+        self.batch_size = max(1, int(os.getenv('SD_BATCH_SIZE', 1)))
+        
         # Callback functions for Slack notifications
         self.slack_callback: Optional[Callable] = None
+        self.sd_api.set_stall_callback(self._notify_stalled_backend)
     
     def set_slack_callback(self, callback: Callable):
         """Set callback function for Slack notifications"""
@@ -52,6 +99,149 @@ class StampWorkflowManager:
             except Exception as e:
                 print(f"Error sending Slack notification: {e}")
     
+    def _build_generation_job(self, stamp: Stamp, prompt: str, seed: int,
+                              reference_image_path: Optional[str] = None) -> Dict:
+        """Describe one stamp's SD request, detached from the DB session"""
+        return {
+            'stamp_id': stamp.id,
+            'number': stamp.number,
+            'phrase': stamp.phrase,
+            'prompt': prompt,
+            'negative_prompt': stamp.negative_prompt or "",
+            'seed': seed,
+            'width': STAMP_WIDTH,
+            'height': STAMP_HEIGHT,
+            'steps': DEFAULT_STEPS,
+            'sampler_name': DEFAULT_SAMPLER,
+            'reference_image_path': reference_image_path,
+            'denoising_strength': 0.6,
+            'control_image_path': None,
+            'checkpoint': self.checkpoint,
+            'model_key': model_key(prompt, self.checkpoint),
+            'draft': False
+        }
+    
+    def _as_draft(self, job: Dict) -> Dict:
+        """Cheaper variant of a job for sample review"""
+        # SD needs dimensions in multiples of 8
+        width = max(64, int(job['width'] * self.draft_scale) // 8 * 8)
+        height = max(64, int(job['height'] * self.draft_scale) // 8 * 8)
+        return dict(job, width=width, height=height, steps=min(job['steps'], self.draft_steps), draft=True)
+    
+    def _finalize_draft_job(self, set_id: str, stamp: Stamp, job: Dict) -> Dict:
+        """Full-quality job for an approved draft: same seed, upscaled from the draft when it was downsized"""
+        job = dict(job, seed=stamp.seed or job['seed'])
+        draft_source = self.image_processor.get_draft_source(set_id, stamp.number)
+        if self.draft_scale < 1.0 and draft_source:
+            # A different canvas size changes the noise, so the seed alone would
+            # not reproduce the approved composition; refine the draft instead,
+            # keeping the character reference as a ControlNet unit
+            job.update(reference_image_path=draft_source, denoising_strength=self.draft_upscale_denoise,
+                       control_image_path=job['reference_image_path'])
+        return job
+    
+    @staticmethod
+    def _batch_key(job: Dict) -> tuple:
+        """Jobs with equal keys can be rendered in the same SD request"""
+        return (job['width'], job['height'], job['sampler_name'], job['steps'],
+                job['reference_image_path'], job['denoising_strength'], job['control_image_path'],
+                job['model_key'])
+    
+    def _group_compatible_jobs(self, jobs: List[Dict], batch_size: int) -> List[List[Dict]]:
+        """Group consecutive compatible jobs with consecutive seeds into batches"""
+        groups: List[List[Dict]] = []
+        for job in jobs:
+            if groups:
+                group = groups[-1]
+                head = group[0]
+                if (len(group) < batch_size
+                        and self._batch_key(job) == self._batch_key(head)
+                        and job['seed'] == head['seed'] + len(group)):
+                    group.append(job)
+                    continue
+            groups.append([job])
+        return groups
+    
+    def _run_generation_group(self, group: List[Dict]) -> List[tuple]:
+        """Render a group of jobs and return (image_data, seed) per job"""
+        head = group[0]
+        params = {
+            'width': head['width'],
+            'height': head['height'],
+            'steps': head['steps'],
+            'sampler_name': head['sampler_name'],
+            'seed': head['seed'],
+            'reference_image_path': head['reference_image_path'],
+            'denoising_strength': head['denoising_strength'],
+            'control_image_path': head['control_image_path'],
+            'checkpoint': head['checkpoint']
+        }
+        if len(group) == 1:
+            image_data = self.sd_api.generate_image(
+                prompt=head['prompt'], negative_prompt=head['negative_prompt'],
+                raise_errors=True, **params
+            )
+            return [(image_data, head['seed'])]
+        
+        return self.sd_api.generate_batch(
+            prompts=[job['prompt'] for job in group],
+            negative_prompts=[job['negative_prompt'] for job in group],
+            raise_errors=True, **params
+        )
+    
+    def _notify_stalled_backend(self, url: str, snapshot: Dict):
+        """Warn on Slack when an SD backend stops making progress"""
+        self._notify_slack(
+            f"⚠️ SD WebUI ({url}) の生成が止まっている可能性があります "
+            f"(ステップ {snapshot.get('step', 0)}/{snapshot.get('steps', 0)})"
+        )
+    
+    def _format_backend_summary(self) -> str:
+        """Summary of SD retries, model switches and background removal timings for Slack"""
+        stats = self.sd_api.get_resilience_stats().values()
+        retries = sum(s['retries'] for s in stats)
+        gave_up = sum(s['gave_up'] for s in stats)
+        opens = sum(s['breaker']['opens'] for s in stats)
+        switches = sum(backend['model_switches'] for backend in self.sd_api.get_status())
+        picks = self.generation_queue.get_stats()['affinity_picks']
+        summary = (
+            f"🔁 リトライ {retries}回 / 断念 {gave_up}回 / サーキット遮断 {opens}回\n"
+            f"🔀 モデル切替 {switches}回 (読み込み済みモデルを優先 {picks}回)"
+        )
+        if self.postprocessor.in_process:
+            background_stats = dict(self.image_processor.background_stats)
+            if background_stats['fast']:
+                summary += (
+                    f"\n⚡ 高速背景除去 {background_stats['fast']}枚 "
+                    f"(平均{background_stats['fast_seconds'] / background_stats['fast'] * 1000:.0f}ms) / "
+                    f"rembg {background_stats['rembg']}枚"
+                )
+            rembg_stats = self.image_processor.background_remover.get_stats()
+            if rembg_stats['avg_inference_seconds'] is not None:
+                summary += (
+                    f"\n✂️ 背景除去 平均{rembg_stats['avg_inference_seconds']:.2f}秒/枚 "
+                    f"(モデル読込 {rembg_stats['load_seconds_total']:.1f}秒)"
+                )
+        post_stats = self.postprocessor.get_stats()
+        if post_stats['backpressure_waits']:
+            summary += f"\n⏳ 後処理待ち {post_stats['backpressure_waits']}回 ({post_stats['backpressure_seconds']:.0f}秒)"
+        return summary
+    
+    def _format_png_summary(self, png_summary: Dict) -> str:
+        """Bytes saved by PNG optimization, and any stamps still over the size limit"""
+        summary = (
+            f"🗜️ PNG最適化 {png_summary['bytes_before'] / 1024:.0f}KB → {png_summary['bytes_after'] / 1024:.0f}KB "
+            f"({png_summary['bytes_saved'] / 1024:.0f}KB削減, {png_summary['seconds']:.1f}秒)"
+        )
+        if png_summary['over_budget']:
+            names = ', '.join(Path(path).name for path in png_summary['over_budget'])
+            summary += f"\n⚠️ 容量上限 ({self.png_optimizer.max_bytes / 1000:.0f}KB) を超えています: {names}"
+        return summary
+    
+    def get_generation_progress(self, set_id: str) -> Optional[Dict]:
+        """Current generation progress of a set, including per-backend step progress"""
+        return progress_registry.get(set_id)
+    
     def create_new_set(self, name: str, slack_ts: str) -> Optional[StampSet]:
         """Create new stamp set"""
         db = get_session(self.engine)
@@ -102,7 +292,7 @@ class StampWorkflowManager:
                         return
                     
                     stamp_type = stamp_set.genre
-                    
+                
                 finally:
                     db.close()
                 
@@ -148,7 +338,7 @@ class StampWorkflowManager:
                     })
                 
                 self._notify_slack("🎨 キャラクター案を生成しました", blocks)
-                
+            
             except Exception as e:
                 print(f"Error generating character proposals: {e}")
                 self._notify_slack("❌ キャラクター案の生成中にエラーが発生しました。")
@@ -232,7 +422,7 @@ class StampWorkflowManager:
                 ]
                 
                 self._notify_slack("📝 フレーズ案を生成しました", blocks)
-                
+            
             except Exception as e:
                 print(f"Error generating phrase patterns: {e}")
                 self._notify_slack("❌ フレーズ生成中にエラーが発生しました。")
@@ -275,9 +465,9 @@ class StampWorkflowManager:
                 else:
                     seed = None  # Random seed for each stamp
                 
+                # Queue every sample up front so idle backends can work in parallel
+                futures = []
                 for i, stamp in enumerate(sample_stamps):
-                    self._notify_slack(f"🎨 サンプル{i+1}/5を生成中...")
-                    
                     # Use different seed for each stamp if no character consistency
                     current_seed = seed + i if seed else random.randint(1, 1000000)
                     
@@ -285,18 +475,37 @@ class StampWorkflowManager:
                     lora_path = self.lora_trainer.get_lora_path(set_id)
                     prompt = self.lora_trainer.build_prompt_with_lora(stamp.prompt, set_id, lora_path)
                     
-                    image_data = self.sd_api.generate_image(
-                        prompt=prompt,
-                        negative_prompt=stamp.negative_prompt or "",
-                        seed=current_seed,
-                        reference_image_path=stamp_set.reference_image_path if stamp_set.character_consistency else None
+                    job = self._build_generation_job(
+                        stamp, prompt, current_seed,
+                        stamp_set.reference_image_path if stamp_set.character_consistency else None
                     )
+                    if self.draft_samples:
+                        job = self._as_draft(job)
+                    futures.append(self.generation_queue.submit(
+                        PRIORITY_SAMPLE, self._run_generation_group, [job], model_key=job['model_key']
+                    ))
+                
+                progress_registry.start(set_id, 'samples', len(sample_stamps))
+                for i, (stamp, future) in enumerate(zip(sample_stamps, futures)):
+                    self._notify_slack(f"🎨 サンプル{i+1}/{len(sample_stamps)}を生成中...")
+                    try:
+                        image_data, used_seed = future.result()[0]
+                    except SDAPIError as e:
+                        print(f"Sample stamp {stamp.number} failed: {e}")
+                        image_data = None
+                    
+                    progress_registry.update(set_id, i + 1)
                     
                     if image_data:
-                        image_path = self.image_processor.save_stamp_image(
-                            set_id, stamp.number, image_data, stamp.phrase, is_sample=True
+                        image_path = self.postprocessor.save(
+                            set_id, stamp.number, image_data, stamp.phrase, is_sample=True,
+                            draft=self.draft_samples
                         )
                         stamp_crud.update_image_path(stamp.id, image_path)
+                        stamp_crud.update_seed(stamp.id, used_seed)
+                        if self.draft_samples:
+                            self.image_processor.save_draft_source(set_id, stamp.number, image_data)
+                            stamp_crud.update_status(stamp.id, 'draft')
                         
                         generated_stamps.append({
                             'id': stamp.id,
@@ -305,6 +514,9 @@ class StampWorkflowManager:
                             'phrase': stamp.phrase
                         })
                 
+                progress_registry.finish(set_id)
+                time_to_review = progress_registry.get(set_id)['elapsed_seconds']
+                
                 # Create grid image
                 grid_path = self.image_processor.create_grid_image(set_id, generated_stamps, is_sample=True)
                 
@@ -315,7 +527,10 @@ class StampWorkflowManager:
                 blocks = [
                     {
                         "type": "section",
-                        "text": {"type": "mrkdwn", "text": f"🎨 サンプルスタンプを{len(generated_stamps)}枚生成しました"}
+                        "text": {"type": "mrkdwn", "text": (
+                            f"🎨 サンプルスタンプを{len(generated_stamps)}枚生成しました ({time_to_review:.0f}秒)"
+                            + ("\n📝 下書き品質です。承認したスタンプは全体生成時に高画質で仕上げます" if self.draft_samples else "")
+                        )}
                     },
                     {
                         "type": "image",
@@ -371,7 +586,7 @@ class StampWorkflowManager:
                 })
                 
                 self._notify_slack("🎨 サンプルスタンプが完成しました", blocks)
-                
+            
             except Exception as e:
                 print(f"Error generating sample stamps: {e}")
                 self._notify_slack("❌ サンプル生成中にエラーが発生しました。")
@@ -399,40 +614,145 @@ class StampWorkflowManager:
                 stamps = stamp_crud.get_by_set(set_id)
                 
                 # Generate images for all stamps
-                generated_count = 0
                 total_count = len(stamps)
+                # Skip already generated stamps, but finish approved drafts at full quality
+                pending_stamps = [stamp for stamp in stamps if not stamp.image_path or stamp.status == 'draft']
+                generated_count = total_count - len(pending_stamps)
                 
-                # Use seed only if character consistency is required
+                # Seeds are base + stamp number so consecutive stamps get consecutive
+                # seeds, matching how SD WebUI assigns seeds inside a batch.
+                # Without character consistency the base is fresh for every run.
                 if stamp_set.character_consistency:
                     seed = stamp_set.seed or random.randint(1, 1000000)
                 else:
-                    seed = None  # Random seed for each stamp
+                    seed = random.randint(1, 1000000)
                 
-                for i, stamp in enumerate(stamps):
-                    if stamp.image_path:  # Skip already generated
+                reference_image_path = stamp_set.reference_image_path if stamp_set.character_consistency else None
+                jobs = []
+                for stamp in pending_stamps:
+                    job = self._build_generation_job(stamp, stamp.prompt, seed + stamp.number, reference_image_path)
+                    if stamp.status == 'draft':
+                        job = self._finalize_draft_job(set_id, stamp, job)
+                    jobs.append(job)
+                
+                # Fan groups out through the generation queue. Each group's images go to
+                # the post-processing pool together (one batched rembg run) as soon as
+                # they arrive, and the thread goes back for the next group; DB updates
+                # stay on this thread's session
+                def render_group(group: List[Dict]) -> tuple:
+                    if circuit_open:
+                        raise CancelledError()
+                    results = self.generation_queue.run(
+                        PRIORITY_FULL, self._run_generation_group, group,
+                        model_key=group[0]['model_key'], tag=set_id
+                    )
+                    rendered = [(job, used_seed) for job, (image_data, used_seed) in zip(group, results) if image_data]
+                    failed = [(job, used_seed) for job, (image_data, used_seed) in zip(group, results) if not image_data]
+                    save_future = None
+                    if rendered:
+                        save_future = self.postprocessor.submit_batch(set_id, [
+                            (job['number'], image_data, job['phrase'])
+                            for job, (image_data, _) in zip(group, results) if image_data
+                        ])
+                    return save_future, rendered, failed
+                
+                processed_count = generated_count
+                failed_numbers = []
+                circuit_open = False
+                
+                def record(job: Dict, image_path: Optional[str], used_seed: int):
+                    nonlocal processed_count, generated_count
+                    processed_count += 1
+                    progress_registry.update(set_id, processed_count)
+                    
+                    if image_path:
+                        stamp_crud.update_image_path(job['stamp_id'], image_path)
+                        stamp_crud.update_seed(job['stamp_id'], used_seed)
+                        stamp_crud.update_status(job['stamp_id'], 'pending')
                         generated_count += 1
-                        continue
+                    else:
+                        failed_numbers.append(job['number'])
                     
                     # Progress notification
-                    if (i + 1) % 5 == 0 or i == len(stamps) - 1:
-                        self._notify_slack(f"🎨 進捗: {i+1}/{total_count}枚完了...")
-                    
-                    # Use different seed for each stamp if no character consistency
-                    current_seed = seed + stamp.number if seed else random.randint(1, 1000000)
-                    
-                    image_data = self.sd_api.generate_image(
-                        prompt=stamp.prompt,
-                        negative_prompt=stamp.negative_prompt or "",
-                        seed=current_seed,
-                        reference_image_path=stamp_set.reference_image_path if stamp_set.character_consistency else None
-                    )
+                    if processed_count % 5 == 0 or processed_count == total_count:
+                        self._notify_slack(f"🎨 進捗: {format_progress(progress_registry.get(set_id))}")
+                
+                progress_registry.start(set_id, 'full', total_count, processed_count)
+                groups = self._group_compatible_jobs(jobs, self.batch_size)
+                with ThreadPoolExecutor(max_workers=self.sd_api.capacity()) as executor:
+                    futures = {executor.submit(render_group, group): group for group in groups}
+                    saves = {}
+                    waiting = set(futures)
+                    while waiting:
+                        done, waiting = wait(waiting, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            if future in saves:
+                                rendered = saves.pop(future)
+                                try:
+                                    image_paths = future.result()
+                                except Exception as e:
+                                    print(f"Error post-processing stamps {[job['number'] for job, _ in rendered]}: {e}")
+                                    image_paths = [None] * len(rendered)
+                                for (job, used_seed), image_path in zip(rendered, image_paths):
+                                    record(job, image_path, used_seed)
+                                continue
+                            
+                            if future.cancelled():
+                                continue
+                            try:
+                                save_future, rendered, failed = future.result()
+                            except CancelledError:
+                                # Withdrawn from the generation queue after the circuit opened
+                                failed_numbers.extend(job['number'] for job in futures[future])
+                                continue
+                            except SDAPIError as e:
+                                print(f"Stamp group failed: {e}")
+                                save_future, rendered, failed = None, [], [(job, job['seed']) for job in futures[future]]
+                                if isinstance(e, SDCircuitOpenError) and not circuit_open:
+                                    # Every backend is cooling down; stop queueing work that would fail the same way
+                                    circuit_open = True
+                                    for pending in futures:
+                                        pending.cancel()
+                                    # Groups already waiting in the generation queue would run and fail too
+                                    self.generation_queue.cancel(set_id)
+                            
+                            for job, used_seed in failed:
+                                record(job, None, used_seed)
+                            if save_future is not None:
+                                saves[save_future] = rendered
+                                waiting.add(save_future)
                     
-                    if image_data:
-                        image_path = self.image_processor.save_stamp_image(
-                            set_id, stamp.number, image_data, stamp.phrase
-                        )
-                        stamp_crud.update_image_path(stamp.id, image_path)
-                        generated_count += 1
+                    # Groups cancelled before they started never reached the loop above
+                    for future, group in futures.items():
+                        if future.cancelled():
+                            failed_numbers.extend(job['number'] for job in group)
+                
+                progress_registry.finish(set_id)
+                
+                if failed_numbers:
+                    # Keep the set resumable; generated stamps are kept and skipped next time
+                    numbers = ', '.join(str(n) for n in sorted(failed_numbers))
+                    reason = "SD WebUIが応答しないため中断しました" if circuit_open else "一部のスタンプの生成に失敗しました"
+                    blocks = [
+                        {
+                            "type": "section",
+                            "text": {"type": "mrkdwn", "text": f"⚠️ {reason}\n未生成: {numbers}\n{self._format_backend_summary()}"}
+                        },
+                        {
+                            "type": "actions",
+                            "elements": [
+                                {
+                                    "type": "button",
+                                    "text": {"type": "plain_text", "text": "未生成分を再開"},
+                                    "style": "primary",
+                                    "value": set_id,
+                                    "action_id": "resume_generation"
+                                }
+                            ]
+                        }
+                    ]
+                    self._notify_slack(f"⚠️ {len(failed_numbers)}枚のスタンプが未生成です", blocks)
+                    return
                 
                 # Create grid image
                 all_stamps = []
@@ -441,15 +761,21 @@ class StampWorkflowManager:
                         all_stamps.append({
                             'number': stamp.number,
                             'image_path': stamp.image_path,
-                            'phrase': stamp.phrase
+                            'phrase': stamp.phrase,
+                            'prompt': stamp.prompt
                         })
                 
-                grid_path = self.image_processor.create_grid_image(set_id, all_stamps, is_sample=False)
-                
-                # Export for LoRA
+                # Export for LoRA (before optimization, so training sees the full-colour originals)
                 self.image_processor.export_for_lora(set_id, all_stamps)
                 crud.mark_lora_exported(set_id)
                 
+                # Shrink every stamp in parallel and check it against the submission limit;
+                # re-exports keep the dataset's originals rather than the optimized files
+                png_summary = self.png_optimizer.optimize_files([stamp['image_path'] for stamp in all_stamps])
+                self.image_processor.accept_lora_rewrites(set_id, [stamp['image_path'] for stamp in all_stamps])
+                
+                grid_path = self.image_processor.create_grid_image(set_id, all_stamps, is_sample=False)
+                
                 # Update status and notify
                 crud.update_status(set_id, 'completed')
                 
@@ -460,17 +786,31 @@ class StampWorkflowManager:
                     },
                     {
                         "type": "section", 
-                        "text": {"type": "mrkdwn", "text": f"📁 保存先: `output/{set_id}/`"}
+                        "text": {"type": "mrkdwn", "text": (
+                            f"📁 保存先: `output/{set_id}/`\n{self._format_png_summary(png_summary)}\n"
+                            f"{self._format_backend_summary()}"
+                        )}
                     },
                     {
                         "type": "image",
                         "image_url": f"file://{grid_path}",
                         "alt_text": "Complete stamps grid"
+                    },
+                    {
+                        "type": "actions",
+                        "elements": [
+                            {
+                                "type": "button",
+                                "text": {"type": "plain_text", "text": "📦 LINE申請用ZIPを作成"},
+                                "action_id": "export_line",
+                                "value": set_id
+                            }
+                        ]
                     }
                 ]
                 
                 self._notify_slack("✅ スタンプセットが完成しました！", blocks)
-                
+            
             except Exception as e:
                 print(f"Error generating full stamps: {e}")
                 self._notify_slack("❌ 全体生成中にエラーが発生しました。")
@@ -478,3 +818,153 @@ class StampWorkflowManager:
                 db.close()
         
         threading.Thread(target=run_in_background, daemon=True).start()
+    
+    def export_for_line(self, set_id: str, count: Optional[int] = None, main_number: Optional[int] = None):
+        """Build the LINE submission zip for a set and report the result to Slack"""
+        def run_in_background():
+            db = get_session(self.engine)
+            try:
+                stamp_set = StampSetCRUD(db).get(set_id)
+                if not stamp_set:
+                    self._notify_slack("❌ スタンプセットが見つかりません。")
+                    return
+                
+                stamps = [
+                    {'number': stamp.number, 'image_path': stamp.image_path, 'phrase': stamp.phrase}
+                    for stamp in StampCRUD(db).get_by_set(set_id) if stamp.image_path
+                ]
+                zip_path, package = self.line_exporter.export_for_line(set_id, stamps, count, main_number)
+                notes = ''.join(f"\nℹ️ {warning}" for warning in package.warnings)
+                
+                if zip_path is None:
+                    issues = '\n'.join(f"• {issue}" for issue in package.issues[:20])
+                    self._notify_slack(
+                        f"⚠️ 「{stamp_set.name}」のLINE申請用ZIPを作成できませんでした",
+                        [{
+                            "type": "section",
+                            "text": {"type": "mrkdwn", "text": f"⚠️ 申請要件を満たしていません:\n{issues}{notes}"}
+                        }]
+                    )
+                    return
+                
+                self._notify_slack(
+                    f"📦 「{stamp_set.name}」のLINE申請用ZIPを作成しました",
+                    [{
+                        "type": "section",
+                        "text": {"type": "mrkdwn", "text": (
+                            f"📦 LINE申請用ZIP: `{zip_path}`\n"
+                            f"{len(package.assets) - 2}枚 + main.png / tab.png, "
+                            f"{package.total_bytes / 1024:.0f}KB ({package.seconds:.1f}秒){notes}"
+                        )}
+                    }]
+                )
+            
+            except Exception as e:
+                print(f"Error exporting for LINE: {e}")
+                self._notify_slack("❌ LINE申請用ZIPの作成中にエラーが発生しました。")
+            finally:
+                db.close()
+        
+        threading.Thread(target=run_in_background, daemon=True).start()
+    
+    def resume_generation(self, set_id: str):
+        """Generate the stamps that are still missing an image"""
+        self._notify_slack("🔄 未生成のスタンプの生成を再開します...")
+        self.generate_full_stamps(set_id)
+    
+    def regenerate_single_stamp(self, set_id: str, stamp_id: str):
+        """Regenerate one stamp with a new seed, ahead of any queued batch work"""
+        def run_in_background():
+            db = get_session(self.engine)
+            previous_status = None
+            job = None
+            try:
+                crud = StampSetCRUD(db)
+                stamp_crud = StampCRUD(db)
+                
+                stamp_set = crud.get(set_id)
+                stamp = stamp_crud.get(stamp_id)
+                if not stamp_set or not stamp or stamp.set_id != set_id:
+                    self._notify_slack("❌ スタンプが見つかりません。")
+                    return
+                
+                previous_status = stamp.status
+                stamp_crud.update_status(stamp_id, 'regenerating')
+                stamp_crud.increment_retry_count(stamp_id)
+                self._notify_slack(f"🔄 スタンプ {stamp.number:02d} を再生成中...")
+                
+                lora_path = self.lora_trainer.get_lora_path(set_id)
+                prompt = self.lora_trainer.build_prompt_with_lora(stamp.prompt, set_id, lora_path)
+                job = self._build_generation_job(
+                    stamp, prompt, random.randint(1, 1000000),
+                    stamp_set.reference_image_path if stamp_set.character_consistency else None
+                )
+                # Samples under review are regenerated as drafts too
+                in_review = stamp_set.status == 'samples_review'
+                if in_review and self.draft_samples:
+                    job = self._as_draft(job)
+                
+                # Interactive priority: a user is waiting on this one stamp
+                image_data, used_seed = self.generation_queue.run(
+                    PRIORITY_INTERACTIVE, self._run_generation_group, [job], model_key=job['model_key']
+                )[0]
+                image_path = self.postprocessor.save(
+                    set_id, stamp.number, image_data, stamp.phrase, is_sample=in_review, draft=job['draft']
+                )
+                stamp_crud.update_image_path(stamp_id, image_path)
+                stamp_crud.update_seed(stamp_id, used_seed)
+                if job['draft']:
+                    self.image_processor.save_draft_source(set_id, stamp.number, image_data)
+                stamp_crud.update_status(stamp_id, 'draft' if job['draft'] else 'pending')
+                if stamp_set.status == 'completed':
+                    # Replacing a stamp in a finished set: sync the full-quality image to the
+                    # LoRA dataset first, then keep the stamp within the submission limit
+                    self.image_processor.export_for_lora(set_id, [
+                        {'number': s.number, 'image_path': s.image_path, 'phrase': s.phrase, 'prompt': s.prompt}
+                        for s in stamp_crud.get_by_set(set_id) if s.image_path
+                    ])
+                    self.png_optimizer.optimize_file(image_path)
+                    self.image_processor.accept_lora_rewrites(set_id, [image_path])
+                # Keep the review grids current without recomposing them
+                self.image_processor.update_grid_stamp(set_id, stamp.number, image_path)
+                
+                blocks = [
+                    {
+                        "type": "section",
+                        "text": {"type": "mrkdwn", "text": f"*スタンプ {stamp.number:02d}*: {stamp.phrase} を再生成しました"}
+                    },
+                    {
+                        "type": "image",
+                        "image_url": f"file://{image_path}",
+                        "alt_text": f"Stamp {stamp.number:02d}"
+                    },
+                    {
+                        "type": "actions",
+                        "elements": [
+                            {
+                                "type": "button",
+                                "text": {"type": "plain_text", "text": "✅ OK"},
+                                "action_id": "approve_sample_stamp",
+                                "value": f"{set_id}:{stamp_id}"
+                            },
+                            {
+                                "type": "button",
+                                "text": {"type": "plain_text", "text": "🔄 再生成"},
+                                "action_id": "regenerate_stamp",
+                                "value": f"{set_id}:{stamp_id}"
+                            }
+                        ]
+                    }
+                ]
+                self._notify_slack(f"🔄 スタンプ {stamp.number:02d} を再生成しました", blocks)
+            
+            except Exception as e:
+                print(f"Error regenerating stamp: {e}")
+                # A draft keeps its draft status, so the full run still finalizes its preview
+                was_draft = previous_status == 'draft' or (job is not None and job['draft'])
+                StampCRUD(db).update_status(stamp_id, 'draft' if was_draft else 'pending')
+                self._notify_slack("❌ スタンプの再生成に失敗しました。")
+            finally:
+                db.close()
+        
+        threading.Thread(target=run_in_background, daemon=True).start()
@@ -171,6 +171,14 @@ class StampCRUD:
             self.db.refresh(stamp)
         return stamp
     
+    def update_seed(self, stamp_id: str, seed: int) -> Optional[Stamp]:
+        stamp = self.get(stamp_id)
+        if stamp:
+            stamp.seed = seed
+            self.db.commit()
+            self.db.refresh(stamp)
+        return stamp
+    
     def update_prompt(self, stamp_id: str, prompt: str, negative_prompt: str = None) -> Optional[Stamp]:
         stamp = self.get(stamp_id)
         if stamp:
@@ -67,7 +67,7 @@ class Stamp(Base):
     set = relationship("StampSet", back_populates="stamps")
     
     # Status constants
-    STATUSES = ['pending', 'approved', 'rejected', 'regenerating']
+    STATUSES = ['pending', 'draft', 'approved', 'rejected', 'regenerating']  # draft: 下書き品質のサンプル
 
 # Database setup
 def init_db(db_path: str):
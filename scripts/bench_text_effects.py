@@ -0,0 +1,64 @@
+"""Benchmark caption rendering against the previous 24-pass outline.
+
+    python scripts/bench_text_effects.py --font ./fonts/NotoSansJP-Regular.ttf --text おつかれさま
+"""
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Tuple
+from PIL import Image, ImageDraw, ImageFont
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from core.text_effects import TextStyle, draw_text
+
+def _legacy_outline(img: Image.Image, xy: Tuple[int, int], text: str, font, outline_width: int = 2):
+    """The previous renderer: the phrase drawn at every offset, then once in white"""
+    draw = ImageDraw.Draw(img)
+    x, y = xy
+    for dx in range(-outline_width, outline_width + 1):
+        for dy in range(-outline_width, outline_width + 1):
+            if dx == 0 and dy == 0:
+                continue
+            draw.text((x + dx, y + dy), text, font=font, fill=(0, 0, 0, 255))
+    draw.text((x, y), text, font=font, fill=(255, 255, 255, 255))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark caption rendering against the 24-pass outline")
+    parser.add_argument("--font", default=os.getenv('FONT_PATH', './fonts/NotoSansJP-Regular.ttf'))
+    parser.add_argument("--size", type=int, default=32)
+    parser.add_argument("--text", default="おつかれさまです")
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    
+    try:
+        font = ImageFont.truetype(args.font, args.size)
+    except OSError:
+        print(f"Could not load {args.font}; using Pillow's default font")
+        font = ImageFont.load_default(args.size)
+    
+    base = Image.new('RGBA', (370, 320), (0, 0, 0, 0))
+    xy = (40, 260)
+    cases = [
+        ("legacy 24-pass", lambda img: _legacy_outline(img, xy, args.text, font)),
+        ("dilate", lambda img: draw_text(img, xy, args.text, font, TextStyle())),
+        ("stroke", lambda img: draw_text(img, xy, args.text, font, TextStyle(outline_method='stroke'))),
+        ("dilate + shadow + gradient", lambda img: draw_text(img, xy, args.text, font, TextStyle(
+            shadow=(0, 0, 0, 128), gradient=((255, 255, 255, 255), (255, 215, 0, 255))
+        )))
+    ]
+    
+    baseline = None
+    for name, render in cases:
+        render(base.copy())  # warm the glyph cache
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            render(base.copy())
+        per_call = (time.perf_counter() - start) / args.iterations
+        baseline = baseline or per_call
+        print(f"{name:28s} {per_call * 1000:7.2f} ms  x{baseline / per_call:.1f}")
+
+if __name__ == "__main__":
+    main()
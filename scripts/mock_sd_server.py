@@ -0,0 +1,270 @@
+"""Mock AUTOMATIC1111 WebUI API for load-testing without a GPU.
+
+    python scripts/mock_sd_server.py --port 7861 --step-time 0.02 --error-rate 0.05
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional
+from PIL import Image, ImageDraw
+
+SAMPLERS = [
+    "DPM++ 2M Karras",
+    "DPM++ SDE Karras",
+    "Euler a",
+    "Euler",
+    "DDIM",
+    "UniPC"
+]
+
+class MockSDState:
+    """Simulated GPU: one job at a time, with step-level progress"""
+    
+    def __init__(self, step_time: float = 0.02, overhead: float = 0.2, jitter: float = 0.1,
+                 error_rate: float = 0.0, batch_efficiency: float = 0.6, rng_seed: Optional[int] = None):
+        self.step_time = step_time
+        self.overhead = overhead
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.batch_efficiency = batch_efficiency
+        self.rng = random.Random(rng_seed)
+        self.rng_lock = threading.Lock()
+        
+        self.gpu_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+        self.interrupted = threading.Event()
+        self.options: Dict[str, Any] = {"sd_model_checkpoint": "mock-model.safetensors"}
+        self.progress: Dict[str, Any] = self._idle_progress()
+        self.stats = {'requests': 0, 'images': 0, 'errors': 0, 'busy_seconds': 0.0}
+    
+    @staticmethod
+    def _idle_progress() -> Dict[str, Any]:
+        return {
+            "progress": 0.0,
+            "eta_relative": 0.0,
+            "state": {
+                "skipped": False, "interrupted": False, "job": "", "job_count": 0,
+                "job_timestamp": "0", "job_no": 0, "sampling_step": 0, "sampling_steps": 0
+            },
+            "current_image": None,
+            "textinfo": None
+        }
+    
+    def _random(self) -> float:
+        with self.rng_lock:
+            return self.rng.random()
+    
+    def _gauss(self) -> float:
+        with self.rng_lock:
+            return self.rng.gauss(0.0, 1.0)
+    
+    def count(self, key: str, amount: int = 1):
+        with self.state_lock:
+            self.stats[key] += amount
+    
+    def should_fail(self) -> bool:
+        return self.error_rate > 0 and self._random() < self.error_rate
+    
+    def run_job(self, steps: int, batch_size: int, n_iter: int):
+        """Hold the GPU for the simulated duration, updating progress per step"""
+        # A batch of n costs n ** batch_efficiency single-image steps
+        step_seconds = self.step_time * (batch_size ** self.batch_efficiency)
+        step_seconds *= max(0.1, 1.0 + self.jitter * self._gauss())
+        total_steps = max(1, steps) * n_iter
+        
+        with self.gpu_lock:
+            started = time.time()
+            self.interrupted.clear()
+            time.sleep(self.overhead)
+            for iteration in range(n_iter):
+                for step in range(1, max(1, steps) + 1):
+                    if self.interrupted.is_set():
+                        break
+                    time.sleep(step_seconds)
+                    done = iteration * max(1, steps) + step
+                    with self.state_lock:
+                        self.progress = {
+                            "progress": done / total_steps,
+                            "eta_relative": (total_steps - done) * step_seconds,
+                            "state": {
+                                "skipped": False, "interrupted": False, "job": f"Batch {iteration + 1} out of {n_iter}",
+                                "job_count": n_iter, "job_timestamp": str(int(started)), "job_no": iteration,
+                                "sampling_step": step, "sampling_steps": steps
+                            },
+                            "current_image": None,
+                            "textinfo": None
+                        }
+            with self.state_lock:
+                self.progress = self._idle_progress()
+                self.stats['busy_seconds'] += time.time() - started
+
+def render_image(prompt: str, seed: int, width: int, height: int) -> bytes:
+    """Deterministic synthetic stamp: a figure on a plain background"""
+    digest = hashlib.sha256(f"{prompt}|{seed}".encode('utf-8')).digest()
+    background = (235 + digest[0] % 20, 235 + digest[1] % 20, 235 + digest[2] % 20)
+    body = (digest[3], digest[4], digest[5])
+    accent = (255 - digest[3], 255 - digest[4], 255 - digest[5])
+    
+    img = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(img)
+    cx, cy = width // 2, height // 2
+    radius = min(width, height) // 3 + digest[6] % 20
+    draw.ellipse([cx - radius, cy - radius, cx + radius, cy + radius], fill=body, outline=(30, 30, 30), width=3)
+    eye = max(4, radius // 6)
+    for dx in (-radius // 3, radius // 3):
+        draw.ellipse([cx + dx - eye, cy - radius // 4 - eye, cx + dx + eye, cy - radius // 4 + eye], fill=accent)
+    draw.arc([cx - radius // 2, cy, cx + radius // 2, cy + radius // 2], 20, 160, fill=(30, 30, 30), width=3)
+    draw.text((8, 8), f"seed {seed}", fill=(80, 80, 80))
+    
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+def make_handler(state: MockSDState):
+    class MockSDHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        
+        def log_message(self, format, *args):
+            pass
+        
+        def _send_json(self, data: Any, status: int = 200):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        def _read_json(self) -> Dict[str, Any]:
+            length = int(self.headers.get("Content-Length") or 0)
+            if not length:
+                return {}
+            return json.loads(self.rfile.read(length))
+        
+        def do_GET(self):
+            path = self.path.split('?', 1)[0]
+            if path == "/":
+                body = b"<html><body>Mock SD WebUI</body></html>"
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            elif path == "/sdapi/v1/samplers":
+                self._send_json([{"name": name, "aliases": [], "options": {}} for name in SAMPLERS])
+            elif path == "/sdapi/v1/progress":
+                with state.state_lock:
+                    progress = dict(state.progress)
+                self._send_json(progress)
+            elif path == "/sdapi/v1/options":
+                self._send_json(state.options)
+            elif path == "/mock/stats":
+                with state.state_lock:
+                    stats = dict(state.stats)
+                self._send_json(stats)
+            else:
+                self._send_json({"detail": "Not Found"}, 404)
+        
+        def do_POST(self):
+            path = self.path.split('?', 1)[0]
+            try:
+                payload = self._read_json()
+            except json.JSONDecodeError:
+                self._send_json({"detail": "Invalid JSON"}, 400)
+                return
+            
+            if path in ("/sdapi/v1/txt2img", "/sdapi/v1/img2img"):
+                self._generate(payload, img2img=path.endswith("img2img"))
+            elif path == "/sdapi/v1/options":
+                state.options.update(payload)
+                self._send_json(None)
+            elif path == "/sdapi/v1/interrupt":
+                state.interrupted.set()
+                self._send_json(None)
+            else:
+                self._send_json({"detail": "Not Found"}, 404)
+        
+        def _generate(self, payload: Dict[str, Any], img2img: bool):
+            state.count('requests')
+            if img2img and not payload.get("init_images"):
+                self._send_json({"detail": "init_images is required for img2img"}, 422)
+                return
+            
+            batch_size = int(payload.get("batch_size", 1))
+            n_iter = int(payload.get("n_iter", 1))
+            count = batch_size * n_iter
+            prompts = payload.get("prompt", "")
+            prompts: List[str] = prompts if isinstance(prompts, list) else [prompts] * count
+            if len(prompts) != count:
+                self._send_json({"detail": "prompt list length must equal batch_size * n_iter"}, 422)
+                return
+            
+            seed = int(payload.get("seed", -1))
+            if seed == -1:
+                seed = int(state._random() * 4294967294)
+            seeds = [seed + i for i in range(count)]
+            width = int(payload.get("width", 512))
+            height = int(payload.get("height", 512))
+            
+            state.run_job(int(payload.get("steps", 20)), batch_size, n_iter)
+            
+            if state.should_fail():
+                state.count('errors')
+                self._send_json({"error": "OutOfMemoryError", "detail": "Simulated failure"}, 500)
+                return
+            
+            images = [
+                base64.b64encode(render_image(p, s, width, height)).decode()
+                for p, s in zip(prompts, seeds)
+            ]
+            state.count('images', count)
+            info = {"all_seeds": seeds, "all_prompts": prompts, "seed": seed, "width": width, "height": height}
+            self._send_json({"images": images, "parameters": payload, "info": json.dumps(info)})
+    
+    return MockSDHandler
+
+def run_server(host: str = "127.0.0.1", port: int = 7861, **state_options) -> ThreadingHTTPServer:
+    """Start the mock server in a background thread and return it"""
+    server = ThreadingHTTPServer((host, port), make_handler(MockSDState(**state_options)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Stable Diffusion WebUI API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--step-time", type=float, default=0.02, help="seconds per sampling step for one image")
+    parser.add_argument("--overhead", type=float, default=0.2, help="fixed seconds per request")
+    parser.add_argument("--jitter", type=float, default=0.1, help="relative std dev of step time")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probability of an HTTP 500 per request")
+    parser.add_argument("--batch-efficiency", type=float, default=0.6,
+                        help="a batch of n costs n**x single-image steps (1.0 = no batching gain)")
+    parser.add_argument("--rng-seed", type=int, default=None, help="seed for jitter, errors and random seeds")
+    args = parser.parse_args()
+    
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(MockSDState(
+        step_time=args.step_time,
+        overhead=args.overhead,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        batch_efficiency=args.batch_efficiency,
+        rng_seed=args.rng_seed
+    )))
+    server.daemon_threads = True
+    print(f"Mock SD WebUI listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
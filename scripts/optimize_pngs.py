@@ -0,0 +1,31 @@
+"""Optimise a set's stamp PNGs in place to fit LINE's per-file limit.
+
+    python scripts/optimize_pngs.py output/<set_id> --max-bytes 1000000
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).parent.parent))
+
+from core.png_optimizer import PNGOptimizer
+
+def main():
+    parser = argparse.ArgumentParser(description="Optimise a set's stamp PNGs to fit a per-file byte budget")
+    parser.add_argument("set_dir")
+    parser.add_argument("--max-bytes", type=int, default=None)
+    parser.add_argument("--quantize", choices=['auto', 'always', 'never'], default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    
+    optimizer = PNGOptimizer(max_bytes=args.max_bytes, workers=args.workers, quantize=args.quantize)
+    summary = optimizer.optimize_set(args.set_dir)
+    for result in summary['files']:
+        flag = "" if result['fits'] else "  OVER BUDGET"
+        print(f"{Path(result['path']).name:<16} {result['bytes_before'] / 1024:8.1f}KB -> "
+              f"{result['bytes_after'] / 1024:8.1f}KB  {result['method']}{flag}")
+    print(f"{len(summary['files'])} files, {summary['bytes_saved'] / 1024:.1f}KB saved "
+          f"in {summary['seconds']:.2f}s ({len(summary['over_budget'])} over {optimizer.max_bytes} bytes)")
+
+if __name__ == "__main__":
+    main()
@@ -80,6 +80,11 @@ class SlackBot:
             await ack()
             await self._handle_export_booth(body)
         
+        @self.app.action("export_line")
+        async def handle_export_line(ack, body, logger):
+            await ack()
+            await self._handle_export_line(body)
+        
         @self.app.action("select_stamp_type")
         async def handle_select_stamp_type(ack, body, logger):
             await ack()
@@ -730,6 +735,11 @@ class SlackBot:
         else:
             self.workflow_manager.create_variation(set_id, theme)
     
+    async def _handle_export_line(self, body: Dict):
+        """Handle LINE submission zip export"""
+        set_id = body["actions"][0]["value"]
+        self.workflow_manager.export_for_line(set_id)
+    
     async def _handle_export_booth(self, body: Dict):
         """Handle BOOTH export"""
         set_id = body["actions"][0]["value"]
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+from PIL import Image, ImageDraw
+from rembg.sessions.u2net import U2netSession
+
+from ..core import background_remover
+from ..core.background_remover import BackgroundRemover
+
+class _InnerSession:
+    """Stands in for the ONNX model: the 'mask' is the mean of the normalised input channels"""
+    
+    class _Input:
+        name = 'input.1'
+        shape = ['batch', 3, 320, 320]
+    
+    def get_inputs(self):
+        return [self._Input()]
+    
+    def run(self, outputs, feed):
+        return [feed['input.1'].mean(axis=1, keepdims=True)]
+
+class _Session:
+    inner_session = _InnerSession()
+
+def _stamp(seed):
+    """Non-square stamp-sized image with an off-centre figure"""
+    rng = np.random.default_rng(seed)
+    img = Image.fromarray(rng.integers(0, 256, (320, 370, 3), dtype=np.uint8))
+    ImageDraw.Draw(img).ellipse((20, 40, 200, 300), fill=(250, 240, 230))
+    return img
+
+def test_batched_masks_match_rembg_single_image_path():
+    remover = BackgroundRemover('u2net', pool_size=1)
+    remover._created = 1
+    remover._sessions.put(_Session())
+    images = [_stamp(seed) for seed in range(3)]
+    
+    batched = remover.predict_masks(images, batch_size=2)
+    
+    single = U2netSession.__new__(U2netSession)
+    single.inner_session = _InnerSession()
+    for img, mask in zip(images, batched):
+        expected = single.predict(img)[0]
+        assert mask.size == expected.size == img.size
+        difference = np.abs(np.asarray(mask, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+        # float32 here vs float64 in rembg: at most one grey level apart
+        assert difference.max() <= 1
+
+def test_warm_up_calibrates_outside_inference_stats(monkeypatch):
+    monkeypatch.delenv('REMBG_BATCH_SIZE', raising=False)
+    monkeypatch.setattr(background_remover, '_calibrated_batch_sizes', {})
+    remover = BackgroundRemover('u2net', pool_size=1)
+    monkeypatch.setattr(remover, '_create_session', _Session)
+    
+    remover.warm_up()
+    assert remover.batch_size in (1, 2, 4, 8)
+    assert remover.get_stats()['images'] == 0
+    
+    # A second remover in the same process reuses the calibration
+    other = BackgroundRemover('u2net', pool_size=1)
+    monkeypatch.setattr(other, 'calibrate', lambda: pytest.fail("calibrated twice"))
+    assert other.get_batch_size() == remover.batch_size
+    
+    remover.predict_masks([_stamp(0)])
+    assert remover.get_stats()['images'] == 1
@@ -0,0 +1,34 @@
+import threading
+from concurrent.futures import CancelledError
+
+import pytest
+
+from ..core.generation_queue import GenerationQueue, PRIORITY_FULL, PRIORITY_SAMPLE
+
+def test_cancel_withdraws_only_queued_jobs_with_the_tag():
+    queue = GenerationQueue(workers=1)
+    started, release = threading.Event(), threading.Event()
+    
+    def blocker():
+        started.set()
+        release.wait(5)
+        return 'running'
+    
+    running = queue.submit(PRIORITY_FULL, blocker, tag='set-1')
+    assert started.wait(5)
+    queued = [queue.submit(PRIORITY_FULL, lambda: 'ran', tag='set-1') for _ in range(3)]
+    other = queue.submit(PRIORITY_SAMPLE, lambda: 'other', tag='set-2')
+    
+    assert queue.cancel('set-1') == 3
+    release.set()
+    
+    assert running.result(5) == 'running'
+    assert other.result(5) == 'other'
+    for future in queued:
+        with pytest.raises(CancelledError):
+            future.result(5)
+    stats = queue.get_stats()['classes']['full']
+    assert stats['cancelled'] == 3
+    assert stats['queued'] == 0
+    assert stats['completed'] == 1
+    queue.shutdown()
@@ -0,0 +1,90 @@
+import numpy as np
+from PIL import Image
+
+from ..core.thumbnails import ThumbnailCache
+
+def _striped_palette_stamp(path):
+    """1px black/white stripes saved as a palette PNG, as the PNG optimizer writes them"""
+    pixels = np.zeros((320, 370, 4), dtype=np.uint8)
+    pixels[:, ::2, :3] = 255
+    pixels[..., 3] = 255
+    Image.fromarray(pixels, 'RGBA').quantize(colors=2).save(path)
+
+def test_palette_source_is_resampled_not_decimated(tmp_path):
+    output_dir = tmp_path / "output"
+    (output_dir / "set").mkdir(parents=True)
+    _striped_palette_stamp(output_dir / "set" / "stamp_01.png")
+    cache = ThumbnailCache(output_dir, cache_dir=str(tmp_path / "thumbs"))
+    
+    for fmt in ('webp', 'jpeg'):
+        path, _, _ = cache.get(cache.resolve("set/stamp_01.png"), 160, fmt)
+        with Image.open(path) as thumb:
+            luma = np.asarray(thumb.convert('L'), dtype=np.float32)
+        # LANCZOS averages the stripes to grey; nearest-neighbour would keep them at 0/255
+        assert thumb.width == 160
+        assert luma.std() < 40
+        assert 80 < luma.mean() < 180
+
+def test_etag_follows_source_content(tmp_path):
+    output_dir = tmp_path / "output"
+    (output_dir / "set").mkdir(parents=True)
+    source = output_dir / "set" / "stamp_01.png"
+    Image.new('RGBA', (370, 320), (255, 0, 0, 128)).save(source)
+    cache = ThumbnailCache(output_dir, cache_dir=str(tmp_path / "thumbs"))
+    
+    first = cache.get(cache.resolve("set/stamp_01.png"), 300)
+    assert cache.get(cache.resolve("set/stamp_01.png"), 300) == first
+    Image.new('RGBA', (370, 320), (0, 0, 255, 255)).save(source)
+    assert cache.get(cache.resolve("set/stamp_01.png"), 300)[1] != first[1]
+
+def test_cache_is_outside_static_output(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.delenv('THUMB_CACHE_DIR', raising=False)
+    output_dir = tmp_path / "output"
+    output_dir.mkdir()
+    cache = ThumbnailCache(output_dir)
+    assert output_dir.resolve() not in cache.cache_dir.resolve().parents
+    assert cache.resolve("../outside.png") is None
+
+def test_least_recently_used_thumbnails_are_evicted(tmp_path):
+    output_dir = tmp_path / "output"
+    (output_dir / "set").mkdir(parents=True)
+    for i in range(3):
+        Image.new('RGB', (370, 320), (i * 100, 0, 0)).save(output_dir / "set" / f"stamp_0{i}.png")
+    sizes = [p.stat().st_size for p, _, _ in (
+        ThumbnailCache(output_dir, cache_dir=str(tmp_path / "sizes")).get(output_dir / "set" / f"stamp_0{i}.png", 160)
+        for i in range(3)
+    )]
+    # Room for any two of them, not all three
+    cache = ThumbnailCache(output_dir, cache_dir=str(tmp_path / "thumbs"), max_bytes=sizes[0] + max(sizes[1:]))
+    
+    first, _, _ = cache.get(cache.resolve("set/stamp_00.png"), 160)
+    second, _, _ = cache.get(cache.resolve("set/stamp_01.png"), 160)
+    cache.get(cache.resolve("set/stamp_00.png"), 160)  # Now more recent than the second
+    third, _, _ = cache.get(cache.resolve("set/stamp_02.png"), 160)
+    
+    assert first.exists() and third.exists()
+    assert not second.exists()
+    stats = cache.get_stats()
+    assert stats['evictions'] == 1
+    assert stats['bytes'] <= cache.max_bytes
+    
+    # A restarted process picks up the existing files and their order
+    restarted = ThumbnailCache(output_dir, cache_dir=str(tmp_path / "thumbs"), max_bytes=cache.max_bytes)
+    assert restarted.get_stats()['entries'] == 2
+
+def test_version_token_matches_only_current_source(tmp_path):
+    output_dir = tmp_path / "output"
+    (output_dir / "set").mkdir(parents=True)
+    source = output_dir / "set" / "stamp_01.png"
+    Image.new('RGB', (370, 320), (255, 0, 0)).save(source)
+    cache = ThumbnailCache(output_dir, cache_dir=str(tmp_path / "thumbs"))
+    
+    old_version = cache.version("set/stamp_01.png")
+    _, etag, _ = cache.get(cache.resolve("set/stamp_01.png"), 320)
+    assert etag.startswith(f'"{old_version}-')
+    assert cache.is_current(cache.resolve("set/stamp_01.png"), old_version)
+    
+    Image.new('RGB', (370, 320), (0, 0, 255)).save(source)
+    assert not cache.is_current(cache.resolve("set/stamp_01.png"), old_version)
+    assert not cache.is_current(cache.resolve("set/stamp_01.png"), None)
@@ -0,0 +1,118 @@
+import threading
+
+import pytest
+
+pytest.importorskip("google.generativeai")
+
+from ..core import workflow
+from ..core.sd_api import SDTransientError
+
+class _Stamp:
+    def __init__(self, status, image_path):
+        self.id = 'stamp-1'
+        self.set_id = 'set-1'
+        self.number = 1
+        self.phrase = 'おはよう'
+        self.prompt = 'cute cat'
+        self.negative_prompt = ''
+        self.seed = 42
+        self.status = status
+        self.image_path = image_path
+
+class _StampSet:
+    def __init__(self, status):
+        self.id = 'set-1'
+        self.status = status
+        self.character_consistency = False
+        self.reference_image_path = None
+
+class _StampSetCRUD:
+    def __init__(self, stamp_set):
+        self.stamp_set = stamp_set
+    
+    def get(self, set_id):
+        return self.stamp_set if set_id == self.stamp_set.id else None
+
+class _StampCRUD:
+    def __init__(self, stamp):
+        self.stamp = stamp
+    
+    def get(self, stamp_id):
+        return self.stamp if stamp_id == self.stamp.id else None
+    
+    def update_status(self, stamp_id, status):
+        self.stamp.status = status
+    
+    def increment_retry_count(self, stamp_id):
+        pass
+    
+    def update_image_path(self, stamp_id, image_path):
+        self.stamp.image_path = image_path
+    
+    def update_seed(self, stamp_id, seed):
+        self.stamp.seed = seed
+
+class _Session:
+    def close(self):
+        pass
+
+class _FailingQueue:
+    def run(self, *args, **kwargs):
+        raise SDTransientError("backend down")
+
+class _LoRATrainer:
+    def get_lora_path(self, set_id):
+        return None
+    
+    def build_prompt_with_lora(self, prompt, set_id, lora_path):
+        return prompt
+
+class _InlineThread:
+    """Runs the background job on start() so the test can check its outcome"""
+    
+    def __init__(self, target, daemon=None):
+        self.target = target
+    
+    def start(self):
+        self.target()
+
+@pytest.fixture
+def regenerate(monkeypatch):
+    def run(set_status, stamp_status, draft_samples=True):
+        stamp = _Stamp(stamp_status, '/output/set-1/drafts/preview_01.png')
+        stamp_crud = _StampCRUD(stamp)
+        monkeypatch.setattr(workflow, 'get_session', lambda engine: _Session())
+        monkeypatch.setattr(workflow, 'StampCRUD', lambda db: stamp_crud)
+        set_crud = _StampSetCRUD(_StampSet(set_status))
+        monkeypatch.setattr(workflow, 'StampSetCRUD', lambda db: set_crud)
+        monkeypatch.setattr(threading, 'Thread', _InlineThread)
+        
+        manager = workflow.StampWorkflowManager.__new__(workflow.StampWorkflowManager)
+        manager.engine = None
+        manager.checkpoint = None
+        manager.draft_samples = draft_samples
+        manager.draft_scale = 0.5
+        manager.draft_steps = 12
+        manager.lora_trainer = _LoRATrainer()
+        manager.generation_queue = _FailingQueue()
+        messages = []
+        manager._notify_slack = lambda text, blocks=None: messages.append(text)
+        
+        manager.regenerate_single_stamp('set-1', 'stamp-1')
+        return stamp, messages
+    return run
+
+def test_failed_draft_regenerate_stays_a_draft(regenerate):
+    stamp, messages = regenerate('samples_review', 'draft')
+    # Still picked up (and finalized) by generate_full_stamps
+    assert stamp.status == 'draft'
+    assert stamp.image_path.endswith('drafts/preview_01.png')
+    assert messages[-1] == "❌ スタンプの再生成に失敗しました。"
+
+def test_failed_regenerate_of_draft_outside_review_stays_a_draft(regenerate):
+    stamp, _ = regenerate('generating', 'draft', draft_samples=False)
+    assert stamp.status == 'draft'
+
+def test_failed_regenerate_of_final_stamp_is_pending(regenerate):
+    stamp, _ = regenerate('generating', 'pending')
+    assert stamp.status == 'pending'
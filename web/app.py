@@ -3,15 +3,21 @@ import asyncio
 from pathlib import Path
 from typing import List, Optional
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from starlette.background import BackgroundTask
 from jinja2 import Environment, FileSystemLoader
 from dotenv import load_dotenv
 
 from ..db.models import init_db, get_session
 from ..db.crud import StampSetCRUD, StampCRUD
 from ..core.image_utils import ImageProcessor
+from ..core.line_exporter import LineExporter
+from ..core.png_optimizer import PNGOptimizer
+from ..core.sd_progress import progress_registry
+from ..core.thumbnails import ThumbnailCache
 
 load_dotenv()
 
@@ -36,6 +42,17 @@ output_dir = Path(os.getenv('OUTPUT_DIR', './output'))
 if output_dir.exists():
     app.mount("/static", StaticFiles(directory=str(output_dir)), name="static")
 
+# Resized WebP/JPEG previews (THUMB_CACHE_DIR, THUMB_CACHE_MB, THUMB_WIDTHS, THUMB_QUALITY)
+thumbnail_cache = ThumbnailCache(output_dir)
+
+# LINE submission zips, streamed to the browser
+line_exporter = LineExporter(str(output_dir), PNGOptimizer())
+
+def preview_url(file_path: Path, width: int) -> str:
+    """Thumbnail URL with a version token, so browsers may cache it indefinitely"""
+    relative_path = file_path.resolve().relative_to(output_dir.resolve()).as_posix()
+    return f"/thumb/{relative_path}?w={width}&v={thumbnail_cache.version(relative_path)}"
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request, status: Optional[str] = None, genre: Optional[str] = None):
     """スタンプセット一覧ページ"""
@@ -103,11 +120,13 @@ async def set_detail(request: Request, set_id: str):
         # Prepare stamps data
         stamps_data = []
         for stamp in stamps:
-            # Get relative path for static serving
+            # Get relative path for static serving, plus a small preview for the list
             image_path = None
+            thumb_path = None
             if stamp.image_path and Path(stamp.image_path).exists():
                 relative_path = Path(stamp.image_path).relative_to(output_dir)
                 image_path = f"/static/{relative_path}"
+                thumb_path = preview_url(Path(stamp.image_path), 320)
             
             stamps_data.append({
                 'id': stamp.id,
@@ -117,6 +136,7 @@ async def set_detail(request: Request, set_id: str):
                 'negative_prompt': stamp.negative_prompt,
                 'status': stamp.status,
                 'image_path': image_path,
+                'thumb_path': thumb_path,
                 'is_sample': stamp.is_sample,
                 'seed': stamp.seed
             })
@@ -124,6 +144,8 @@ async def set_detail(request: Request, set_id: str):
         # Get grid images
         sample_grid_path = None
         full_grid_path = None
+        sample_grid_preview = None
+        full_grid_preview = None
         
         set_dir = output_dir / set_id
         if set_dir.exists():
@@ -133,17 +155,21 @@ async def set_detail(request: Request, set_id: str):
             if sample_grid_file.exists():
                 relative_path = sample_grid_file.relative_to(output_dir)
                 sample_grid_path = f"/static/{relative_path}"
+                sample_grid_preview = preview_url(sample_grid_file, 1280)
             
             if full_grid_file.exists():
                 relative_path = full_grid_file.relative_to(output_dir)
                 full_grid_path = f"/static/{relative_path}"
+                full_grid_preview = preview_url(full_grid_file, 1280)
         
         return templates.TemplateResponse("set_detail.html", {
             "request": request,
             "stamp_set": stamp_set,
             "stamps": stamps_data,
             "sample_grid_path": sample_grid_path,
-            "full_grid_path": full_grid_path
+            "full_grid_path": full_grid_path,
+            "sample_grid_preview": sample_grid_preview,
+            "full_grid_preview": full_grid_preview
         })
         
     finally:
@@ -178,17 +204,47 @@ async def export_lora(set_id: str):
         if not stamps_with_images:
             raise HTTPException(status_code=400, detail="No stamps with images found")
         
-        # Export for LoRA
-        image_processor.export_for_lora(set_id, stamps_with_images)
+        # Export for LoRA (only changed images and captions are written)
+        stats = await run_in_threadpool(image_processor.export_for_lora, set_id, stamps_with_images)
         
         # Mark as exported
         set_crud.mark_lora_exported(set_id)
         
-        return {"message": f"LoRA data exported for {len(stamps_with_images)} stamps"}
+        return {"message": f"LoRA data exported for {len(stamps_with_images)} stamps", "stats": stats}
         
     finally:
         db.close()
 
+@app.get("/set/{set_id}/line.zip")
+async def export_line(set_id: str, count: Optional[int] = None, main: Optional[int] = None):
+    """LINE申請用ZIPをストリーミングでダウンロード"""
+    db = get_session(engine)
+    try:
+        stamp_set = StampSetCRUD(db).get(set_id)
+        if not stamp_set:
+            raise HTTPException(status_code=404, detail="Stamp set not found")
+        
+        stamps = [
+            {'number': stamp.number, 'image_path': stamp.image_path, 'phrase': stamp.phrase}
+            for stamp in StampCRUD(db).get_by_set(set_id) if stamp.image_path
+        ]
+    finally:
+        db.close()
+    
+    # Assets are derived, validated and spilled to disk before the response starts; the zip is streamed from there
+    package = await run_in_threadpool(line_exporter.build, set_id, stamps, count, main)
+    if not package.ok:
+        raise HTTPException(status_code=422, detail={'issues': package.issues, 'warnings': package.warnings})
+    
+    # iter_zip removes the work directory when it finishes, but a client that disconnects
+    # before the body starts never runs it; the background task covers that case
+    return StreamingResponse(
+        line_exporter.iter_zip(package),
+        media_type='application/zip',
+        headers={'Content-Disposition': f'attachment; filename="line_{set_id}.zip"'},
+        background=BackgroundTask(package.cleanup)
+    )
+
 @app.get("/download/{set_id}/{filename}")
 async def download_file(set_id: str, filename: str):
     """ダウンロードファイルを提供"""
@@ -203,6 +259,40 @@ async def download_file(set_id: str, filename: str):
         media_type='application/octet-stream'
     )
 
+@app.get("/thumb/{file_path:path}")
+async def thumbnail(request: Request, file_path: str, w: int = 320, fmt: Optional[str] = None,
+                    v: Optional[str] = None):
+    """縮小プレビュー（WebP/JPEG）を提供"""
+    source = thumbnail_cache.resolve(file_path)
+    if source is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    
+    negotiated = fmt is None
+    if negotiated:
+        fmt = 'webp' if 'image/webp' in request.headers.get('accept', '') else 'jpeg'
+    try:
+        path, etag, media_type = await run_in_threadpool(thumbnail_cache.get, source, w, fmt)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if thumbnail_cache.is_current(source, v):
+        # The URL names this exact source, so a new image always gets a new URL
+        cache_control = 'public, max-age=31536000, immutable'
+    elif v:
+        # Stale or mistyped token: the same URL may serve different content later
+        cache_control = 'public, max-age=60, must-revalidate'
+    else:
+        cache_control = 'public, no-cache'
+    headers = {'ETag': etag, 'Cache-Control': cache_control}
+    if negotiated:
+        headers['Vary'] = 'Accept'
+    
+    if_none_match = request.headers.get('if-none-match', '')
+    if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    
+    return FileResponse(path=str(path), media_type=media_type, headers=headers)
+
 @app.get("/api/sets")
 async def get_sets_api(status: Optional[str] = None):
     """API: スタンプセット一覧をJSONで取得"""
@@ -252,6 +342,8 @@ async def get_set_api(set_id: str):
                 'status': stamp.status,
                 'is_sample': stamp.is_sample,
                 'seed': stamp.seed,
+                'thumbnail_url': preview_url(Path(stamp.image_path), 320)
+                if stamp.image_path and Path(stamp.image_path).exists() else None,
                 'created_at': stamp.created_at.isoformat()
             })
         
@@ -272,6 +364,22 @@ async def get_set_api(set_id: str):
     finally:
         db.close()
 
+@app.get("/api/progress")
+async def get_progress_api():
+    """API: 実行中の生成の進捗とGPUごとのステップ進捗を取得"""
+    return {
+        "sets": progress_registry.get_all(),
+        "backends": progress_registry.get_backend_snapshots()
+    }
+
+@app.get("/api/set/{set_id}/progress")
+async def get_set_progress_api(set_id: str):
+    """API: スタンプセットの生成進捗を取得"""
+    progress = progress_registry.get(set_id)
+    if not progress:
+        raise HTTPException(status_code=404, detail="No generation progress for this set")
+    return progress
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv('WEB_UI_PORT', 8080))